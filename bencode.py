@@ -3,9 +3,30 @@
 
 Format specs:
     <http://wiki.theory.org/BitTorrentSpecification>
+
+Decoding is done with decode(), which works on a whole buffer (bytes or
+mmap) using an integer offset. The older stream functions (readany(),
+etc.) read a byte at a time and are much slower; they are kept for
+reading from non-seekable streams.
+
+Lazy decoding is done with lazy(), which returns LazyDict and LazyList
+views of containers. These only record the byte span of each item and
+decode it when accessed, and also give access to the raw (encoded) bytes
+of each item, e.g. for hashing a torrent's info dict.
+
+Encoding is done with iterencode(), which generates the encoded data as
+a sequence of chunks; string payloads are passed through without being
+copied. It's non-recursive, so it can handle any nesting depth.
+
+When run as a script, it benchmarks both decoders on the specified files.
 """
 
+from __future__ import print_function
+import collections.abc
+import mmap
 import re
+import sys
+import time
 try:
     from cStringIO import StringIO as DataIO
     str2bytes = lambda s: s
@@ -16,30 +37,45 @@ except ImportError:
 import fileutil
 
 
+MMAP_MIN_SIZE = 2**20  # larger files are memory-mapped by load()
+
+
 def loads(s):
-    """Read an object from a string."""
-    return load(DataIO(s))
+    """Read an object from a string (or any buffer supported by decode())."""
+    return decode(s)[0]
 
 
 def load(f):
-    """Read an object from a file (or file path)."""
+    """Read an object from a file (or file path).
+
+    The file must be seekable; it is read from its current position and
+    left positioned after the end of the object.
+    """
     if not hasattr(f, 'read'):
-        f = open(f, 'rb')
-    return readany(f)
+        with open(f, 'rb') as f:
+            return load(f)
+    start = f.tell()
+    size = fileutil.fsize(f) - start
+    if size >= MMAP_MIN_SIZE and start == 0:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            obj, end = decode(m)
+    else:
+        obj, end = decode(f.read())
+    f.seek(start + end)
+    return obj
 
 
 def dumps(obj):
     """Write an object to a string."""
-    f = DataIO()
-    dump(f, obj)
-    return f.getvalue()
+    return b''.join(iterencode(obj))
 
 
 def dump(f, obj):
     """Write an object to a file (or file path)."""
     if not hasattr(f, 'write'):
-        f = open(f, 'wb')
-    writeany(f, obj)
+        with open(f, 'wb') as f:
+            return dump(f, obj)
+    f.writelines(iterencode(obj))
 
 
 """
@@ -57,6 +93,256 @@ bencoding format
 INT_FORMAT = re.compile(br'^(?:0|-?[1-9][0-9]*)$')
 
 
+def decode(data, pos=0):
+    """Decode a bencoded value from a buffer, starting at an offset.
+
+    The buffer can be a bytes or mmap object. Other buffers (bytearray,
+    memoryview) are copied to bytes first, since their slices are not
+    hashable or lack find().
+    Returns the value and the offset following it.
+    """
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    try:
+        return _decode(data, pos)
+    except IndexError:
+        raise EOFError
+
+
+# integer body and terminator, used by decode()
+_INT_END_FORMAT = re.compile(br'(?:0|-?[1-9][0-9]*)e')
+
+# first bytes of bencoded values
+_INT, _LIST, _DICT, _END, _DIGIT0, _DIGIT9 = b'ilde09'
+
+
+def _strspan(data, pos):
+    """Start and end offsets of the string data at pos."""
+    colon = data.find(b':', pos)
+    if colon < 0:
+        raise EOFError
+    size = data[pos:colon]
+    # int() alone would also accept signs, spaces and underscores
+    if not size.isdigit():
+        raise ValueError('bad string size')
+    start = colon + 1
+    end = start + int(size, 10)
+    if end > len(data):
+        raise EOFError
+    return start, end
+
+
+def _decodestr(data, pos):
+    start, end = _strspan(data, pos)
+    return data[start:end], end
+
+
+def _decode(data, pos):
+    # strings are checked first, since they're the most common values
+    c = data[pos]
+    if _DIGIT0 <= c <= _DIGIT9:
+        return _decodestr(data, pos)
+    elif c == _DICT:
+        ret = {}
+        pos += 1
+        while data[pos] != _END:
+            key, pos = _decodestr(data, pos)
+            ret[key], pos = _decode(data, pos)
+        return ret, pos + 1
+    elif c == _LIST:
+        ret = []
+        pos += 1
+        while data[pos] != _END:
+            x, pos = _decode(data, pos)
+            ret.append(x)
+        return ret, pos + 1
+    elif c == _INT:
+        m = _INT_END_FORMAT.match(data, pos + 1)
+        if not m:
+            if data.find(b'e', pos) < 0:
+                raise EOFError
+            raise ValueError('bad integer')
+        end = m.end()
+        return int(data[pos+1:end-1], 10), end
+    else:
+        raise ValueError('bad value type')
+
+
+def _skip(data, pos):
+    """Offset following the value at pos, without decoding it."""
+    # iterative, to avoid a call per nested value
+    depth = 0
+    find = data.find
+    while True:
+        c = data[pos]
+        if _DIGIT0 <= c <= _DIGIT9:
+            pos = _strspan(data, pos)[1]
+        elif c == _DICT or c == _LIST:
+            depth += 1
+            pos += 1
+            continue
+        elif c == _END and depth:
+            depth -= 1
+            pos += 1
+        elif c == _INT:
+            m = _INT_END_FORMAT.match(data, pos + 1)
+            if not m:
+                if find(b'e', pos) < 0:
+                    raise EOFError
+                raise ValueError('bad integer')
+            pos = m.end()
+        else:
+            raise ValueError('bad value type')
+        if not depth:
+            return pos
+
+
+def lazy(data, pos=0):
+    """Lazily decode a bencoded value from a buffer, starting at an offset.
+
+    Strings and integers are decoded immediately, while dicts and lists
+    are returned as LazyDict and LazyList objects. See decode() for the
+    buffer types.
+    """
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    try:
+        c = data[pos]
+        if c == _DICT:
+            return LazyDict(data, pos)
+        elif c == _LIST:
+            return LazyList(data, pos)
+        return _decode(data, pos)[0]
+    except IndexError:
+        raise EOFError
+
+
+def lazyload(path):
+    """Lazily decode an object from a file path. See lazy()."""
+    with open(path, 'rb') as f:
+        return lazy(f.read())
+
+
+class LazyContainer(object):
+    """Base of lazily decoded containers.
+
+    Item spans are found when first needed and items are decoded on each
+    access, so it's best to keep references to the items that are needed
+    more than once.
+    """
+
+    def __init__(self, data, start):
+        self.data = data
+        self.start = start
+        self._spans = None
+        self._end = None
+
+    @property
+    def end(self):
+        """Offset following the container."""
+        if self._end is None:
+            self._end = _skip(self.data, self.start)
+        return self._end
+
+    @property
+    def raw(self):
+        """Encoded bytes of the container."""
+        return self.data[self.start:self.end]
+
+    def decode(self):
+        """Fully decoded container (dict or list)."""
+        try:
+            return _decode(self.data, self.start)[0]
+        except IndexError:
+            raise EOFError
+
+    def spans(self):
+        """Item spans; see subclasses for their format."""
+        if self._spans is None:
+            try:
+                self._spans = self._findspans()
+            except IndexError:
+                raise EOFError
+        return self._spans
+
+    def _item(self, start):
+        c = self.data[start]
+        if c == _DICT:
+            return LazyDict(self.data, start)
+        elif c == _LIST:
+            return LazyList(self.data, start)
+        return _decode(self.data, start)[0]
+
+
+class LazyDict(LazyContainer, collections.abc.Mapping):
+    """Lazily decoded dict; keys are decoded, values only when accessed."""
+
+    def _findspans(self):
+        ret = {}
+        data = self.data
+        pos = self.start + 1
+        while data[pos] != _END:
+            key, pos = _decodestr(data, pos)
+            end = _skip(data, pos)
+            ret[key] = pos, end
+            pos = end
+        self._end = pos + 1
+        return ret
+
+    def span(self, key):
+        """Start and end offsets of the value of a key."""
+        return self.spans()[key]
+
+    def rawitem(self, key):
+        """Encoded bytes of the value of a key."""
+        start, end = self.spans()[key]
+        return self.data[start:end]
+
+    def __getitem__(self, key):
+        return self._item(self.spans()[key][0])
+
+    def __iter__(self):
+        return iter(self.spans())
+
+    def __len__(self):
+        return len(self.spans())
+
+    def __contains__(self, key):
+        return key in self.spans()
+
+
+class LazyList(LazyContainer, collections.abc.Sequence):
+    """Lazily decoded list; items are decoded when accessed."""
+
+    def _findspans(self):
+        ret = []
+        data = self.data
+        pos = self.start + 1
+        while data[pos] != _END:
+            end = _skip(data, pos)
+            ret.append((pos, end))
+            pos = end
+        self._end = pos + 1
+        return ret
+
+    def span(self, index):
+        """Start and end offsets of an item."""
+        return self.spans()[index]
+
+    def rawitem(self, index):
+        """Encoded bytes of an item."""
+        start, end = self.spans()[index]
+        return self.data[start:end]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(start) for start, _ in self.spans()[index]]
+        return self._item(self.spans()[index][0])
+
+    def __len__(self):
+        return len(self.spans())
+
+
 def readstr(f, lead=b''):
     """Read a bencoded string. Accepts leading bytes that are already read."""
     size = int(lead + fileutil.readupto(f, b':'))
@@ -110,20 +396,76 @@ def readany(f, checkend=False):
 
 def writeany(f, obj):
     """Write any bencoded value."""
-    if isinstance(obj, dict):
-        f.write(b'd')
-        for k in sorted(obj):
-            if not isinstance(k, bytes):
-                raise TypeError('dict key is not a string')
-            writeany(f, k)
-            writeany(f, obj[k])
-        f.write(b'e')
-    elif isinstance(obj, list):
-        f.write(b'l')
-        for x in obj:
-            writeany(f, x)
-        f.write(b'e')
-    elif isinstance(obj, bytes):
-        f.write(str2bytes(str(len(obj))) + b':' + obj)
-    else:  # expect int-convertible
-        f.write(b'i' + str2bytes(str(int(obj))) + b'e')
+    f.writelines(iterencode(obj))
+
+
+def _dictitems(obj):
+    """Generate the sorted keys and values of a dict, alternately."""
+    for k in sorted(obj):
+        if not isinstance(k, bytes):
+            raise TypeError('dict key is not a string')
+        yield k
+        yield obj[k]
+
+
+def iterencode(obj):
+    """Generate the chunks of a bencoded value.
+
+    Strings can be any bytes-like objects; their payloads are generated
+    as-is, separately from their length prefixes. Integers are anything
+    int-convertible.
+    """
+    stack = [iter([obj])]  # iterators of the items of open containers
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, (bytes, bytearray)):
+                yield b'%d:' % len(x)
+                yield x
+            elif isinstance(x, memoryview):
+                yield b'%d:' % x.nbytes
+                yield x
+            elif isinstance(x, dict):
+                yield b'd'
+                stack.append(_dictitems(x))
+                break
+            elif isinstance(x, list):
+                yield b'l'
+                stack.append(iter(x))
+                break
+            else:  # expect int-convertible
+                yield b'i%de' % int(x)
+        else:
+            stack.pop()
+            if stack:
+                yield b'e'
+
+
+def benchmark(paths, repeat=3):
+    """Compare the speed of decode() and readany() on a list of files."""
+    total_old, total_new = 0, 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            old = readany(DataIO(data))
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            new = decode(data)[0]
+        t2 = time.perf_counter()
+        if old != new:
+            print('results differ: %s' % path, file=sys.stderr)
+        total_old += t1 - t0
+        total_new += t2 - t1
+        print('%10d %9.3f %9.3f %7.1fx  %s' % (
+            len(data), (t1 - t0) / repeat, (t2 - t1) / repeat,
+            (t1 - t0) / (t2 - t1) if t2 > t1 else 0, path))
+    print('total: readany %.3f sec, decode %.3f sec' % (
+        total_old / repeat, total_new / repeat))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: bencode.py FILE...  (benchmarks readany vs decode)')
+    print('%10s %9s %9s %8s  %s' % ('size', 'readany', 'decode', 'speedup', 'path'))
+    benchmark(sys.argv[1:])
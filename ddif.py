@@ -1,14 +1,26 @@
-"""Compare the files (and optionally their hashes/bytes) of two directories."""
+"""Compare the files (and optionally their hashes/bytes) of two directories.
+
+Directories are listed with os.scandir(), using the cached type and stat
+info of each entry. Subdirectory and file content comparisons can run
+concurrently on a thread pool; output is still printed in the same
+(sorted, depth-first) order as in serial mode.
+"""
 
 from __future__ import print_function
 import os
 import sys
-import hashlib
+import random
 import argparse
+import threading
+import concurrent.futures
+import weakref
 import efutil
 
 
 IO_BUFLEN = 2 ** 20
+SAMPLE_BUFLEN = 2 ** 16
+SAMPLE_BLOCKS = 4  # number of random blocks checked by sampling
+MTIME_TOLERANCE = 2  # seconds; FAT timestamps have 2 second resolution
 
 
 if os.name == 'posix':
@@ -37,52 +49,115 @@ def merged(a, b, case_sens):
     """
     if case_sens:
         sort_key = lambda s: s
-        item_cmp = lambda s1, s2: cmp(s1, s2)
     else:
         sort_key = lambda s: s.lower()
-        item_cmp = lambda s1, s2: cmp(s1.lower(), s2.lower())
 
     a = sorted(a, key=sort_key)
     b = sorted(b, key=sort_key)
 
-    while a or b:
-        if not a:
-            yield b.pop(0), '>'
-        elif not b:
-            yield a.pop(0), '<'
+    i, j = 0, 0
+    while i < len(a) or j < len(b):
+        if i == len(a):
+            yield b[j], '>'
+            j += 1
+        elif j == len(b):
+            yield a[i], '<'
+            i += 1
         else:
-            order = item_cmp(a[0], b[0])
+            order = cmp(sort_key(a[i]), sort_key(b[j]))
             if order < 0:
-                yield a.pop(0), '<'
+                yield a[i], '<'
+                i += 1
             elif order > 0:
-                yield b.pop(0), '>'
+                yield b[j], '>'
+                j += 1
             else:
-                b.pop(0)
-                yield a.pop(0), '='
+                yield a[i], '='
+                i += 1
+                j += 1
 
 
-def compare_file_hashes(path1, path2):
-    """Compare two files using MD5 hashes.
+class Deferred(object):
+    """Future-like object that performs a call when its result is requested.
 
-    Returns False as soon as a difference is detected, otherwise True.
+    Used in place of thread pool futures in serial mode, so that the
+    output of each subdirectory is produced only when it's printed.
     """
-    if os.path.getsize(path1) != os.path.getsize(path2):
-        return False
-    hash1, hash2 = hashlib.md5(), hashlib.md5()
-    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
-        while True:
-            s1, s2 = f1.read(IO_BUFLEN), f2.read(IO_BUFLEN)
-            if len(s1) != len(s2):
-                # size mismatch
-                return False
-            elif not s1:
-                # both files exhausted
-                return True
-            else:
-                hash1.update(s1)
-                hash2.update(s2)
-                if hash1.digest() != hash2.digest():
-                    return False
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+    def result(self):
+        return self.func(*self.args)
+
+
+def scan_dir(path):
+    """Dict of names to os.DirEntry objects of a directory's items."""
+    with os.scandir(path) as it:
+        return dict((entry.name, entry) for entry in it)
+
+
+def print_items(items, stats):
+    """Print the output items of a directory comparison and update stats.
+
+    See compare_dirs() for item types.
+    """
+    for item in items:
+        if isinstance(item, tuple):
+            prefix, relpath, stats_key = item
+            if prefix:
+                efutil.conout(prefix, relpath)
+            if stats_key:
+                stats[stats_key] += 1
+        else:
+            print_items(item.result(), stats)
+
+
+_local = threading.local()  # per thread I/O buffers
+
+
+def no_content_matcher(path1, path2):
+    """Content matcher that considers all files equal."""
+    return True
+
+
+def read_full(f, buf):
+    """Read into a buffer until it's full or EOF is reached.
+
+    Returns the number of bytes read.
+    """
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        n = f.readinto(view[pos:])
+        if not n:
+            break
+        pos += n
+    return pos
+
+
+def get_buffers(size):
+    """Pair of reusable read buffers of the current thread."""
+    bufs = getattr(_local, 'buffers', None)
+    if bufs is None or len(bufs[0]) != size:
+        bufs = _local.buffers = bytearray(size), bytearray(size)
+    return bufs
+
+
+def same_blocks(f1, f2, buf1, buf2):
+    """Read and compare a block from two files at their current positions.
+
+    Returns the number of bytes compared, or None on mismatch.
+    """
+    n1, n2 = read_full(f1, buf1), read_full(f2, buf2)
+    if n1 != n2:
+        return None
+    # comparing whole bytearrays is a memcmp; slicing (copying) is
+    # only needed for the last block (memoryview comparison is per item)
+    if n1 == len(buf1):
+        same = buf1 == buf2
+    else:
+        same = buf1[:n1] == buf2[:n1]
+    return n1 if same else None
 
 
 def compare_file_bytes(path1, path2):
@@ -92,84 +167,143 @@ def compare_file_bytes(path1, path2):
     """
     if os.path.getsize(path1) != os.path.getsize(path2):
         return False
-    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+    buf1, buf2 = get_buffers(IO_BUFLEN)
+    with open(path1, 'rb', buffering=0) as f1, open(path2, 'rb', buffering=0) as f2:
         while True:
-            s1, s2 = f1.read(IO_BUFLEN), f2.read(IO_BUFLEN)
-            if len(s1) != len(s2):
-                # size mismatch
+            n = same_blocks(f1, f2, buf1, buf2)
+            if n is None:
                 return False
-            elif not s1:
+            elif not n:
                 # both files exhausted
                 return True
-            else:
-                if s1 != s2:
-                    return False
 
 
-def compare_dirs(root1, root2, rel, stats, args):
-    """Compare two dirs."""
+def compare_file_samples(path1, path2):
+    """Compare the first, last and some random blocks of two files.
+
+    Returns False as soon as a difference is detected, otherwise True.
+    Note that this is not exhaustive; see compare_file_sampled_bytes().
+    """
+    size = os.path.getsize(path1)
+    if size != os.path.getsize(path2):
+        return False
+    buf1, buf2 = get_buffers(SAMPLE_BUFLEN)
+    last = max(0, size - SAMPLE_BUFLEN)
+    rnd = random.Random(size)  # deterministic per size
+    offsets = [0, last] + [rnd.randint(0, last) for _ in range(SAMPLE_BLOCKS)]
+    with open(path1, 'rb', buffering=0) as f1, open(path2, 'rb', buffering=0) as f2:
+        for offset in offsets:
+            f1.seek(offset)
+            f2.seek(offset)
+            if same_blocks(f1, f2, buf1, buf2) is None:
+                return False
+    return True
+
+
+def compare_file_sampled_bytes(path1, path2):
+    """Compare sample blocks of two files and then all of their bytes.
+
+    The samples detect most differences of large files early, without
+    reading them fully.
+    """
+    return (compare_file_samples(path1, path2) and
+            compare_file_bytes(path1, path2))
+
+
+def compare_files(entry1, entry2, relpath, args):
+    """Compare two file entries.
+
+    Returns a list of output items; see compare_dirs().
+    """
+    if ((args.quick and quick_match(entry1, entry2)) or
+            args.content_matcher(entry1.path, entry2.path)):
+        if args.verbose:
+            return [('==', relpath, 'matched_files')]
+        else:
+            return [(None, None, 'matched_files')]
+    else:
+        return [('**', relpath, 'mismatched_files')]
+
+
+def quick_match(entry1, entry2):
+    """Check whether two file entries have the same size and mtime."""
+    st1, st2 = entry1.stat(), entry2.stat()
+    return (st1.st_size == st2.st_size and
+            abs(st1.st_mtime - st2.st_mtime) <= MTIME_TOLERANCE)
 
-    merged_names = merged(
-        os.listdir(os.path.join(root1, rel)),
-        os.listdir(os.path.join(root2, rel)),
-        args.case_sens)
 
-    for name, where in merged_names:
+def compare_dirs(root1, root2, rel, args, submit):
+    """Compare two dirs.
+
+    Returns a list of output items. These are either (prefix, relpath,
+    stats key) tuples, or future-like objects returned by
+    submit(func, *args) (e.g. a thread pool's submit() or Deferred),
+    whose result() is the item list of a subdirectory.
+    """
+    entries1 = scan_dir(os.path.join(root1, rel))
+    entries2 = scan_dir(os.path.join(root2, rel))
+    if args.case_sens:
+        lookup2 = entries2
+        key = lambda s: s
+    else:
+        lookup2 = dict((name.lower(), entry) for name, entry in entries2.items())
+        key = lambda s: s.lower()
+
+    items = []
+    for name, where in merged(entries1, entries2, args.case_sens):
+        relpath = os.path.join(rel, name)
         if where == '<':
-            isdir = os.path.isdir(os.path.join(root1, rel, name))
-            if isdir:
-                list_unmatched_dir(root1, os.path.join(rel, name), stats, 'only_in_a', '1 ')
+            if entries1[name].is_dir():
+                items += [submit(list_unmatched_dir, root1, relpath, 'only_in_a', '1 ', submit)]
             else:
-                efutil.conout('1 ', os.path.join(rel, name))
-                stats['only_in_a'] += 1
+                items += [('1 ', relpath, 'only_in_a')]
         elif where == '>':
-            isdir = os.path.isdir(os.path.join(root2, rel, name))
-            if isdir:
-                list_unmatched_dir(root2, os.path.join(rel, name), stats, 'only_in_b', ' 2')
+            if entries2[name].is_dir():
+                items += [submit(list_unmatched_dir, root2, relpath, 'only_in_b', ' 2', submit)]
             else:
-                efutil.conout(' 2', os.path.join(rel, name))
-                stats['only_in_b'] += 1
+                items += [(' 2', relpath, 'only_in_b')]
         else:
-            isdir1 = os.path.isdir(os.path.join(root1, rel, name))
-            isdir2 = os.path.isdir(os.path.join(root2, rel, name))
+            entry1, entry2 = entries1[name], lookup2[key(name)]
+            isdir1 = entry1.is_dir()
+            isdir2 = entry2.is_dir()
             if isdir1 and isdir2:
-                compare_dirs(root1, root2, os.path.join(rel, name), stats, args)
+                items += [submit(compare_dirs, root1, root2, relpath, args, submit)]
             elif not isdir1 and not isdir2:
-                path1 = os.path.join(root1, rel, name)
-                path2 = os.path.join(root2, rel, name)
-                if args.content_matcher(path1, path2):
-                    if args.verbose:
-                        efutil.conout('==', os.path.join(rel, name))
-                    stats['matched_files'] += 1
+                if args.content_matcher is no_content_matcher:
+                    items += compare_files(entry1, entry2, relpath, args)
+                elif entry1.stat().st_size != entry2.stat().st_size:
+                    items += [('**', relpath, 'mismatched_files')]
                 else:
-                    efutil.conout('**', os.path.join(rel, name))
-                    stats['mismatched_files'] += 1
+                    items += [submit(compare_files, entry1, entry2, relpath, args)]
             else:  # file <-> dir
                 if isdir1:
-                    list_unmatched_dir(root1, os.path.join(rel, name), stats, 'only_in_a', '1 ')
-                    efutil.conout(' 2', os.path.join(rel, name))
-                    stats['only_in_b'] += 1
+                    items += [submit(list_unmatched_dir, root1, relpath, 'only_in_a', '1 ', submit)]
+                    items += [(' 2', relpath, 'only_in_b')]
                 else:
-                    efutil.conout('1 ', os.path.join(rel, name))
-                    stats['only_in_a'] += 1
-                    list_unmatched_dir(root2, os.path.join(rel, name), stats, 'only_in_b', ' 2')
+                    items += [('1 ', relpath, 'only_in_a')]
+                    items += [submit(list_unmatched_dir, root2, relpath, 'only_in_b', ' 2', submit)]
+    return items
 
 
-def list_unmatched_dir(root, rel, stats, stats_key, prefix):
-    """Recursively print all files under an unmatched directory."""
+def list_unmatched_dir(root, rel, stats_key, prefix, submit):
+    """List all files under an unmatched directory.
+
+    Returns a list of output items; see compare_dirs().
+    """
     dpath = os.path.join(root, rel)
     try:
-        items = os.listdir(dpath)
+        entries = scan_dir(dpath)
     except OSError as x:
         efutil.conerr('ERROR: could not list dir "%s";' % dpath, str(x))
-        return
-    for name in items:
-        isdir = os.path.isdir(os.path.join(root, rel, name))
-        if isdir:
-            list_unmatched_dir(root, os.path.join(rel, name), stats, stats_key, prefix)
+        return []
+    items = []
+    for name, entry in entries.items():
+        relpath = os.path.join(rel, name)
+        if entry.is_dir():
+            items += [submit(list_unmatched_dir, root, relpath, stats_key, prefix, submit)]
         else:
-            efutil.conout(prefix, os.path.join(rel, name))
-            stats[stats_key] += 1
+            items += [(prefix, relpath, stats_key)]
+    return items
 
 
 def parse_args():
@@ -182,8 +316,17 @@ def parse_args():
     add('relpath', metavar='REL', nargs='?', help='common relative path')
     add('--case-sens', choices='mip', default='p',
         help='name case comparisons; m: match, i: ignore, p: platform specific (default)')
-    add('-c', dest='content_matcher', choices='nhb', default='n',
-        help='file contents comparison; n: none (default), h: MD5 hash, b: bytes')
+    add('-c', dest='content_matcher', choices='nhbs', default='n',
+        help='file contents comparison; n: none (default), b: bytes, '
+             's: first, last and a few random blocks, then all bytes; '
+             'h: same as b (hashing was dropped, since it has no benefit '
+             'over comparing bytes)')
+    add('-q', dest='quick', action='store_true',
+        help='quick match; files with the same size and mtime (within %d sec) '
+             'are considered equal without comparing their contents' % MTIME_TOLERANCE)
+    add('-j', dest='jobs', type=int, default=1, metavar='N',
+        help='number of threads for comparing subdirectories and file '
+             'contents concurrently; default: %(default)s')
     #add('-b', dest='buflen', type=int, default=2*20, help='file I/O buffer size')
     add('-v', dest='verbose', action='store_true', help='verbose output; shows matched items')
     args = parser.parse_args()
@@ -197,6 +340,8 @@ def parse_args():
         parser.error('not a directory: "%s"' % args.dir1)
     if not os.path.isdir(args.dir2):
         parser.error('not a directory: "%s"' % args.dir2)
+    if args.jobs < 1:
+        parser.error('number of threads must be positive')
 
     args.dir1 = efutil.promote_input_to_unicode(args.dir1)
     args.dir2 = efutil.promote_input_to_unicode(args.dir2)
@@ -211,9 +356,10 @@ def parse_args():
         args.case_sens = CASE_SENSITIVE_PLATFORM_PATHS
 
     args.content_matcher = {
-        'n': lambda s1, s2: True,
-        'h': compare_file_hashes,
+        'n': no_content_matcher,
+        'h': compare_file_bytes,
         'b': compare_file_bytes,
+        's': compare_file_sampled_bytes,
     } [args.content_matcher]
 
     return args
@@ -231,7 +377,21 @@ if __name__ == '__main__':
     stats = {'only_in_a':0, 'only_in_b':0, 
              'mismatched_files':0, 'matched_files':0}
     try:
-        compare_dirs(dir1, dir2, '', stats, args)
+        if args.jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+                pending = weakref.WeakSet()  # for cancelling on exit
+                def submit(func, *a):
+                    future = pool.submit(func, *a)
+                    pending.add(future)
+                    return future
+                try:
+                    print_items(compare_dirs(dir1, dir2, '', args, submit), stats)
+                except KeyboardInterrupt:
+                    for future in list(pending):
+                        future.cancel()
+                    raise
+        else:
+            print_items(compare_dirs(dir1, dir2, '', args, Deferred), stats)
         print()
         print('Totals:')
         print('  (==)    matched:', stats['matched_files'])
@@ -9,6 +9,7 @@ import time
 import requests
 
 import efutil
+import ratemeter
 
 
 '''
@@ -41,29 +42,32 @@ class Status:
     def __init__(self):
         self.lastdisplen = 0
         self.lastupdate = time.monotonic()
+        self.meter = None
+        self.lastcur = 0
 
     def begin(self, canresume, remotesize, localsize):
 ##        print('size (remote/local): ', remotesize, localsize)
 ##        print('resumable:', canresume)
-        pass
+        self.meter = None
 
     def update(self, start, cur, total, elapsed):
+        if self.meter is None:
+            self.meter = ratemeter.RateMeter(total=total, done=cur)
+        else:
+            self.meter.add(cur - self.lastcur)
+        self.lastcur = cur
         t = time.monotonic()
         if t - self.lastupdate < 1.0:
             return
         self.lastupdate = t
+        stats = self.meter.snapshot()
         if total is not None:
-            ratio = cur / total if total else 0
-            downloaded = cur - start
-            pending = total - cur
-            speed = downloaded / elapsed if elapsed else 0
-            eta = pending / speed if speed else 0
             msg = '{} ({:.0%}) of {} at {}/s; ETA {}'.format(
                 efutil.prettysize(cur),
-                ratio,
+                stats.ratio,
                 efutil.prettysize(total),
-                efutil.prettysize(speed),
-                efutil.timefmt(eta))
+                efutil.prettysize(stats.rate),
+                efutil.timefmt(stats.eta or 0))
         else:
             msg = '{}'.format(
                 efutil.prettysize(cur))
@@ -18,24 +18,25 @@ import mathutil
 from ctypes.wintypes import HANDLE, DWORD, UINT, BOOL
 
 
-GetStdHandle = ctypes.windll.kernel32.GetStdHandle
-GetStdHandle.restype = HANDLE
-GetStdHandle.argtypes = [DWORD]
+if os.name == 'nt':
+    GetStdHandle = ctypes.windll.kernel32.GetStdHandle
+    GetStdHandle.restype = HANDLE
+    GetStdHandle.argtypes = [DWORD]
 
-STD_OUTPUT_HANDLE = DWORD(-11)
-STD_ERROR_HANDLE = DWORD(-12)
+    STD_OUTPUT_HANDLE = DWORD(-11)
+    STD_ERROR_HANDLE = DWORD(-12)
 
-GetConsoleOutputCP = ctypes.windll.kernel32.GetConsoleOutputCP
-GetConsoleOutputCP.restype = UINT
-GetConsoleOutputCP.argtypes = []
+    GetConsoleOutputCP = ctypes.windll.kernel32.GetConsoleOutputCP
+    GetConsoleOutputCP.restype = UINT
+    GetConsoleOutputCP.argtypes = []
 
-WriteConsoleW = ctypes.windll.kernel32.WriteConsoleW
-WriteConsoleW.restype = BOOL
-WriteConsoleW.argtypes = [HANDLE, ctypes.c_void_p, DWORD, ctypes.POINTER(ctypes.c_ulong), ctypes.c_void_p]
+    WriteConsoleW = ctypes.windll.kernel32.WriteConsoleW
+    WriteConsoleW.restype = BOOL
+    WriteConsoleW.argtypes = [HANDLE, ctypes.c_void_p, DWORD, ctypes.POINTER(ctypes.c_ulong), ctypes.c_void_p]
 
-CloseHandle = ctypes.windll.kernel32.CloseHandle
-CloseHandle.restype = BOOL
-CloseHandle.argtypes = [HANDLE]
+    CloseHandle = ctypes.windll.kernel32.CloseHandle
+    CloseHandle.restype = BOOL
+    CloseHandle.argtypes = [HANDLE]
 
 
 def WriteConsole(h, s):
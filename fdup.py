@@ -1,4 +1,29 @@
-"""Locate duplicate files using MD5 hashes."""
+"""Locate duplicate files using content hashes (MD5 by default).
+
+Candidates are narrowed in stages, each one dropping files that turn out
+to be unique, so that only the survivors are passed to the next (more
+expensive) stage:
+    1. file size
+    2. hash of the first and last few KB (skipped for small files)
+    3. hash of the full contents
+
+Signatures can optionally be kept in a persistent cache (see HashCache)
+so that unchanged files are not re-read on subsequent runs.
+
+Hardlinks to the same file are collapsed before hashing, since they are
+not duplicates and their contents need only be read once. When a fast,
+non-cryptographic hash is selected, files with matching hashes are also
+compared byte by byte before being reported as duplicates.
+
+Hashing can run on a thread pool (hashlib releases the GIL), with a
+separate concurrency limit for each device, so that several disks can be
+read at full speed at the same time.
+
+For very large trees, duplicate groups can be streamed to a JSON Lines
+file as soon as each one is final, and the scanned file list can be kept
+in sorted temporary files on disk (see SizeGroupStore), so that memory
+use does not depend on the number of files.
+"""
 
 from __future__ import print_function, division
 import os
@@ -6,17 +31,43 @@ import hashlib
 import sys
 import time
 import collections
+import heapq
+import itertools
+import json
+import tempfile
 import string
 import argparse
+import sqlite3
+import threading
+import concurrent.futures
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 import efutil
 import console_stuff
+import ratemeter
 import winfixargv
 
 
 HASH_BUFLEN = 2**20
+SAMPLE_LEN = 2**16  # bytes hashed at each end of a file in the sample stage
+SAMPLE_MIN_SIZE = 8 * SAMPLE_LEN  # smaller files skip the sample stage
 STATUS_UPDATE_SEC = 1
 
+# name -> (hash object factory, whether equal hashes must be verified)
+HASH_TYPES = {
+    'md5': (hashlib.md5, False),
+    'sha1': (hashlib.sha1, False),
+    'blake2b': (lambda: hashlib.blake2b(digest_size=16), False),
+    'blake2b-64': (lambda: hashlib.blake2b(digest_size=8), True),
+}
+if xxhash:
+    HASH_TYPES['xxh64'] = (xxhash.xxh64, True)
+    HASH_TYPES['xxh128'] = (xxhash.xxh3_128, True)
+
 
 iteritems = (lambda d: d.iteritems()) if efutil.PY2 else (lambda d: d.items())
 
@@ -27,17 +78,19 @@ class Status:
         self.interval = interval
         self.counter = counter
         self.cursor = console_stuff.SamePosOutput(fallback=True)
+        self.lock = threading.Lock()
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_value, traceback):
         self.prnt()
         print()
     def add(self, *data):
-        self.counter.add(*data)
-        t = time.time()
-        if t - self.lastPrintTime >= self.interval:
-            self.prnt()
-            self.lastPrintTime = t
+        with self.lock:
+            self.counter.add(*data)
+            t = time.time()
+            if t - self.lastPrintTime >= self.interval:
+                self.prnt()
+                self.lastPrintTime = t
     def prnt(self):
         self.cursor.restore(True)
         print(str(self.counter), end='')
@@ -53,16 +106,20 @@ class ItemCounter:
         return str(self.value)
 
 
+class NullStatus:
+    def add(self, *data):
+        pass
+
+
 class SizeCounter:
     def __init__(self, total):
-        self.current = 0
-        self.total = total
+        self.meter = ratemeter.RateMeter(total=total)
     def add(self, n):
-        self.current += n
+        self.meter.add(n)
     def __str__(self):
-        percent = 100 * self.current / self.total if self.total else 100
+        stats = self.meter.snapshot()
 ##        return str(round(percent)) + '%'
-        return str(int(round(percent))) + '%'
+        return '%d%% %s/s' % (int(round(100 * stats.ratio)), sizeStr(int(stats.rate)))
 
 
 def fileList(dirname, recurse):
@@ -78,30 +135,439 @@ def fileList(dirname, recurse):
                 yield s
 
 
-def getSizeGroups(dirs, status, args):
-    """Group all files in specified dirs by size."""
-    ret = collections.defaultdict(list)
+def getSizeGroups(dirs, status, args, store=None):
+    """Group all files in specified dirs by size.
+
+    Only the first path of each set of hardlinks is included.
+    Returns the groups and the number of hardlinks skipped.
+    Groups are stored in a dict of sizes to lists of paths, unless
+    a store (e.g. SizeGroupStore) is specified, in which case files are
+    added using store.add(path, size) and the store is returned instead.
+    """
+    ret = collections.defaultdict(list) if store is None else store
+    add = store.add if store is not None else (
+        lambda fpath, fsize: ret[fsize].append(fpath))
+    seen = set()  # (dev, ino) of files with multiple links
+    links = 0
     for dir in dirs:
         for fpath in fileList(dir, args.recurse):
-            fsize = os.path.getsize(fpath)
+            st = os.stat(fpath)
+            if st.st_nlink > 1 and st.st_ino:
+                fid = st.st_dev, st.st_ino
+                if fid in seen:
+                    links += 1
+                    continue
+                seen.add(fid)
+            fsize = st.st_size
             if fsize != 0 or args.includezero:
-                ret[fsize].append(fpath)
+                add(fpath, fsize)
                 status.add(1)
-    return ret
+    return ret, links
+
 
+class SizeGroupStore:
+    """Files grouped by size, using a bounded amount of memory.
 
-def hashFile(fpath, status):
-    """Calculate MD5 of file; return hash object."""
-    f = open(fpath, 'rb')
-    md5 = hashlib.md5()
-    while True:
-        s = f.read(HASH_BUFLEN)
-        if not s:
-            break
-        md5.update(s)
+    Directory paths are interned and each file is kept as a (size, dir
+    index, name) record. Whenever maxitems records are buffered, they are
+    sorted and spilled to a temporary file, and groups() merges all these
+    runs back in size order.
+    """
+
+    def __init__(self, maxitems):
+        self.maxitems = maxitems
+        self.dirs = []
+        self.dirIndex = {}
+        self.buffer = []
+        self.runs = []
+        self.totalBytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for f in self.runs:
+            f.close()
+        self.runs = []
+
+    def add(self, fpath, size):
+        dir, name = os.path.split(fpath)
+        i = self.dirIndex.get(dir)
+        if i is None:
+            i = self.dirIndex[dir] = len(self.dirs)
+            self.dirs.append(dir)
+        self.buffer.append((size, i, name))
+        self.totalBytes += size
+        if len(self.buffer) >= self.maxitems:
+            self.spill()
+
+    def spill(self):
+        """Write buffered records to a new sorted run."""
+        self.buffer.sort()
+        f = tempfile.TemporaryFile('w+', encoding='utf-8', prefix='fdup-')
+        for rec in self.buffer:
+            f.write(json.dumps(rec) + '\n')
+        self.runs.append(f)
+        self.buffer = []
+
+    @staticmethod
+    def readRun(f):
+        f.seek(0)
+        for line in f:
+            yield tuple(json.loads(line))
+
+    def groups(self):
+        """Generate (size, paths) tuples in increasing size order."""
+        self.buffer.sort()
+        runs = [self.readRun(f) for f in self.runs] + [iter(self.buffer)]
+        merged = heapq.merge(*runs)
+        for size, recs in itertools.groupby(merged, key=lambda rec: rec[0]):
+            yield size, [os.path.join(self.dirs[i], name) for _, i, name in recs]
+
+
+def hashFile(fpath, status, hashtype=hashlib.md5):
+    """Calculate hash (def=MD5) of file; return hash object."""
+    h = hashtype()
+    with open(fpath, 'rb') as f:
+        while True:
+            s = f.read(HASH_BUFLEN)
+            if not s:
+                break
+            h.update(s)
+            status.add(len(s))
+    return h
+
+
+def sampleFile(fpath, size, status, hashtype=hashlib.md5):
+    """Calculate hash (def=MD5) of the first and last SAMPLE_LEN bytes;
+    return hash object."""
+    h = hashtype()
+    with open(fpath, 'rb') as f:
+        s = f.read(SAMPLE_LEN)
+        h.update(s)
+        status.add(len(s))
+        f.seek(max(SAMPLE_LEN, size - SAMPLE_LEN))
+        s = f.read(SAMPLE_LEN)
+        h.update(s)
         status.add(len(s))
-    return md5
-    
+    return h
+
+
+def sameContents(path1, path2, status):
+    """Compare the contents of two files of the same size."""
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            s1 = f1.read(HASH_BUFLEN)
+            s2 = f2.read(HASH_BUFLEN)
+            status.add(len(s2))
+            if s1 != s2:
+                return False
+            if not s1:
+                return True
+
+
+def verifyGroups(groups, status):
+    """Split groups of files with equal hashes by comparing their contents.
+
+    Protects against collisions of weak hashes. Each group is compared
+    against a representative file of every distinct content found so far;
+    new groups get an extra key item (the index of the distinct content).
+
+    Returns the new groups and the total size of the dropped files.
+    """
+    ret = collections.defaultdict(list)
+    for key, files in iteritems(groups):
+        subgroups = []  # lists of files with identical contents
+        for s in files:
+            for sub in subgroups:
+                if sameContents(sub[0], s, status):
+                    sub.append(s)
+                    break
+            else:
+                subgroups.append([s])
+        for i, sub in enumerate(subgroups):
+            ret[key + (i,)] = sub
+    dropped = 0
+    for key in [k for k, files in iteritems(ret) if len(files) < 2]:
+        dropped += key[0]
+        del ret[key]
+    return ret, dropped
+
+
+def sampleCost(size):
+    """Number of bytes read by the sample stage for a file."""
+    return 2 * SAMPLE_LEN if size >= SAMPLE_MIN_SIZE else 0
+
+
+def fullCost(size):
+    """Number of bytes read by the full hash stage for a file."""
+    return size
+
+
+def sampleSig(hashtype):
+    """Sample stage key function for the specified hash type.
+
+    Keys are None for files too small to be worth sampling.
+    """
+    def keyfunc(fpath, size, status):
+        if not sampleCost(size):
+            return None
+        return sampleFile(fpath, size, status, hashtype).hexdigest()
+    return keyfunc
+
+
+def fullSig(hashtype):
+    """Full contents stage key function for the specified hash type."""
+    def keyfunc(fpath, size, status):
+        return hashFile(fpath, status, hashtype).hexdigest()
+    return keyfunc
+
+
+def sampleBytes(groups):
+    """Number of bytes read by the sample stage."""
+    return sum(sampleCost(key[0]) * len(files) for (key,files)
+               in iteritems(groups))
+
+
+def groupBytes(groups):
+    """Total size of all files in groups."""
+    return sum(key[0] * len(files) for (key,files) in iteritems(groups))
+
+
+def calcKeys(groups, keyfunc, status, jobs=1, perdev=1):
+    """Calculate keyfunc(path, size, status) for all files in groups.
+
+    If jobs > 1, files are processed on a thread pool of that size, with
+    at most perdev files of the same device being processed at a time.
+
+    Returns a dict of paths to keys.
+    """
+    ret = {}
+    if jobs <= 1:
+        for key, files in iteritems(groups):
+            for s in files:
+                ret[s] = keyfunc(s, key[0], status)
+        return ret
+
+    pending = collections.defaultdict(collections.deque)  # dev -> (path, size)
+    for key, files in iteritems(groups):
+        for s in files:
+            pending[os.stat(s).st_dev].append((s, key[0]))
+    running = {}  # future -> (dev, path)
+    active = collections.Counter()  # dev -> running count
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        while pending or running:
+            for dev in list(pending):
+                queue = pending[dev]
+                while queue and active[dev] < perdev and len(running) < jobs:
+                    fpath, size = queue.popleft()
+                    future = pool.submit(keyfunc, fpath, size, status)
+                    running[future] = dev, fpath
+                    active[dev] += 1
+                if not queue:
+                    del pending[dev]
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dev, fpath = running.pop(future)
+                active[dev] -= 1
+                ret[fpath] = future.result()
+    return ret
+
+
+def refineGroups(groups, keyfunc, status, jobs=1, perdev=1):
+    """Split groups of candidate files using an additional key.
+
+    Groups are dicts of key tuples (starting with the file size) to lists
+    of paths. Each file's key is extended with keyfunc(path, size, status)
+    and groups left with a single file are dropped. See calcKeys() for
+    jobs and perdev.
+
+    Returns the new groups and the total size of the dropped files.
+    """
+    keys = calcKeys(groups, keyfunc, status, jobs, perdev)
+    ret = collections.defaultdict(list)
+    for key, files in iteritems(groups):
+        for s in files:
+            ret[key + (keys[s],)].append(s)
+    dropped = 0
+    for key in [k for k, files in iteritems(ret) if len(files) < 2]:
+        dropped += key[0]
+        del ret[key]
+    return ret, dropped
+
+
+def streamGroups(sizeGroups, status, args, sampleKey, fullKey):
+    """Generate final duplicate groups as (key, files) tuples.
+
+    Unlike running each stage over all files, size groups are processed
+    in batches of about args.batch files, so that results become available
+    early and only one batch is kept in memory. Status is updated with the
+    total size of each batch once it is processed.
+    """
+    def process(batch):
+        ret, _ = refineGroups(batch, sampleKey, NullStatus(), args.jobs, args.perdev)
+        ret, _ = refineGroups(ret, fullKey, NullStatus(), args.jobs, args.perdev)
+        if args.verify:
+            ret, _ = verifyGroups(ret, NullStatus())
+        status.add(groupBytes(batch))
+        return iteritems(ret)
+
+    batch, count = {}, 0
+    for size, files in sizeGroups:
+        if len(files) < 2:
+            continue
+        batch[(size,)] = files
+        count += len(files)
+        if count >= args.batch:
+            for item in process(batch):
+                yield item
+            batch, count = {}, 0
+    if batch:
+        for item in process(batch):
+            yield item
+
+
+class DupStats:
+    """Running totals of duplicate groups."""
+
+    def __init__(self):
+        self.files = 0
+        self.groups = 0
+        self.bytes = 0
+        self.uniqBytes = 0
+        self.dirs = collections.defaultdict(int)  # dir -> count of dup files
+
+    def add(self, size, files):
+        self.files += len(files)
+        self.groups += 1
+        self.bytes += size * len(files)
+        self.uniqBytes += size
+        for s in files:
+            self.dirs[os.path.split(s)[0]] += 1
+
+    def prnt(self):
+        print()
+        print('dir counts:')
+        for dir, times in sorted(self.dirs.items(), key=lambda t: t[1], reverse=True):
+            print('  %6d: %s' % (times, dir))
+
+        print()
+        print('dup files/groups: %d, %d' % (self.files, self.groups))
+        print('total/unique/extra size of dups: %s, %s, %s' % (
+            sizeStr(self.bytes), sizeStr(self.uniqBytes),
+            sizeStr(self.bytes - self.uniqBytes)))
+
+
+def sigLabel(key, verify):
+    """Displayed signature of a final group key."""
+    if verify and key[3]:
+        return '%s (%d)' % (key[2], key[3])  # distinct contents, same hash
+    return key[2]
+
+
+def deleteDups(files):
+    """Delete all files except for the first one; return count deleted."""
+    n = 0
+    for s in files[1:]:
+        try:
+            os.unlink(s)
+            n += 1
+        except OSError:
+            efutil.uprint('could not delete "%s"' % s)
+    return n
+
+
+class HashCache:
+    """Persistent store of file signatures, backed by an SQLite database.
+
+    Entries are keyed by file identity (device and inode) and signature
+    kind, and are only valid as long as the file's size and mtime match.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()  # for use by hashing threads
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS sigs ('
+            'dev INTEGER, ino INTEGER, kind TEXT, size INTEGER, mtime INTEGER, '
+            'path TEXT, sig TEXT, PRIMARY KEY (dev, ino, kind))')
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def get(self, st, kind):
+        """Cached signature of a file (given its stat result) or None."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT sig FROM sigs WHERE dev=? AND ino=? AND kind=? '
+                'AND size=? AND mtime=?',
+                (st.st_dev, st.st_ino, kind, st.st_size, st.st_mtime_ns)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, fpath, st, kind, sig):
+        """Store the signature of a file (given its stat result)."""
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sigs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (st.st_dev, st.st_ino, kind, st.st_size, st.st_mtime_ns,
+                 os.path.abspath(fpath), sig))
+
+    def compact(self):
+        """Evict entries of deleted or modified files; return count removed."""
+        stale = []
+        for row in self.db.execute(
+                'SELECT dev, ino, size, mtime, path FROM sigs'):
+            dev, ino, size, mtime, path = row
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append((dev, ino))
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != (dev, ino, size, mtime):
+                stale.append((dev, ino))
+        self.db.executemany('DELETE FROM sigs WHERE dev=? AND ino=?', stale)
+        self.db.commit()
+        self.db.execute('VACUUM')
+        return len(stale)
+
+
+def cachedSig(cache, kind, keyfunc, cost):
+    """Wrap a stage key function to look up and store signatures in a cache.
+
+    The cost function returns the number of bytes keyfunc reads for a given
+    file size; these are reported to status on cache hits so that progress
+    stays accurate, and files with zero cost bypass the cache.
+    """
+    def wrapper(fpath, size, status):
+        if not cost(size):
+            return keyfunc(fpath, size, status)
+        st = os.stat(fpath)
+        sig = cache.get(st, kind)
+        if sig is None:
+            sig = keyfunc(fpath, size, status)
+            cache.put(fpath, st, kind, sig)
+        else:
+            status.add(cost(size))
+        return sig
+    return wrapper
+
 
 def sizeStr(n):
     """Convert byte count to str with unit and 2 decimals max."""
@@ -127,8 +593,6 @@ def hash_set_param(s):
     st = set(t.lower() for t in s.split(','))
     valid_digits = set(string.hexdigits)
     for x in st:
-        if len(x) != 32:
-            raise argparse.ArgumentTypeError('bad hash size: "%s"' % x)
         if not set(x) <= valid_digits:
             raise argparse.ArgumentTypeError('bad hash: "%s"' % x)
     return st
@@ -136,7 +600,7 @@ def hash_set_param(s):
 
 def parse_args():
     ap = argparse.ArgumentParser(
-        description='locate duplicate files using MD5 hashes')
+        description='locate duplicate files using content hashes')
     add = ap.add_argument
 
     add('dirs', nargs='*', metavar='DIR', default=[u'.'],
@@ -147,10 +611,47 @@ def parse_args():
         help='include empty files (ignored by default)')
     add('-i', dest='ignoresigs', type=hash_set_param, metavar='HASHES', default=[],
         help='ignore files with specified, comma-delimitied hashes')
+    add('-a', dest='hashname', choices=sorted(HASH_TYPES), default='md5',
+        help='hash algorithm; default is md5; weak hashes (blake2b-64 and '
+        'xxhash types, if the module is installed) are verified by '
+        'comparing file contents')
     add('--delete', action='store_true',
         help='delete duplicates in each set except for one (randomly selected)')
+    add('--cache', metavar='FILE',
+        help='persistent hash cache database; created if missing')
+    add('--compact-cache', action='store_true',
+        help='remove entries of deleted or modified files from the cache '
+        'specified by --cache and exit')
+    add('-j', '--jobs', type=int, default=1, metavar='N',
+        help='number of hashing threads; default is 1 (no threading)')
+    add('--per-device', dest='perdev', type=int, default=1, metavar='N',
+        help='max number of files hashed at the same time on each device '
+        '(volume); default is 1, which suits spinning disks')
+    add('--jsonl', metavar='FILE',
+        help='write duplicate groups to a JSON Lines file as soon as each one '
+        'is final, instead of listing them at the end')
+    add('--spill', type=int, metavar='N',
+        help='keep at most N scanned files in memory, spilling the rest '
+        'to temporary files; requires --jsonl')
+    add('--batch', type=int, default=10000, metavar='N',
+        help='approximate number of files hashed per batch when using '
+        '--jsonl; default is %(default)s')
 
     args = ap.parse_args()
+    if args.compact_cache and not args.cache:
+        ap.error('--compact-cache requires --cache')
+    if args.jobs < 1 or args.perdev < 1:
+        ap.error('thread counts must be positive')
+    if args.spill is not None and not args.jsonl:
+        ap.error('--spill requires --jsonl')
+    if (args.spill is not None and args.spill < 1) or args.batch < 1:
+        ap.error('item counts must be positive')
+
+    args.hashtype, args.verify = HASH_TYPES[args.hashname]
+    sigLen = args.hashtype().digest_size * 2
+    for x in args.ignoresigs:
+        if len(x) != sigLen:
+            ap.error('bad %s hash size: "%s"' % (args.hashname, x))
 
     return args
 
@@ -158,30 +659,109 @@ def parse_args():
 if __name__ == '__main__':
     args = parse_args()
 
+    cache = HashCache(args.cache) if args.cache else None
+    if args.compact_cache:
+        with cache:
+            print('cache entries removed:', cache.compact())
+        sys.exit()
+
+    sampleKey, fullKey = sampleSig(args.hashtype), fullSig(args.hashtype)
+    if cache:
+        sampleKey = cachedSig(cache, '%s-sample-%d' % (args.hashname, SAMPLE_LEN),
+                              sampleKey, sampleCost)
+        fullKey = cachedSig(cache, args.hashname, fullKey, fullCost)
+
+    if args.jsonl:
+        store = SizeGroupStore(args.spill) if args.spill else None
+        print('scanning:', end=' ')
+        with Status(STATUS_UPDATE_SEC, ItemCounter()) as status:
+            sizeGroups, hardlinks = getSizeGroups(args.dirs, status, args, store)
+        print('hardlinks skipped: %d' % hardlinks)
+        if store:
+            totalBytes = store.totalBytes
+            sizeGroups = store.groups
+        else:
+            totalBytes = sum(size*len(files) for (size,files)
+                             in iteritems(sizeGroups))
+            sizeGroups = lambda d=sizeGroups: iteritems(d)
+        bytesToHash = sum(size*len(files) for (size,files)
+                          in sizeGroups() if len(files) > 1)
+        print('total/hash size: %s, %s' % (sizeStr(totalBytes), sizeStr(bytesToHash)))
+
+        stats = DupStats()
+        ignored, deleted = 0, 0
+        print('hashing:', end=' ')
+        with open(args.jsonl, 'w', encoding='utf-8') as out, \
+                Status(STATUS_UPDATE_SEC, SizeCounter(bytesToHash)) as status:
+            for key, files in streamGroups(sizeGroups(), status, args, sampleKey, fullKey):
+                if key[2] in args.ignoresigs:
+                    ignored += len(files)
+                    continue
+                out.write(json.dumps({
+                    'size': key[0], 'hash': sigLabel(key, args.verify), 'files': files}))
+                out.write('\n')
+                out.flush()
+                stats.add(key[0], files)
+                if args.delete:
+                    deleted += deleteDups(files)
+        if store:
+            store.close()
+        if cache:
+            cache.close()
+
+        stats.prnt()
+        print('ignored files:', ignored)
+        if cache:
+            print('hash cache hits/misses: %d, %d' % (cache.hits, cache.misses))
+        if args.delete:
+            print('files deleted:', deleted)
+        sys.exit()
+
     print('scanning:', end=' ')
     with Status(STATUS_UPDATE_SEC, ItemCounter()) as status:
-        sizeGroups = getSizeGroups(args.dirs, status, args)
+        sizeGroups, hardlinks = getSizeGroups(args.dirs, status, args)
+    print('hardlinks skipped: %d' % hardlinks)
 
     totalBytes = sum(size*len(files) for (size,files)
                      in iteritems(sizeGroups))
-    bytesToHash = sum(size*len(files) for (size,files)
+    candidates = dict(((size,), files) for (size, files)
                       in iteritems(sizeGroups) if len(files) > 1)
+    bytesToHash = groupBytes(candidates)
     print('total/hash size: %s, %s' % (sizeStr(totalBytes), sizeStr(bytesToHash)))
+    print('size stage avoided: %s' % sizeStr(totalBytes - bytesToHash))
+
+    print('sampling:', end=' ')
+    with Status(STATUS_UPDATE_SEC, SizeCounter(sampleBytes(candidates))) as status:
+        candidates, dropped = refineGroups(
+            candidates, sampleKey, status, args.jobs, args.perdev)
+    print('sample stage avoided: %s' % sizeStr(dropped))
 
     print('hashing:', end=' ')
+    with Status(STATUS_UPDATE_SEC, SizeCounter(groupBytes(candidates))) as status:
+        candidates, dropped = refineGroups(
+            candidates, fullKey, status, args.jobs, args.perdev)
+    print('full hash stage unique: %s' % sizeStr(dropped))
+
+    if args.verify:
+        print('verifying:', end=' ')
+        verifyBytes = sum(key[0] * (len(files) - 1) for (key,files)
+                          in iteritems(candidates))
+        with Status(STATUS_UPDATE_SEC, SizeCounter(verifyBytes)) as status:
+            candidates, dropped = verifyGroups(candidates, status)
+        print('hash collisions: %s' % sizeStr(dropped))
+    if cache:
+        cache.close()
+
     sigNames = collections.defaultdict(list)
     sigSizes = collections.defaultdict(int)
     ignored = 0
-    with Status(STATUS_UPDATE_SEC, SizeCounter(bytesToHash)) as status:
-        for size, files in iteritems(sizeGroups):
-            if len(files) > 1:
-                for s in files:
-                    sig = hashFile(s, status).hexdigest()
-                    if sig in args.ignoresigs:
-                        ignored += 1
-                    else:
-                        sigNames[sig] += [s]
-                        sigSizes[sig] = size
+    for key, files in iteritems(candidates):
+        if key[2] in args.ignoresigs:
+            ignored += len(files)
+        else:
+            sig = sigLabel(key, args.verify)
+            sigNames[sig] += files
+            sigSizes[sig] = key[0]
 
     print()
     print('duplicates:')
@@ -191,52 +771,27 @@ if __name__ == '__main__':
             for s in files:
                 efutil.uprint('  ' + s)
 
-    # calc and print dirs and their count of dup files
-    dirs = collections.defaultdict(int)
-    for sig, files in iteritems(sigNames):
-        if len(files) > 1:
-            for s in files:
-                dirs[os.path.split(s)[0]] += 1
-
-    print()
-    print('dir counts:')
-    for dir, times in sorted(dirs.items(), key=lambda t: t[1], reverse=True):
-        print('  %6d: %s' % (times, dir))
-
-    dupFiles, dupGroups = 0, 0
-    dupBytes, uniqBytes = 0, 0
+    stats = DupStats()
     for sig, files in iteritems(sigNames):
         if len(files) > 1:
-            count, size = len(files), sigSizes[sig]
-            dupFiles += count
-            dupGroups += 1
-            dupBytes += size * count
-            uniqBytes += size
-            
-    #dups = [len(a) for a in sigNames.itervalues() if len(a) > 1]
-    print()
-    print('dup files/groups: %d, %d' % (dupFiles, dupGroups))
-    print('total/unique/extra size of dups: %s, %s, %s' % (
-        sizeStr(dupBytes), sizeStr(uniqBytes), sizeStr(dupBytes - uniqBytes)))
+            stats.add(sigSizes[sig], files)
+    stats.prnt()
     print('ignored files:', ignored)
+    if cache:
+        print('hash cache hits/misses: %d, %d' % (cache.hits, cache.misses))
 
     if args.delete:
         print()
         print('deleting duplicates...')
         n = 0
         for sig, files in iteritems(sigNames):
-            for s in files[1:]:  # keep the first one
-                try:
-                    os.unlink(s)
-                    n += 1
-                except OSError:
-                    efutil.uprint('could not delete "%s"' % s)
-        print('files deleted:', n)
+            n += deleteDups(files)  # keep the first one
+        print('files deleted:', n)
 
 
 '''
 ---------|---------|---------|---------|---------|---------|---------|---------|
 hashing: 999,999 files 99% 999,999/s; 999 bytes 99% 999 bytes/s; ETA 99h:99m:99s
 99.9 XB
-999 bytes
+999 bytes
 '''
\ No newline at end of file
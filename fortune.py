@@ -4,8 +4,13 @@ See <http://en.wikipedia.org/wiki/Fortune_(Unix)>.
 """
 from __future__ import print_function, division
 import argparse
+import array
+import bisect
 import codecs
+import concurrent.futures
+import mmap
 import os
+import pickle
 import random
 import re
 import struct
@@ -15,6 +20,27 @@ import time
 
 PY2 = sys.version_info.major == 2
 
+# array typecode for unsigned/signed 32-bit items
+UINT32 = 'L' if array.array('L').itemsize == 4 else 'I'
+INT32 = 'l' if array.array('l').itemsize == 4 else 'i'
+
+
+def loadarray(typecode, buf, offset, count):
+    """Decode a big-endian array of 32-bit items from a buffer."""
+    ret = array.array(typecode)
+    ret.frombytes(buf[offset:offset + 4 * count])
+    if sys.byteorder == 'little':
+        ret.byteswap()
+    return ret
+
+
+def savearray(f, a):
+    """Write an array to a file as big-endian."""
+    if sys.byteorder == 'little':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    a.tofile(f)
+
 
 def getfiles(all=False, offensive=False):
     """Get list of potential fortune files.
@@ -41,7 +67,11 @@ def getfiles(all=False, offensive=False):
 
 
 class Index(object):
-    """Fortune index file."""
+    """Fortune index file.
+
+    The offset table is memory-mapped and decoded in a single pass,
+    so accessing items does no further I/O.
+    """
     VERSION = 1
     STR_RANDOM = 0x1
     STR_ORDERED = 0x2
@@ -50,13 +80,42 @@ class Index(object):
     HEADER_LEN = struct.calcsize(HEADER)
 
     def __init__(self, fpath):
-        self.f = open(fpath, 'rb')
-        hdr = self.f.read(self.HEADER_LEN)
-        (self.version, self.count, self.maxlen, self.minlen,
-         self.flags, self.delim, padding) = struct.unpack(self.HEADER, hdr)
+        self.path = fpath
+        with open(fpath, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (self.version, self.count, self.maxlen, self.minlen,
+             self.flags, self.delim, padding) = struct.unpack_from(self.HEADER, buf)
+            assert self.version == self.VERSION
+            # string starts, plus an extra entry for the end of the last string
+            self.offsets = loadarray(UINT32, buf, self.HEADER_LEN, self.count + 1)
+        finally:
+            buf.close()
+        self.starts = memoryview(self.offsets)[:-1]
+        if self.flags & (self.STR_RANDOM | self.STR_ORDERED):
+            self.ends = self._reorderedends(self.offsets)
+        else:
+            # string ends are the next one's start
+            self.ends = memoryview(self.offsets)[1:]
         if not PY2:
             self.delim = str(self.delim, 'ascii')
-        assert self.version == self.VERSION
+        self._bysize = None
+
+    @staticmethod
+    def _reorderedends(offsets):
+        """Get the string ends of a shuffled or sorted table.
+
+        As in Unix strfile, only the starts are reordered; each string
+        extends up to its delimiter line, i.e. to the start of the string
+        that follows it in the file, which is the next larger offset.
+        """
+        count = len(offsets) - 1
+        order = sorted(range(count + 1), key=offsets.__getitem__)
+        ends = array.array(UINT32, [0]) * count
+        for i, j in zip(order, order[1:]):
+            if i < count:
+                ends[i] = offsets[j]
+        return memoryview(ends)
 
     def __len__(self):
         """Number of strings."""
@@ -68,26 +127,77 @@ class Index(object):
             i = self.count + i
         if i < 0 or i >= self.count:
             raise IndexError
-        self.f.seek(self.HEADER_LEN + 4 * i)
-        return struct.unpack('>LL', self.f.read(8))
-
-    class _Iter(object):
-        def __init__(self, ndx):
-            self.ndx = ndx
-            self.cur = 0
-        def __iter__(self):
-            return self
-        def __next__(self):
-            try:
-                self.cur += 1
-                return self.ndx[self.cur - 1]
-            except IndexError:
-                self.cur -= 1
-                raise StopIteration
-        next = __next__
+        return self.starts[i], self.ends[i]
 
     def __iter__(self):
-        return self._Iter(self)
+        return zip(self.starts, self.ends)
+
+    def bysize(self):
+        """Get the string indices and sizes, sorted by size.
+
+        The result is cached in a file next to the index (see sizesname())
+        and rebuilt when the index is newer.
+        """
+        if self._bysize is None:
+            cachepath = sizesname(self.path)
+            self._bysize = self._loadsizes(cachepath)
+            if self._bysize is None:
+                self._bysize = self._calcsizes()
+                self._savesizes(cachepath, *self._bysize)
+        return self._bysize
+
+    SIZES_HEADER = '>4sL'
+    SIZES_MAGIC = b'FSIZ'
+
+    def _calcsizes(self):
+        # size excludes the delimiter line
+        sizes = [end - beg - 2 for beg, end in zip(self.starts, self.ends)]
+        order = sorted(range(self.count), key=sizes.__getitem__)
+        return (array.array(UINT32, order),
+                array.array(INT32, (sizes[i] for i in order)))
+
+    def _loadsizes(self, path):
+        try:
+            if os.path.getmtime(path) < os.path.getmtime(self.path):
+                return None
+            with open(path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, IOError, ValueError):
+            return None
+        try:
+            hdrlen = struct.calcsize(self.SIZES_HEADER)
+            if len(buf) != hdrlen + 8 * self.count:
+                return None
+            magic, count = struct.unpack_from(self.SIZES_HEADER, buf)
+            if magic != self.SIZES_MAGIC or count != self.count:
+                return None
+            return (loadarray(UINT32, buf, hdrlen, count),
+                    loadarray(INT32, buf, hdrlen + 4 * count, count))
+        finally:
+            buf.close()
+
+    def _savesizes(self, path, order, sizes):
+        # failure is not an error; the cache will be rebuilt next time
+        tmppath = path + '.tmp'
+        try:
+            with open(tmppath, 'wb') as f:
+                f.write(struct.pack(self.SIZES_HEADER, self.SIZES_MAGIC, self.count))
+                savearray(f, order)
+                savearray(f, sizes)
+            os.replace(tmppath, path)
+        except (OSError, IOError):
+            pass
+
+    def select(self, sizefilter):
+        """Get the indices of strings that satisfy a SizeFilter.
+
+        Returns a read-only sequence of indices in ascending size order.
+        After the first call (per index file), this is O(log n).
+        """
+        order, sizes = self.bysize()
+        lo = 0 if sizefilter.minsize is None else bisect.bisect_left(sizes, sizefilter.minsize)
+        hi = len(sizes) if sizefilter.maxsize is None else bisect.bisect_right(sizes, sizefilter.maxsize)
+        return memoryview(order)[lo:max(lo, hi)]
 
 
 class File(object):
@@ -96,9 +206,13 @@ class File(object):
     
     def __init__(self, fpath, index):
         # NOTE: since indexing is performed in binary mode, we also
-        # open the file in binary and convert to UTF-8 after reading;
+        # map the file in binary and convert to UTF-8 after reading;
         # this is necessary for the file positions to match
-        self.f = open(fpath, 'rb')
+        with open(fpath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b''
         self.index = index
 
     def __getitem__(self, i):
@@ -107,14 +221,13 @@ class File(object):
         Automatically decodes ROT13-encoded data and removes delimiter line.
         """
         beg, end = self.index[i]
-        self.f.seek(beg)
-        s = self.f.read(end - beg).decode('utf-8')
+        s = self.data[beg:end].decode('utf-8')
         if s[-2:] == self.index.delim + '\n':
             # this 'if' used to be an assert, but the delim+'\n'
             # of one file was missing at the last entry
             s = s[:-2]
         if self.index.flags & self.index.STR_ROTATED:
-            s = ROT13_DECODER(s)[0]
+            s = self.ROT13_DECODER(s)[0]
         return s
 
     class _Iter(object):
@@ -136,37 +249,169 @@ class File(object):
         return self._Iter(self)
 
 
+class SizeFilter(object):
+    """Size-filtering function.
+
+    Accepts sizes between minsize and maxsize (inclusive); None means no limit.
+    """
+    def __init__(self, minsize=None, maxsize=None):
+        self.minsize = minsize
+        self.maxsize = maxsize
+
+    def __call__(self, n):
+        return ((self.minsize is None or n >= self.minsize) and
+                (self.maxsize is None or n <= self.maxsize))
+
+
 def makesizefilter(onlylong, onlyshort, shortlen):
     """Create a size-filtering function."""
     if onlyshort:
-        return lambda n: n <= shortlen
+        return SizeFilter(maxsize=shortlen)
     elif onlylong:
-        return lambda n: n > shortlen
+        return SizeFilter(minsize=shortlen + 1)
     else:
-        return lambda n: True
+        return SizeFilter()
 
 
 def countitems(indexfile, sizefilter):
     """Count the items that satisfy the specified size constraints."""
-    count = 0
     try:
-        for beg, end in Index(indexfile):
-            if sizefilter(end - beg - 2):
-                count += 1
-        return count
-    except IOError:
-        # probably index file not found
+        return len(Index(indexfile).select(sizefilter))
+    except (IOError, ValueError):
+        # probably index file not found or empty
         return 0
 
 
 def findnth(ndx, n, sizefilter):
-    for i, (beg, end) in enumerate(ndx):
-        if not sizefilter(end - beg - 2):
-            continue
-        if n == 0:
-            return i
-        n -= 1
-    raise IndexError
+    """Get the index of the nth item that satisfies the size constraints.
+
+    Items are counted in ascending size order, not in file order.
+    """
+    return ndx.select(sizefilter)[n]
+
+
+class WordIndex(object):
+    """Inverted index of the words of a fortune file.
+
+    Maps lowercase words to the indices of the strings that contain them.
+    It is stored next to the index file (see wordsname()) and rebuilt
+    when the fortune file or its index change.
+    """
+    VERSION = 1
+
+    def __init__(self, datafile, ndx):
+        self.path = wordsname(ndx.path)
+        self.stamp = (self.VERSION, filestamp(datafile), filestamp(ndx.path))
+        self.words = self._load()
+        if self.words is None:
+            self.words = self._build(File(datafile, ndx))
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                stamp, words = pickle.load(f)
+        except Exception:
+            return None
+        return words if stamp == self.stamp else None
+
+    def _save(self):
+        # failure is not an error; the index will be rebuilt next time
+        tmppath = self.path + '.tmp'
+        try:
+            with open(tmppath, 'wb') as f:
+                pickle.dump((self.stamp, self.words), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, self.path)
+        except (OSError, IOError):
+            pass
+
+    @staticmethod
+    def _build(dat):
+        words = {}
+        for i, s in enumerate(dat):
+            for word in set(WORD_RX.findall(s.lower())):
+                try:
+                    words[word].append(i)
+                except KeyError:
+                    words[word] = array.array(UINT32, [i])
+        return words
+
+    def candidates(self, fragments):
+        """Get the indices of strings that may contain all word fragments.
+
+        Fragments must be lowercase. Returns a sorted list.
+        """
+        ret = None
+        for frag in fragments:
+            found = set()
+            for word, indices in self.words.items():
+                if frag in word:
+                    found.update(indices)
+            ret = found if ret is None else ret & found
+            if not ret:
+                break
+        return sorted(ret or ())
+
+
+WORD_RX = re.compile(r'\w+')
+
+
+def filestamp(path):
+    """Get the modification time and size of a file."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def wordfragments(rx):
+    """Get the word fragments that any match of a regexp must contain.
+
+    Returns a list of lowercase strings, or None if the pattern is not
+    made only of words and whitespace.
+    """
+    if not re.match(r'[\w\s]+$', rx.pattern) or rx.flags & re.VERBOSE:
+        return None
+    return WORD_RX.findall(rx.pattern.lower())
+
+
+def searchfile(datafile, rx, sizefilter, usewords):
+    """Find the strings of a fortune file that match a regexp.
+
+    If usewords is set and the pattern allows it, only the strings found
+    through the file's WordIndex are tested.
+    Returns the delimiter and a list of (index, string) tuples.
+    Module-level, so that it can be used by a process pool.
+    """
+    try:
+        ndx = Index(indexname(datafile))
+        dat = File(datafile, ndx)
+    except (IOError, ValueError):
+        # probably index file not found
+        return None, []
+    fragments = wordfragments(rx) if usewords else None
+    if fragments:
+        indices = WordIndex(datafile, ndx).candidates(fragments)
+    else:
+        indices = range(len(ndx))
+    ret = []
+    for i in indices:
+        s = dat[i]
+        if sizefilter(len(s)) and rx.search(s):
+            ret.append((i, s))
+    return ndx.delim, ret
+
+
+def search(files, rx, sizefilter, usewords=True, jobs=None):
+    """Search fortune files in parallel.
+
+    Generates (file, index, string, delimiter) tuples in file order.
+    """
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = [(datafile, pool.submit(searchfile, datafile, rx, sizefilter, usewords))
+                   for datafile in files]
+        for datafile, future in futures:
+            delim, matches = future.result()
+            for i, s in matches:
+                yield datafile, i, s, delim
 
 
 def indexname(s):
@@ -178,6 +423,16 @@ def indexname(s):
     return s + '.dat'
 
 
+def sizesname(s):
+    """Convert index file name to the name of its cached size order."""
+    return s + '.siz'
+
+
+def wordsname(s):
+    """Convert index file name to the name of its word index."""
+    return s + '.wdx'
+
+
 def parse_args():
     ap = argparse.ArgumentParser(
         description='Unix fortune in Python')
@@ -224,6 +479,9 @@ def parse_args():
         help='prepend source file/index to quotations')
     add('-c', dest='countmatches', action='store_true',
         help='when used with -m, print count of matches instead')
+    add('-W', dest='nowordindex', action='store_true',
+        help='do not use or update the word indexes for -m; scan all '
+        'fortunes instead')
 
     args = ap.parse_args()
 
@@ -236,7 +494,7 @@ def parse_args():
         try:
             args.matchpattern = re.compile(args.matchpattern, rxflags)
         except re.error as x:
-            ap.error('invalid regexp; ' + str(err))
+            ap.error('invalid regexp; ' + str(x))
 
     return args
 
@@ -258,24 +516,18 @@ if __name__ == '__main__':
     # if pattern matching is requested, show items and exit
     if args.matchpattern:
         count = 0
-        for datafile in files:
-            try:
-                ndx = Index(indexname(datafile))
-                for i, s in enumerate(File(datafile, ndx)):
-                    if sizefilter(len(s)) and args.matchpattern.search(s):
-                        if args.countmatches:
-                            count += 1
-                        else:
-                            if args.showsource:
-                                print('[%s:%d]' % (datafile, i))
-                            sys.stdout.write(s + ndx.delim + '\n')
-            except IOError:
-                # probably index file not found
-                pass
+        for datafile, i, s, delim in search(files, args.matchpattern, sizefilter,
+                                     not args.nowordindex):
+            if args.countmatches:
+                count += 1
+            else:
+                if args.showsource:
+                    print('[%s:%d]' % (datafile, i))
+                sys.stdout.write(s + delim + '\n')
         if args.countmatches:
             print(count, 'matches')
         sys.exit()
-                    
+
     # count items according to size constaints
     counts = [countitems(indexname(s), sizefilter) for s in files]
 
@@ -283,16 +535,13 @@ if __name__ == '__main__':
         sys.exit('no fortune files')
 
     # remove files and counts when count is 0
-    # FIXME: fails when all items are removed
-    files, counts = zip(*[
-        (s, n) for (s, n) in zip(files, counts)
-        if n])
-
-    if not files:
+    pairs = [(s, n) for (s, n) in zip(files, counts) if n]
+    if not pairs:
         sys.exit('nothing matches criteria')
+    files, counts = zip(*pairs)
 
     if args.equalfileprob:
-        filename, count = random.choice(zip(files, counts))
+        filename, count = random.choice(list(zip(files, counts)))
         i = random.randint(0, count-1)
     else:
         i = random.randint(0, sum(counts)-1)
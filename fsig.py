@@ -1,15 +1,30 @@
 #!python
-"""File hash calculator."""
+"""File hash calculator.
+
+Several hash types can be calculated in a single pass over each file.
+Reading can optionally be overlapped with hashing by using a separate
+reader thread (hashlib and zlib release the GIL while hashing), and
+multiple files can be hashed concurrently.
+
+A benchmark mode measures the throughput of each hash type and buffer
+size on the specified files, to help select the best options per host.
+"""
 
 from __future__ import print_function
 import argparse
 import binascii
+import collections
+import concurrent.futures
 import glob
 import hashlib
 import itertools
 import os
+import queue
 import struct
 import sys
+import threading
+import time
+import zlib
 
 try:
     from itertools import izip
@@ -24,19 +39,20 @@ import fileutil
 HASH_TYPES = hashlib.algorithms_available | set(['crc32'])
 DEFAULT_HASH_TYPE = 'md5'
 DEFAULT_BUFFER_SIZE = 64 * 1024
+BENCH_BUFFER_SIZES = [16 * 1024, 64 * 1024, 256 * 1024, 1024**2, 4 * 1024**2]
 
 
 class Crc32:
     """CRC32 digest using the hashlib interface."""
     digest_size = 4
-    def __init__(self, data=''):
-        self.value = binascii.crc32(data)
+    def __init__(self, data=b''):
+        self.value = zlib.crc32(data)
     def update(self, data):
-        self.value = binascii.crc32(data, self.value)
+        self.value = zlib.crc32(data, self.value)
     def digest(self):
         return struct.pack('>L', self.value & 0xffffffff)
     def hexdigest(self):
-        return binascii.hexlify(self.digest())
+        return binascii.hexlify(self.digest()).decode('ascii')
     def copy(self):
         # the only state of CRC32 is its current value
         ret = Crc32()
@@ -51,6 +67,23 @@ class Crc32:
 ##        return hashlib.new(name, string)
 
 
+def hash_factory(name):
+    """Callable that creates a new hash object of the specified type."""
+    if name == 'crc32':
+        return Crc32
+    else:
+        return lambda: hashlib.new(name)
+
+
+def hash_types_arg(s):
+    """Comma-separated hash type list argument type for argparse."""
+    ret = [t.strip().lower() for t in s.split(',')]
+    for t in ret:
+        if t not in HASH_TYPES:
+            raise argparse.ArgumentTypeError('invalid hash type: "%s"' % t)
+    return ret
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description='calculate file hashes',
@@ -60,16 +93,29 @@ def parse_args():
 
     add('files', metavar='FILE', nargs='+',
         help='input file (glob pattern)')
-    add('-t', dest='hash_type', choices=HASH_TYPES,
-        default=DEFAULT_HASH_TYPE, metavar='TYPE',
-        help='hash type; one of ' + ','.join(sorted(HASH_TYPES)) + '; '
-             'default: %(default)s')
+    add('-t', dest='hash_types', type=hash_types_arg,
+        default=[DEFAULT_HASH_TYPE], metavar='TYPES',
+        help='comma-separated list of hash types, all calculated in a single '
+             'pass; available: ' + ','.join(sorted(HASH_TYPES)) + '; '
+             'default: ' + DEFAULT_HASH_TYPE)
     add('-o', dest='offset', type=efutil.size_arg, default=0,
          help='starting file offset; default: %(default)s')
     add('-l', dest='length', type=efutil.size_arg, default=-1,
          help='number of bytes to process (or -1 for all); default: %(default)s')
-    add('-b', dest='buflen', type=efutil.size_arg, default=DEFAULT_BUFFER_SIZE,
-         help='read buffer size; default: %(default)s')
+    add('-b', dest='buflen', type=efutil.size_arg,
+         help='read buffer size; default: %d' % DEFAULT_BUFFER_SIZE)
+    add('-T', dest='threaded', action='store_true',
+         help='read the next block on a separate thread while hashing '
+              'the current one')
+    add('-j', '--jobs', type=int, default=1, metavar='N',
+         help='number of files to hash concurrently; results are still '
+              'printed in input order; default: %(default)s')
+    add('--bench', action='store_true',
+         help='instead of printing hashes, measure the throughput of each '
+              'specified hash type and several buffer sizes (' +
+              ','.join(str(n // 1024) + 'k' for n in BENCH_BUFFER_SIZES) +
+              ', or only the one specified with -b) on the input files; note that after the first pass the '
+              'data are probably read from the OS cache')
     add('-u', dest='uppercase', action='store_true',
          help='output hashes in uppercase')
     add('-i', dest='invert', action='store_true',
@@ -92,16 +138,25 @@ def parse_args():
         parser.error('offset must be >= 0')
     if args.length < -1:
         parser.error('number of bytes must be >= -1')
-    if args.buflen <= 0:
+    if args.buflen is None:
+        args.bench_buflens = BENCH_BUFFER_SIZES
+        args.buflen = DEFAULT_BUFFER_SIZE
+    elif args.buflen <= 0:
         parser.error('buffer size must be > 0')
-
-    if args.hash_type == 'crc32':
-        args.hash_type = Crc32
     else:
-        args.hash_type = lambda s=args.hash_type: hashlib.new(s)
+        args.bench_buflens = [args.buflen]
+    if args.jobs <= 0:
+        parser.error('number of jobs must be > 0')
+    if args.jobs > 1:
+        args.progress = False  # can't display progress of multiple files
+
+    args.hash_names = args.hash_types
+    args.hash_types = [hash_factory(s) for s in args.hash_types]
 
     if args.verify:
-        strsize = args.hash_type().digest_size * 2
+        if len(args.hash_types) != 1:
+            parser.error('only a single hash type can be used for verifying')
+        strsize = args.hash_types[0]().digest_size * 2
         a = []
         for s in args.verify.split(','):
             s = s.strip().lower()
@@ -151,23 +206,74 @@ class ProgressIndicator(object):
         sys.stdout.write('')  # softspace kludge
 
 
-def calc_hash(fp, offset, size, hash, buflen, progress):
-    """Calculate stream data digest. May raise IOError or EOFError."""
+def read_blocks(fp, offset, size, buflen):
+    """Generate blocks of stream data. May raise IOError or EOFError."""
+    fp.seek(offset)
+    bytes_left = size
+    while bytes_left > 0:
+        buf = fp.read(min(buflen, bytes_left))
+        if not buf:
+            raise EOFError('no enough data')
+        yield buf
+        bytes_left -= len(buf)
+
+
+def read_blocks_threaded(fp, offset, size, buflen, prefetch=2):
+    """Same as read_blocks(), but read ahead up to prefetch blocks
+    on a separate thread."""
+    q = queue.Queue(prefetch)
+    stop = threading.Event()
+    def put(item):
+        # give up if the consumer has stopped; returns False in that case
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def reader():
+        try:
+            for buf in read_blocks(fp, offset, size, buflen):
+                if not put(buf):
+                    return
+            put(None)
+        except Exception as x:
+            put(x)
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        t.join()
+
+
+def calc_hashes(fp, offset, size, hashes, buflen, progress, threaded=False):
+    """Calculate stream data digests using a list of hash objects,
+    reading the data only once. May raise IOError or EOFError."""
+    reader = read_blocks_threaded if threaded else read_blocks
     try:
-        fp.seek(offset)
-        bytes_left = size
-        while bytes_left > 0:
-            buf = fp.read(min(buflen, bytes_left))
-            if buf == '':
-                raise EOFError('no enough data')
-            hash.update(buf)
+        for buf in reader(fp, offset, size, buflen):
+            for hash in hashes:
+                hash.update(buf)
             if progress:
                 progress.update(len(buf))
-            bytes_left -= len(buf)
     finally:
         if progress:
             progress.clear()
-    return hash.hexdigest()
+    return [hash.hexdigest() for hash in hashes]
+
+
+def calc_hash(fp, offset, size, hash, buflen, progress):
+    """Calculate stream data digest. May raise IOError or EOFError."""
+    return calc_hashes(fp, offset, size, [hash], buflen, progress)[0]
 
 
 class EmptyGlobHandler(object):
@@ -194,6 +300,67 @@ def files_gen(patterns, empty_handler=None):
             empty_handler(patt)
 
 
+def hash_path(path, args):
+    """Calculate the hashes of a file as a space-separated string.
+    Return (hash, None) on success or (None, exception) on failure."""
+    try:
+        with open(path, 'rb') as fp:
+            hashobjs = [factory() for factory in args.hash_types]
+            total = calc_read_size(fileutil.fsize(fp), args.offset, args.length)
+            progress = ProgressIndicator(path, total) if args.progress else None
+            hash = ' '.join(calc_hashes(fp, args.offset, total, hashobjs,
+                                        args.buflen, progress, args.threaded))
+        return hash, None
+    except (IOError, EOFError) as x:
+        return None, x
+
+
+def hash_paths(paths, args):
+    """Generate (path, hash, exception) for each path, in order.
+    Files are hashed concurrently if args.jobs > 1."""
+    if args.jobs <= 1:
+        for path in paths:
+            yield (path,) + hash_path(path, args)
+        return
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+        # limit queued files to avoid holding the results of long file lists
+        pending = collections.deque()
+        for path in paths:
+            pending.append((path, pool.submit(hash_path, path, args)))
+            if len(pending) >= args.jobs * 4:
+                path, future = pending.popleft()
+                yield (path,) + future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield (path,) + future.result()
+
+
+def benchmark(paths, args):
+    """Print the throughput of each hash type and buffer size (see
+    args.bench_buflens) for a list of files. A 'read' row with no hashing
+    is included for reference."""
+    rows = [('read', [])] + [(name, [factory]) for name, factory
+                             in zip(args.hash_names, args.hash_types)]
+    print('%-10s %10s %12s' % ('type', 'buffer', 'MB/s'))
+    for name, factories in rows:
+        for buflen in args.bench_buflens:
+            nbytes = 0
+            start = time.perf_counter()
+            for path in paths:
+                try:
+                    with open(path, 'rb') as fp:
+                        total = calc_read_size(fileutil.fsize(fp), args.offset, args.length)
+                        calc_hashes(fp, args.offset, total, [f() for f in factories],
+                                    buflen, None, args.threaded)
+                    nbytes += total
+                except (IOError, EOFError) as x:
+                    print('error while hashing "%s": %s' % (path, x), file=sys.stderr)
+            elapsed = time.perf_counter() - start
+            rate = nbytes / elapsed / 1e6 if elapsed else 0
+            size = '%dk' % (buflen // 1024) if buflen % 1024 == 0 else str(buflen)
+            print('%-10s %10s %12.1f' % (name, size, rate))
+
+
 def main(args):
     # FIXME: iscon() still returns True if running on console with stdout redirected.
     # It only returns False on PythonWin.
@@ -206,6 +373,10 @@ def main(args):
     empty_globs = EmptyGlobHandler()
     filepaths = files_gen(args.files, empty_globs) if args.glob else args.files
 
+    if args.bench:
+        benchmark(list(filepaths), args)
+        sys.exit(1 if empty_globs.occured else 0)
+
     if args.verify:
         # check for length match early
         filepaths = list(filepaths)
@@ -215,30 +386,25 @@ def main(args):
     error_occured = False
     expected_hashes = args.verify or itertools.repeat(None)
 
-    for (path, expected_hash) in izip(filepaths, expected_hashes):
-        try:
-            fp = open(path, 'rb')
-            hashobj = args.hash_type()
-            total = calc_read_size(fileutil.fsize(fp), args.offset, args.length)
-            progress = ProgressIndicator(path, total) if args.progress else None
-            hash = calc_hash(fp, args.offset, total, hashobj, args.buflen, progress)
-            if not expected_hash:
-                if args.uppercase:
-                    hash = hash.upper()
-                if args.invert:
-                    print(path, hash)
-                else:
-                    print(hash, path)
-            else:
-                if hash != expected_hash:
-                    print('FAIL ', path)
-                    print('hash mismatch for "%s": expected %s, got %s' % (path, expected_hash, hash),
-                          file=sys.stderr)
-                    error_occured = True
-                else:
-                    print('OK   ', path)
-        except (IOError, EOFError) as x:
+    results = hash_paths(filepaths, args)
+    for ((path, hash, x), expected_hash) in izip(results, expected_hashes):
+        if x:
             print('error while hashing "%s": %s' % (path, x), file=sys.stderr)
+        elif not expected_hash:
+            if args.uppercase:
+                hash = hash.upper()
+            if args.invert:
+                print(path, hash)
+            else:
+                print(hash, path)
+        else:
+            if hash != expected_hash:
+                print('FAIL ', path)
+                print('hash mismatch for "%s": expected %s, got %s' % (path, expected_hash, hash),
+                      file=sys.stderr)
+                error_occured = True
+            else:
+                print('OK   ', path)
 
     if empty_globs.occured:
         error_occured = True
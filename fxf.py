@@ -25,7 +25,7 @@ import six
 import efutil
 import mathutil
 import console_stuff
-import quantizer
+import ratemeter
 
 from ctypes.wintypes import BOOL, DWORD, HANDLE, FILETIME, LARGE_INTEGER
 LPDWORD = ctypes.POINTER(DWORD)
@@ -262,21 +262,18 @@ def client_filestream(outdir, reader, buflen):
         os.makedirs(filedir)
 
     spo = console_stuff.SamePosOutput()
-    #ma = util.MovingAverage(1, 10)
-    quant = quantizer.TimeQuantizer(1.0, 30)
+    meter = ratemeter.RateMeter(10)
     t = time.time()
     with open(outfile, 'wb') as f:
         bytesleft = size
         while bytesleft > 0:
             s = reader(min(buflen, bytesleft))
             f.write(s)
-            #ma.add(len(s))
-            quant += len(s)
+            meter.add(len(s))
             if time.time() - t >= 1.0:
                 spo.restore(eolclear=True)
                 gotsize = size - bytesleft
-                #speed = ma.calc()
-                speed = sum(quant.data) / len(quant.data) if quant.data else 0
+                speed = meter.rate()
                 H, M, S = mathutil.multi_divmod(bytesleft / speed if speed else 0, 60, 60)
                 print '  got: %s,  speed: %s/s,  ETA: %02d:%02d:%02d' % (
                     efutil.prettysize(gotsize),
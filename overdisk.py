@@ -21,20 +21,36 @@ import collections
 import argparse
 import fnmatch
 import itertools
+import array
+import stat
+import threading
+import concurrent.futures
 
-import win32file
-import win32console
-
-import AutoComplete
-import console_stuff
 import efutil
-import winfiles
+
+# Windows-only modules; without them, only the scandir scanner
+# and plain console I/O are available
+try:
+    import win32console
+    import AutoComplete
+    import console_stuff
+    import winfiles
+except ImportError:
+    win32console = AutoComplete = console_stuff = winfiles = None
 
 
 # string alignment types mapped to functions
 STR_ALIGN = {'l': str.ljust, 'r': str.rjust, 'c': str.center, '': lambda s, n: s}
 
-FILE_ATTRIBUTE_REPARSE_POINT = 0x400
+FILE_ATTRIBUTE_REPARSE_POINT = stat.FILE_ATTRIBUTE_REPARSE_POINT
+
+
+def is_dir_attr(n):
+    return bool(n & stat.FILE_ATTRIBUTE_DIRECTORY)
+
+
+# item information, with the same fields as winfiles.FindData
+ItemData = collections.namedtuple('ItemData', 'name size attr modify create')
 
 
 ScanError = collections.namedtuple('ScanError', 'startpath messages')
@@ -65,100 +81,392 @@ class ExtStats(object):
         self.bytes = 0
 
 
-class Item(object):
-    """Base directory item."""
-
-    def __init__(self, path, data):
-        self.name = data.name
-        self.size = data.size
-        self.attr = data.attr
-        self.mdate = data.modify
-        self.cdate = data.create
+class Tree(object):
+    """Compact directory tree.
 
+    Items are stored in pre-order in parallel arrays (one element per item),
+    so the subtree of item i occupies the indices [i, end[i]) and the
+    children of a dir can be enumerated by skipping over their subtrees.
+    The root is item 0 and its parent is -1. Names and lowercase file
+    extensions are indices into interned string pools.
+    """
 
-class File(Item):
-    """File item."""
+    def __init__(self):
+        self.parent = array.array('q')
+        self.end = array.array('q')
+        self.size = array.array('Q')
+        self.attr = array.array('L')
+        self.mdate = array.array('d')
+        self.cdate = array.array('d')
+        self.name = array.array('L')
+        self.ext = array.array('L')  # 0 ('') for dirs
+        self.names = []
+        self.name_ids = {}
+        self.exts = ['']
+        self.ext_ids = {'': 0}
+
+    def __len__(self):
+        return len(self.parent)
+
+    @staticmethod
+    def _intern(pool, ids, s):
+        try:
+            return ids[s]
+        except KeyError:
+            ids[s] = len(pool)
+            pool.append(s)
+            return ids[s]
+
+    def append(self, parent, data):
+        """Add an item (an ItemData or winfiles.FindData) as the last
+        child of 'parent' and return its index.
+
+        Its subtree must be added next, followed by a call to close().
+        """
+        i = len(self.parent)
+        is_dir = is_dir_attr(data.attr)
+        self.parent.append(parent)
+        self.end.append(i + 1)
+        self.size.append(data.size)
+        self.attr.append(data.attr)
+        self.mdate.append(data.modify)
+        self.cdate.append(data.create)
+        self.name.append(self._intern(self.names, self.name_ids, data.name))
+        ext = '' if is_dir else os.path.splitext(data.name)[1].lower()
+        self.ext.append(self._intern(self.exts, self.ext_ids, ext))
+        return i
+
+    def close(self, i):
+        """Mark the end of the subtree of item i."""
+        self.end[i] = len(self.parent)
+
+    def is_dir(self, i):
+        return is_dir_attr(self.attr[i])
+
+    def get_name(self, i):
+        return self.names[self.name[i]]
+
+    def children(self, i):
+        """Generate the indices of the immediate children of item i."""
+        j, end = i + 1, self.end[i]
+        while j < end:
+            yield j
+            j = self.end[j]
+
+    def get_sub_dir(self, i, name):
+        """Return the index of an immediate subdir."""
+        if name in ('', '.'):
+            return i
+        name = name.lower()
+        for j in self.children(i):
+            if self.get_name(j).lower() == name:
+                return j
+        else:
+            raise PathError('no child named "%s"' % name)
 
-    def __init__(self, path, data, status=None):
-        Item.__init__(self, path, data)
+    def get_sub_path(self, i, path):
+        """Return the index of a subdir, 1 or more levels deeper, but never
+        higher. "path" must be relative, without any ".." tokens."""
+        if not path:
+            return i
+        for s in path.split(os.path.sep):
+            i = self.get_sub_dir(i, s)
+        return i
+
+    def _import(self, other, start, base):
+        """Return a dict of the arrays of another Tree, from index 'start'
+        on, with item indices offset by 'base' and names/extensions
+        interned in this tree's pools."""
+        name_map = array.array('L', (self._intern(self.names, self.name_ids, s)
+                                     for s in other.names))
+        ext_map = array.array('L', (self._intern(self.exts, self.ext_ids, s)
+                                    for s in other.exts))
+        return {
+            'parent': array.array('q', (n + base for n in other.parent[start:])),
+            'end': array.array('q', (n + base for n in other.end[start:])),
+            'size': other.size[start:],
+            'attr': other.attr[start:],
+            'mdate': other.mdate[start:],
+            'cdate': other.cdate[start:],
+            'name': array.array('L', (name_map[n] for n in other.name[start:])),
+            'ext': array.array('L', (ext_map[n] for n in other.ext[start:])),
+        }
 
-    def add_list_stats(self, stats, filter_obj):
-        if filter_obj.test(self.name):
-            stats.files += 1
-            stats.bytes += self.size
+    def graft(self, parent, other):
+        """Add the contents of another Tree as the last child of 'parent'.
+
+        Like append(), its parent's subtree must then be closed.
+        """
+        base = len(self)
+        for attr, sub_array in self._import(other, 0, base).items():
+            getattr(self, attr).extend(sub_array)
+        self.parent[base] = parent
+
+    def splice(self, i, other):
+        """Replace the subtree of item i with the contents of another Tree,
+        whose root corresponds to item i."""
+        old_end = self.end[i]
+        delta = len(other) - (old_end - i)
+        for attr, sub_array in self._import(other, 1, i).items():
+            a = getattr(self, attr)
+            setattr(self, attr, a[:i + 1] + sub_array + a[old_end:])
+        # the root item's own data are refreshed too
+        for attr in ('size', 'attr', 'mdate', 'cdate'):
+            getattr(self, attr)[i] = getattr(other, attr)[0]
+        # shift indices past the old subtree
+        if delta:
+            tail = i + len(other)
+            self.parent[tail:] = array.array('q', (
+                n + delta if n >= old_end else n for n in self.parent[tail:]))
+            self.end[tail:] = array.array('q', (n + delta for n in self.end[tail:]))
+            j = i
+            while j >= 0:
+                self.end[j] += delta
+                j = self.parent[j]
+        self.end[i] = i + len(other)
+
+    def _file_tester(self, filter_obj):
+        """Return a function testing whether item i is a file that passes
+        the filter; filter results are cached per name."""
+        cache = {}
+        names, name, attr = self.names, self.name, self.attr
+        def test(i):
+            if is_dir_attr(attr[i]):
+                return False
+            n = name[i]
+            try:
+                return cache[n]
+            except KeyError:
+                ret = cache[n] = filter_obj.test(names[n])
+                return ret
+        return test
+
+    def get_list_stats(self, i, filter_obj):
+        """Return total dirs, files and bytes of the subtree of item i."""
+        stats = ListStats()
+        test = self._file_tester(filter_obj)
+        size, attr = self.size, self.attr
+        for j in range(i, self.end[i]):
+            if is_dir_attr(attr[j]):
+                stats.dirs += 1
+            elif test(j):
+                stats.files += 1
+                stats.bytes += size[j]
+        return stats
 
-    def add_ext_stats(self, stats_dict, filter_obj):
-        if filter_obj.test(self.name):
-            ext = os.path.splitext(self.name)[1].lower()
-            stats = stats_dict[ext]
-            stats.files += 1
-            stats.bytes += self.size
+    def get_ext_stats(self, i, filter_obj):
+        """Return a dict of extensions to ExtStats for the files under item i."""
+        files = collections.Counter()
+        sizes = collections.Counter()
+        test = self._file_tester(filter_obj)
+        size, ext = self.size, self.ext
+        for j in range(i + 1, self.end[i]):
+            if test(j):
+                files[ext[j]] += 1
+                sizes[ext[j]] += size[j]
+        ret = {}
+        for n in files:
+            stats = ret[self.exts[n]] = ExtStats()
+            stats.files = files[n]
+            stats.bytes = sizes[n]
+        return ret
 
 
-class Dir(Item):
-    """Directory item."""
+class Scanner(object):
+    """Base directory scanner.
 
-    def __init__(self, path, data, scanlinks, scanerrors, status=None):
-        Item.__init__(self, path, data)
-        if status:
-            status.update(path)
-        if self.attr & FILE_ATTRIBUTE_REPARSE_POINT and not scanlinks:
-            self.children = []
-        else:
-            self.get_children(path, scanlinks, scanerrors, status)
+    Subclasses implement scan(), which returns a Tree of a directory.
+    Progress is reported to 'status' (a ScanStatus or None) and errors are
+    added to the last ScanError of 'scanerrors'.
+    """
 
-    def get_children(self, path, scanlinks, scanerrors, status=None):
-        self.children = []
+    def __init__(self, scanlinks, scanerrors, status=None):
+        self.scanlinks = scanlinks
+        self.scanerrors = scanerrors
+        self.status = status
+        self.lock = threading.Lock()
+
+    def scan(self, path):
+        raise NotImplementedError
+
+    def update(self, path):
+        if self.status:
+            with self.lock:
+                self.status.update(path)
+
+    def error(self, path, reason):
+        msg = 'WARNING: could not list contents of "%s"; reason: %s' % (path, reason)
+        with self.lock:
+            if self.status:
+                self.status.static_print(msg)
+            self.scanerrors[-1].messages.append(msg)
+
+
+class WinFilesScanner(Scanner):
+    """Single-threaded scanner using winfiles.find() (FindFirstFileW)."""
+
+    def scan(self, path):
+        tree = Tree()
+        data = next(winfiles.find(path, times='unix'))
+        self._scan_dir(tree, tree.append(-1, data), path)
+        return tree
+
+    def _scan_dir(self, tree, i, path):
+        self.update(path)
+        if tree.attr[i] & FILE_ATTRIBUTE_REPARSE_POINT and not self.scanlinks:
+            tree.close(i)
+            return
         try:
             for data in winfiles.find(os.path.join(path, '*'), times='unix'):
-                if status:
-                    status.update(path)
-                child_path = os.path.join(path, data.name)
-                if winfiles.is_dir(data.attr):
-                    self.children += [Dir(child_path, data, scanlinks, scanerrors, status)]
+                self.update(path)
+                j = tree.append(i, data)
+                if is_dir_attr(data.attr):
+                    self._scan_dir(tree, j, os.path.join(path, data.name))
                 else:
-                    self.children += [File(child_path, data, status)]
+                    tree.close(j)
         except WindowsError as x:
-            msg = 'WARNING: could not list contents of "%s"; reason: %s' % (path, x.strerror)
-            status.static_print(msg)
-            scanerrors[-1].messages.append(msg)
-            return
+            self.error(path, x.strerror)
+        tree.close(i)
 
-    def get_sub_dir(self, name):
-        """Return an immediate subdir."""
-        if name in ('', '.'):
-            return self
-        for c in self.children:
-            if c.name.lower() == name.lower():
-                return c
-        else:
-            raise PathError('no child named "%s"' % name)
 
-    def get_sub_path(self, path):
-        """Return a subdir, 1 or more levels deeper, but never higher.
-        "path" must be relative, without any ".." tokens."""
-        if not path:
-            return self
-        if os.path.sep in path:
-            s1, s2 = path.split(os.path.sep, 1)
-            return self.get_sub_dir(s1).get_sub_path(s2)
-        else:
-            return self.get_sub_dir(path)
+class ScandirScanner(Scanner):
+    """Portable scanner using os.scandir(), with subtrees scanned
+    concurrently on a pool of threads.
+
+    The top levels are listed until there are enough subdirs to keep
+    the threads busy; each of these subtrees is then scanned by one thread
+    into its own Tree, and the results are grafted in order.
+    """
+
+    MAX_SPLIT_DEPTH = 3
+
+    def __init__(self, scanlinks, scanerrors, status=None, jobs=None):
+        Scanner.__init__(self, scanlinks, scanerrors, status)
+        self.jobs = jobs or os.cpu_count() or 1
+
+    @staticmethod
+    def _attr(name, st, is_dir, is_link):
+        """Get Windows-style attributes of a stat result."""
+        attr = getattr(st, 'st_file_attributes', None)
+        if attr is None:
+            attr = stat.FILE_ATTRIBUTE_ARCHIVE
+            if is_dir:
+                attr = stat.FILE_ATTRIBUTE_DIRECTORY
+            if is_link:
+                attr |= FILE_ATTRIBUTE_REPARSE_POINT
+            if name.startswith('.'):
+                attr |= stat.FILE_ATTRIBUTE_HIDDEN
+            if not st.st_mode & 0o222:
+                attr |= stat.FILE_ATTRIBUTE_READONLY
+        elif is_dir:
+            # a symlink to a dir is a dir, as with FindFirstFileW
+            attr |= stat.FILE_ATTRIBUTE_DIRECTORY
+        return attr
+
+    @classmethod
+    def _data(cls, name, st, is_dir, is_link):
+        return ItemData(
+            name,
+            0 if is_dir else st.st_size,
+            cls._attr(name, st, is_dir, is_link),
+            st.st_mtime,
+            getattr(st, 'st_birthtime', st.st_ctime))
+
+    def _list(self, path):
+        """Get the ItemData of a dir's entries, or None on error."""
+        self.update(path)
+        ret = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        is_link = entry.is_symlink()
+                        is_dir = entry.is_dir()
+                    except OSError as x:
+                        self.error(entry.path, x.strerror)
+                        continue
+                    ret.append(self._data(entry.name, st, is_dir, is_link))
+        except OSError as x:
+            self.error(path, x.strerror)
+            return None
+        return ret
+
+    def _walk_into(self, data):
+        return is_dir_attr(data.attr) and (
+            self.scanlinks or not data.attr & FILE_ATTRIBUTE_REPARSE_POINT)
+
+    def _scan_dir(self, tree, i, path):
+        for data in self._list(path) or ():
+            j = tree.append(i, data)
+            if self._walk_into(data):
+                self._scan_dir(tree, j, os.path.join(path, data.name))
+            else:
+                tree.close(j)
+        tree.close(i)
+
+    def _scan_subtree(self, path, data):
+        tree = Tree()
+        self._scan_dir(tree, tree.append(-1, data), path)
+        return tree
+
+    def scan(self, path):
+        st = os.stat(path)
+        root = self._data(os.path.basename(path.rstrip(os.path.sep)) or path,
+                          st, True, os.path.islink(path))
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            # list the top levels (breadth-first) until there are enough
+            # subtrees for the threads; 'listings' maps paths to entries
+            listings = {}
+            frontier = [path]
+            for depth in range(self.MAX_SPLIT_DEPTH):
+                subs = []
+                for dpath, items in zip(frontier, pool.map(self._list, frontier)):
+                    listings[dpath] = items or []
+                    subs += [os.path.join(dpath, data.name)
+                             for data in listings[dpath] if self._walk_into(data)]
+                frontier = subs
+                if len(frontier) >= 4 * self.jobs:
+                    break
+            # scan the remaining subtrees concurrently
+            futures = {}
+            for dpath, items in listings.items():
+                for data in items:
+                    sub = os.path.join(dpath, data.name)
+                    if self._walk_into(data) and sub not in listings:
+                        futures[sub] = pool.submit(self._scan_subtree, sub, data)
+            # assemble in pre-order
+            tree = Tree()
+            self._assemble(tree, tree.append(-1, root), path, listings, futures)
+        return tree
+
+    def _assemble(self, tree, i, path, listings, futures):
+        for data in listings[path]:
+            sub = os.path.join(path, data.name)
+            if sub in futures:
+                tree.graft(i, futures.pop(sub).result())
+            else:
+                j = tree.append(i, data)
+                if sub in listings:
+                    self._assemble(tree, j, sub, listings, futures)
+                else:
+                    tree.close(j)
+        tree.close(i)
 
-    def get_list_stats(self, filter_obj):
-        """Return total dir, files and bytes recursively."""
-        stats = ListStats()
-        self.add_list_stats(stats, filter_obj)
-        return stats
 
-    def add_list_stats(self, stats, filter_obj):
-        stats.dirs += 1
-        for c in self.children:
-            c.add_list_stats(stats, filter_obj)
+SCANNERS = {
+    'winfiles': WinFilesScanner,
+    'scandir': ScandirScanner,
+}
+DEF_SCANNER = 'winfiles' if winfiles else 'scandir'
 
-    def add_ext_stats(self, stats_dict, filter_obj):
-        for c in self.children:
-            c.add_ext_stats(stats_dict, filter_obj)
+
+def make_scanner(state, status):
+    """Create the selected scanner for the state."""
+    cls = SCANNERS[state.scanner]
+    if cls is ScandirScanner:
+        return cls(state.scan_links, state.scan_errors, status, state.scan_jobs)
+    return cls(state.scan_links, state.scan_errors, status)
 
 
 def cmd_help(state, params):
@@ -323,9 +631,11 @@ class Filter(object):
 class State(object):
     """Global program state."""
     def __init__(self):
-        self.root = None            # root Dir object
+        self.root = None            # Tree object
         self.root_path = ''         # root dir path (must be unicode -> listdir bug)
         self.scan_links = False     # scan into junctions and dir symlinks
+        self.scanner = DEF_SCANNER  # SCANNERS key
+        self.scan_jobs = None       # scandir scanner threads; None for CPU count
         self.scan_errors = []       # list of accumulated ScanError objects
         self.rel_path = ''          # current relative dir path
         self.list_order = 's'       # list sorting
@@ -443,7 +753,7 @@ def output_table(cols, data, colsep, footer=0):
 def get_candidate_paths(state, seed):
     head, tail = os.path.split(seed)
     try:
-        rel_path, dir_obj = locate_dir(state, head)
+        rel_path, dir_index = locate_dir(state, head)
     except PathError:
         return []
     if tail:
@@ -451,11 +761,12 @@ def get_candidate_paths(state, seed):
         matches = lambda s: s.lower().startswith(tail)
     else:
         matches = lambda s: True
+    tree = state.root
     a = []
-    for item in dir_obj.children:
-        if isinstance(item, Dir) and matches(item.name):
-            #a += [item.name]
-            a += [os.path.join(head, item.name)]
+    for i in tree.children(dir_index):
+        if tree.is_dir(i) and matches(tree.get_name(i)):
+            #a += [tree.get_name(i)]
+            a += [os.path.join(head, tree.get_name(i))]
     return a
 
 
@@ -463,10 +774,11 @@ class ScanStatus(object):
     """Manage temporary status output during dir scanning."""
 
     def __init__(self, root):
-        self.spo = console_stuff.SamePosOutput(fallback=True)
+        self.spo = console_stuff.SamePosOutput(fallback=True) if console_stuff else None
         self.root = root
         self.last_update = time.time()
         self.spinner = itertools.cycle('-\\|/')
+        self.pending = False        # status line printed without console_stuff
 
     def update(self, s):
         t = time.time()
@@ -475,19 +787,30 @@ class ScanStatus(object):
         if t - self.last_update < 0.25:
             return
         self.last_update = t
-        self.spo.restore(True)
         s = s[len(self.root):]  # trim root
-        print(next(self.spinner) + ' ' + s[:77])  # TODO: use a better trimming func, removing middle path elements
+        s = next(self.spinner) + ' ' + s[:77]  # TODO: use a better trimming func, removing middle path elements
+        if self.spo:
+            self.spo.restore(True)
+            print(s)
+        else:
+            # plain terminal; overwrite the line in place
+            print('\r' + s.ljust(79), end='', flush=True)
+            self.pending = True
 
 
     def cleanup(self):
-        self.spo.restore(True)
+        if self.spo:
+            self.spo.restore(True)
+        elif self.pending:
+            print('\r' + ' ' * 79 + '\r', end='', flush=True)
+            self.pending = False
 
     def static_print(self, s):
         """Print a static line and continue updates to the next line."""
-        self.spo.restore(True)
+        self.cleanup()
         print(s)
-        self.spo.reset()
+        if self.spo:
+            self.spo.reset()
 
     def __enter__(self):
 ##        self._start_time = time.time()
@@ -512,7 +835,7 @@ def walk_path(state, cur_rel_path, parts):
             del a[-1:]
         else:
             try:
-                state.root.get_sub_path(os.path.join(*(a + [s])))
+                state.root.get_sub_path(0, os.path.join(*(a + [s])))
                 a += [s]
             except PathError:
                 raise
@@ -533,12 +856,12 @@ def setup_dir_change(state, new_path):
 
 def locate_dir(state, new_path):
     """Find dir by following "new_path" (absolute or relative)
-    and return its relative path and Dir object."""
+    and return its relative path and index in state.root."""
     if not new_path:
         rel_path = state.rel_path
     else:
         rel_path = walk_path(state, *setup_dir_change(state, new_path))
-    return rel_path, state.root.get_sub_path(rel_path)
+    return rel_path, state.root.get_sub_path(0, rel_path)
 
 
 def date_to_str(n):
@@ -551,11 +874,11 @@ def attr_to_str(n):
     extra = (n & 0xff00) >> 8
     s = '%02x' % extra if extra else '..'
     s += '-'
-    s += 'A' if n & win32file.FILE_ATTRIBUTE_ARCHIVE   else '.'
-    s += 'D' if n & win32file.FILE_ATTRIBUTE_DIRECTORY else '.'
-    s += 'S' if n & win32file.FILE_ATTRIBUTE_SYSTEM    else '.'
-    s += 'H' if n & win32file.FILE_ATTRIBUTE_HIDDEN    else '.'
-    s += 'R' if n & win32file.FILE_ATTRIBUTE_READONLY  else '.'
+    s += 'A' if n & stat.FILE_ATTRIBUTE_ARCHIVE   else '.'
+    s += 'D' if n & stat.FILE_ATTRIBUTE_DIRECTORY else '.'
+    s += 'S' if n & stat.FILE_ATTRIBUTE_SYSTEM    else '.'
+    s += 'H' if n & stat.FILE_ATTRIBUTE_HIDDEN    else '.'
+    s += 'R' if n & stat.FILE_ATTRIBUTE_READONLY  else '.'
     return s
 
 
@@ -584,8 +907,7 @@ def cmd_root(state, params):
         raise PathError('not a dir: "%s"' % new_root_path)
     state.scan_errors.append(ScanError(startpath=new_root_path, messages=[]))
     with ScanStatus(new_root_path) as status:
-        data = next(winfiles.find(new_root_path))
-        state.root = Dir(new_root_path, data, state.scan_links, state.scan_errors, status)
+        state.root = make_scanner(state, status).scan(new_root_path)
     state.root_path = new_root_path
     state.rel_path = ''
 
@@ -625,11 +947,13 @@ def size_title_and_formatter(unit):
 def cmd_dir(state, params):
     if len(params) > 1:
         raise CmdError('at most one param required')
-    rel_path, dir = locate_dir(state, params[0] if params else '')
+    rel_path, dir_index = locate_dir(state, params[0] if params else '')
+    tree = state.root
     data_rows = []
-    for item in dir.children:
-        if isinstance(item, Dir) or state.filter.test(item.name):
-            data_rows += [(item.mdate, item.size, item.attr, item.name)]
+    for i in tree.children(dir_index):
+        name = tree.get_name(i)
+        if tree.is_dir(i) or state.filter.test(name):
+            data_rows += [(tree.mdate[i], tree.size[i], tree.attr[i], name)]
     order_index_map = {'m':0, 's':1, 'a':2, 'n':3, '*':None}
     order_index = order_index_map[state.dir_order.lower()]
     if order_index is not None:
@@ -638,7 +962,7 @@ def cmd_dir(state, params):
             reverse=(not state.list_order.islower())
         )
 
-    is_dir_row = lambda row: bool(row[2] & win32file.FILE_ATTRIBUTE_DIRECTORY)
+    is_dir_row = lambda row: bool(row[2] & stat.FILE_ATTRIBUTE_DIRECTORY)
 
     # move dirs to beginning
     data_rows.sort(key=is_dir_row, reverse=True)
@@ -670,24 +994,24 @@ def cmd_dir(state, params):
 def cmd_list(state, params):
     if len(params) > 1:
         raise CmdError('at most one param required')
-    rel_path, dir = locate_dir(state, params[0] if params else '')
+    rel_path, dir_index = locate_dir(state, params[0] if params else '')
+    tree = state.root
     data_rows = []
     total_stats = [0, 0, 0]
     file_stats = [0, 0, 0]
-    for item in dir.children:
-        try:
-            stats = item.get_list_stats(state.filter)
-            data_rows += [(stats.dirs, stats.files, stats.bytes, item.name)]
+    for i in tree.children(dir_index):
+        name = tree.get_name(i)
+        if tree.is_dir(i):
+            stats = tree.get_list_stats(i, state.filter)
+            data_rows += [(stats.dirs, stats.files, stats.bytes, name)]
             total_stats[0] += stats.dirs
             total_stats[1] += stats.files
             total_stats[2] += stats.bytes
-        except AttributeError:
-            # it's a File
-            if state.filter.test(item.name):
-                file_stats[1] += 1
-                file_stats[2] += item.size
-                total_stats[1] += 1
-                total_stats[2] += item.size
+        elif state.filter.test(name):
+            file_stats[1] += 1
+            file_stats[2] += tree.size[i]
+            total_stats[1] += 1
+            total_stats[2] += tree.size[i]
     order_index_map = {'d':0, 'f':1, 's':2, 'n':3, '*':None}
     order_index = order_index_map[state.list_order.lower()]
 
@@ -725,10 +1049,8 @@ def cmd_list(state, params):
 def cmd_extcnt(state, params):
     if len(params) > 1:
         raise CmdError('at most one param required')
-    rel_path, dir = locate_dir(state, params[0] if params else '')
-    stats_dict = collections.defaultdict(lambda: ExtStats())
-    for item in dir.children:
-        item.add_ext_stats(stats_dict, state.filter)
+    rel_path, dir_index = locate_dir(state, params[0] if params else '')
+    stats_dict = state.root.get_ext_stats(dir_index, state.filter)
     data_rows = []
     total_files, total_size = 0, 0
     for ext, stats in stats_dict.items():
@@ -763,12 +1085,13 @@ def cmd_extcnt(state, params):
 def cmd_scan(state, params):
     if len(params) > 1:
         raise CmdError('at most one param required')
-    rel_path, dir = locate_dir(state, params[0] if params else '')
+    rel_path, dir_index = locate_dir(state, params[0] if params else '')
     abs_path = os.path.join(state.root_path, rel_path)
     print('scanning "%s" ...' % os.path.join(state.root_path, abs_path))
     state.scan_errors.append(ScanError(startpath=abs_path, messages=[]))
     with ScanStatus(abs_path) as status:
-        dir.get_children(abs_path, state.scan_links, state.scan_errors, status)
+        subtree = make_scanner(state, status).scan(abs_path)
+        state.root.splice(dir_index, subtree)
 
 
 def cmd_scan_errors(state, params):
@@ -808,6 +1131,8 @@ def cmd_go(state, params):
         raise CmdError('at most one param required')
     rel_path, dir = locate_dir(state, params[0] if params else '')
     abs_path = os.path.join(state.root_path, rel_path)
+    if not hasattr(os, 'startfile'):
+        raise CmdError('not supported on this platform')
     os.startfile(abs_path)
 
 
@@ -904,6 +1229,8 @@ def cmd_colsep(state, params):
 def cmd_cols(state, params):
     if len(params) > 1:
         raise CmdError('at most one param required')
+    if not console_stuff:
+        raise CmdError('not supported on this platform')
     if not params:
         print(console_stuff.consolesize()[1])
         return
@@ -919,7 +1246,10 @@ def cmd_cols(state, params):
 def cmd_cls(state, params):
     if params:
         raise CmdError('no params required')
-    console_stuff.cls()
+    if console_stuff:
+        console_stuff.cls()
+    else:
+        print('\x1b[H\x1b[2J', end='', flush=True)
 
 
 def cmd_quit(state, params):
@@ -944,7 +1274,25 @@ def parse_args():
         help='scan directory symlinks and junctions; unless specified, '
              'container names are visible, but are not scanned for subitems'
     )
+    ap.add_argument(
+        '--scanner',
+        choices=sorted(SCANNERS),
+        default=DEF_SCANNER,
+        help='directory scanner backend; "scandir" is portable and '
+             'multithreaded; default: "%(default)s"'
+    )
+    ap.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        metavar='N',
+        help='threads used by the scandir scanner; default: CPU count'
+    )
     args = ap.parse_args()
+    if args.scanner == 'winfiles' and not winfiles:
+        ap.error('the winfiles scanner is not available on this platform')
+    if args.jobs is not None and args.jobs < 1:
+        ap.error('jobs must be positive')
     args.root = os.path.abspath(args.root)
     if not os.path.isdir(args.root):
         ap.error('not a dir: "%s"' % args.root)
@@ -974,26 +1322,26 @@ def main(args):
     state = State()
     state.root_path = args.root
     state.scan_links = args.scan_links
+    state.scanner = args.scanner
+    state.scan_jobs = args.jobs
     cmd_dispatcher = CmdDispatcher(state)
 
     print('scanning "%s" ...' % state.root_path)
     state.scan_errors.append(ScanError(startpath=state.root_path, messages=[]))
     with ScanStatus(state.root_path) as status:
-        data = next(winfiles.find(state.root_path))
-        state.root = Dir(state.root_path, data, state.scan_links, state.scan_errors, status)
+        state.root = make_scanner(state, status).scan(state.root_path)
 
-    acmgr = AutoComplete.Manager()
+    acmgr = AutoComplete.Manager() if AutoComplete else None
 
     while True:
         try:
             try:
-                USE_AUTOCOMPLETE = True
-                if USE_AUTOCOMPLETE:
+                if acmgr:
                     acmgr.completer = lambda s: get_candidate_paths(state, s)
                     s = acmgr.input(get_prompt(state))
                 else:
-                    s = raw_input(get_prompt(state)).strip()
-            except KeyboardInterrupt:
+                    s = input(get_prompt(state)).strip()
+            except (KeyboardInterrupt, EOFError):
                 print('Ctrl-C detected', file=sys.stderr)
                 break
 
@@ -0,0 +1,88 @@
+"""Transfer rate and progress statistics.
+
+RateMeter estimates the current rate of a transfer with exponentially
+decayed sums of amounts and times, so each update is O(1) no matter how
+small the chunks are. It also tracks the total progress and provides
+snapshots with the rate, ratio and ETA for status displays.
+"""
+
+from __future__ import division
+import collections
+import threading
+import time
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class Stats(collections.namedtuple('Stats', 'done total elapsed rate average eta ratio')):
+    """Snapshot of a RateMeter.
+
+    done:       amount transferred so far (incl. the initial amount)
+    total:      total amount; None if unknown
+    elapsed:    seconds since the meter was created
+    rate:       current (decayed) rate per second
+    average:    average rate per second since the meter was created
+    eta:        estimated seconds remaining; None if total or rate unknown
+    ratio:      done/total (0..1); None if total unknown
+    """
+    __slots__ = ()
+
+
+class RateMeter(object):
+    """Exponentially decayed rate estimator.
+
+    Data are weighted by 0.5 ** (age / halflife), where age is measured in
+    transfer time; the rate is the ratio of the weighted amount and time sums.
+    Thread-safe.
+    """
+
+    def __init__(self, halflife=5.0, total=None, done=0):
+        self.halflife = halflife
+        self.total = total
+        self.done = done
+        self.initial = done
+        self.lock = threading.Lock()
+        self.start = self.last = clock()
+        self.wamount = 0.0
+        self.wtime = 0.0
+
+    def add(self, n, dt=None):
+        """Add a transferred amount.
+
+        'dt' is the time it took; if None, the time since the last add()
+        (or creation) is used.
+        """
+        with self.lock:
+            now = clock()
+            if dt is None:
+                dt = now - self.last
+            self.last = now
+            decay = 0.5 ** (dt / self.halflife) if dt > 0 else 1.0
+            self.wamount = self.wamount * decay + n
+            self.wtime = self.wtime * decay + dt
+            self.done += n
+
+    def adjust(self, n):
+        """Correct the amount done, without affecting the rate."""
+        with self.lock:
+            self.done += n
+            self.initial += n
+
+    def rate(self):
+        """Current rate per second (0 if unknown)."""
+        with self.lock:
+            return self.wamount / self.wtime if self.wtime else 0
+
+    def snapshot(self):
+        """Get the current Stats."""
+        with self.lock:
+            elapsed = clock() - self.start
+            rate = self.wamount / self.wtime if self.wtime else 0
+            average = (self.done - self.initial) / elapsed if elapsed else 0
+            if self.total is None:
+                eta = ratio = None
+            else:
+                ratio = self.done / self.total if self.total else 1.0
+                eta = max(self.total - self.done, 0) / rate if rate else None
+            return Stats(self.done, self.total, elapsed, rate, average, eta, ratio)
@@ -6,11 +6,22 @@
 # TODO: maybe use bitflags for exitcode
 
 
+from __future__ import print_function
 import os
 import sys
-from binascii import crc32
+import json
+import time
+import mmap
+import tempfile
+import zlib
+import concurrent.futures
 import wildcard
 
+try:
+    import _winreg as winreg
+except ImportError:
+    import winreg
+
 
 setup_instructions = """
 
@@ -38,16 +49,29 @@ EXIT_FILEERROR = 1
 EXIT_BADPARAM = 2
 EXIT_FATAL = 3
 
-BUFFER_SIZE = 1024**2  # for reading files
+BUFFER_SIZE = 4 * 1024**2  # for reading files
+MMAP_MIN_SIZE = 256 * 1024**2  # larger files are memory-mapped
+
+# results of checking a single file
+RESULT_OK, RESULT_BAD, RESULT_MISSING = range(3)
+
+STAT_CACHE_EXT = '.stat'  # appended to SFV name for the /C stat cache
 
 
 def showhelp():
-    print """\
-SFV [/V] [/X] [{/REG|/UNREG}] [file ...]
+    print("""\
+SFV [/V] [/X] [/J:n] [/C] [{/REG|/UNREG}] [file ...]
 
   file    One or more SFV files to check. Wildcards are allowed.
   /V      Verbose output. Prints the names of all files while checking them.
   /X      Exit on first error.
+  /J:n    Check up to n files at the same time (default is 1). Files of all
+          SFVs are checked together and results are printed as soon as each
+          file is done, followed by the totals of each SFV.
+  /C      Create or update the specified SFV files instead of checking them.
+          Each SFV lists all files in its directory tree (except for other SFV
+          files). A stat cache is kept next to the SFV (same name plus
+          ".stat") and only new or changed files are hashed.
   /REG    TODO: Register a Test command for SFV files in the Shell.
   /UNREG  TODO: Remove the above.
 
@@ -55,7 +79,7 @@ Return codes:
   0  All files verified.
   1  At least one file was not found or verified.
   2  Bad program option, or SFV file not found or malformed.
-  3  Fatal error."""
+  3  Fatal error.""")
 
 
 def main(args):
@@ -66,7 +90,7 @@ def main(args):
 
     try: # parse options
         opt = Options(args)
-    except Options.Error, x:
+    except Options.Error as x:
         errln(str(x))
         return EXIT_BADPARAM
 
@@ -79,24 +103,38 @@ def main(args):
         errors.add(EXIT_FATAL)
 
     if not (opt.exitonerror and errors):
+        sfvfiles = []
         for spec in opt.files:
             s1, s2 = os.path.split(spec)
             if wildcard.iswild(s2):
-                files = [os.path.join(s1, s) for s in wildcard.listdir(s2, s1)]
+                sfvfiles += [os.path.join(s1, s) for s in wildcard.listdir(s2, s1)]
             else:
-                files = [spec]
-            for s in files:
-                ok,bad,missing = verify(s, opt, errors)
+                sfvfiles += [spec]
+        sfvfiles = uniquepaths(sfvfiles)
+        if opt.create:
+            for s in sfvfiles:
+                update(s, opt, errors)
+                print()
                 if opt.exitonerror and errors:
                     break
-                print 'Files OK:%d, bad:%d, missing:%d' % (ok,bad,missing)
-                print
-                totalok += ok
-                totalfail += bad
-                totalmissing += missing
-                totalsfv += 1
-        print 'Total files OK:%d, bad:%d, missing:%d' % (totalok, totalfail, totalmissing)
-        print 'Total SFV files:%d' % (totalsfv,)
+            return sorted(list(errors))[-1] if errors else EXIT_OK
+        if opt.jobs > 1:
+            counts = verifymany(sfvfiles, opt, errors)
+        else:
+            counts = []
+            for s in sfvfiles:
+                counts += [verify(s, opt, errors)]
+                if opt.exitonerror and errors:
+                    break
+                print('Files OK:%d, bad:%d, missing:%d' % counts[-1])
+                print()
+        for ok,bad,missing in counts:
+            totalok += ok
+            totalfail += bad
+            totalmissing += missing
+            totalsfv += 1
+        print('Total files OK:%d, bad:%d, missing:%d' % (totalok, totalfail, totalmissing))
+        print('Total SFV files:%d' % (totalsfv,))
 
     # return highest error number, if any
     return sorted(list(errors))[-1] if errors else EXIT_OK
@@ -110,6 +148,7 @@ class Options:
     simpleflags = {
         'x':'exitonerror',
         'v':'verbose',
+        'c':'create',
         'reg':'register',
         'unreg':'unregister'
     }
@@ -117,6 +156,7 @@ class Options:
         pass
     def __init__(self, args):
         self.files = []
+        self.jobs = 1
         for s in self.simpleflags.values():
             setattr(self, s, False)
         for s in args:
@@ -127,6 +167,14 @@ class Options:
         if self.register and self.unregister:
             raise self.Error('/REG and /UNREG are mutually exclusive')
     def getswitch(self, s):
+        if s.lower().startswith('j:'):
+            try:
+                self.jobs = int(s[2:])
+                if self.jobs < 1:
+                    raise ValueError
+            except ValueError:
+                raise self.Error('invalid job count: "/' + s + '"')
+            return
         if s.lower() not in self.simpleflags:
             raise self.Error('invalid switch: "/' + s + '"')
         setattr(self, self.simpleflags[s.lower()], True)
@@ -135,51 +183,241 @@ class Options:
 def verify(sfv, opt, errors):
     """Open a SFV file and test its files.
     Return number of verified,unverified,and missing files."""
-    print 'Processing SFV file "%s"' % sfv
-    numok, numbad, nummissing = 0, 0, 0
+    print('Processing SFV file "%s"' % sfv)
+    counts = [0, 0, 0]  # indexed by RESULT_*
+    entries = readsfv(sfv, opt, errors)
+    for _, spec, result, msg in checkfiles(entries, opt):
+        counts[result] += 1
+        if msg:
+            errln(msg)
+            errors.add(EXIT_FILEERROR)
+            if opt.exitonerror:
+                break
+    return tuple(counts)
+
+
+def uniquepaths(paths):
+    """Remove duplicate paths (e.g. specified both explicitly and via
+    a wildcard), keeping the first occurrence of each."""
+    seen = set()
+    ret = []
+    for s in paths:
+        key = os.path.normcase(os.path.abspath(s))
+        if key not in seen:
+            seen.add(key)
+            ret.append(s)
+    return ret
+
+
+def verifymany(sfvfiles, opt, errors):
+    """Test the files of several SFV files concurrently.
+    Results are printed as soon as each file is checked, in no particular
+    order, followed by the totals of each SFV.
+    Return list of verified,unverified,and missing file counts per SFV."""
+    entries = []
+    for sfv in sfvfiles:
+        entries += readsfv(sfv, opt, errors)
+        if opt.exitonerror and errors:
+            return []
+    print('Processing %d SFV files' % len(sfvfiles))
+    counts = dict((sfv, [0, 0, 0]) for sfv in sfvfiles)  # indexed by RESULT_*
+    for sfv, spec, result, msg in checkfiles(entries, opt):
+        counts[sfv][result] += 1
+        if msg:
+            errln(msg)
+            errors.add(EXIT_FILEERROR)
+            if opt.exitonerror:
+                break
+        elif opt.verbose:
+            print('File OK "%s"' % spec)
+    print()
+    for sfv in sfvfiles:
+        print('SFV file "%s": OK:%d, bad:%d, missing:%d' % ((sfv,) + tuple(counts[sfv])))
+    print()
+    return [tuple(counts[sfv]) for sfv in sfvfiles]
+
+
+def readsfv(sfv, opt, errors):
+    """Read the entries of a SFV file.
+    Return list of (sfv, filepath, checksum) tuples, possibly incomplete
+    on errors."""
+    ret = []
     try:
-        f = file(sfv)
-    except IOError, x:
+        f = open(sfv)
+    except IOError as x:
         errln(str(x))
         errors.add(EXIT_BADPARAM)
-        return numok, numbad, nummissing
-    for lineno, s in enumerate(f):
-        s = s.rstrip('\n').strip()
-        if s.startswith(';') or not s:  # comment or empty
-            continue
-        try:
-            fname, chksum = parseline(s, lineno, errors)
-        except ValueError:
-            if opt.exitonerror:
-                return numok, numbad, nummissing
-        spec = os.path.join(os.path.dirname(sfv), fname)
-        try:
+        return ret
+    with f:
+        for lineno, s in enumerate(f):
+            s = s.rstrip('\n').strip()
+            if s.startswith(';') or not s:  # comment or empty
+                continue
+            try:
+                fname, chksum = parseline(s, lineno, errors)
+            except ValueError:
+                if opt.exitonerror:
+                    break
+                continue
+            ret += [(sfv, os.path.join(os.path.dirname(sfv), fname), chksum)]
+    return ret
+
+
+def checkfiles(entries, opt):
+    """Check (sfv, filepath, checksum) entries.
+    Generate (sfv, filepath, result, errormsg) tuples; result is one of
+    RESULT_* and errormsg is None for RESULT_OK.
+    Files are checked in order, unless opt.jobs > 1, in which case they
+    are checked concurrently and generated as soon as they complete."""
+    if opt.jobs <= 1:
+        for sfv, spec, chksum in entries:
             if opt.verbose:
-                print 'Checking file "%s"' % spec
-            datafile = file(spec, 'rb')
-            curcrc = 0
+                print('Checking file "%s"' % spec)
+            yield (sfv, spec) + checkfile(spec, chksum)
+        return
+    with concurrent.futures.ThreadPoolExecutor(opt.jobs) as pool:
+        futures = dict((pool.submit(checkfile, spec, chksum), (sfv, spec))
+                       for sfv, spec, chksum in entries)
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future] + future.result()
+        finally:
+            for future in futures:  # if stopped early
+                future.cancel()
+
+
+def checkfile(spec, chksum):
+    """Verify the CRC of a file.
+    Return (result, errormsg); see checkfiles()."""
+    try:
+        curcrc = crcfile(spec)
+    except (IOError, OSError) as x:
+        return RESULT_MISSING, str(x)
+    if curcrc == chksum:
+        return RESULT_OK, None
+    return RESULT_BAD, 'CRC mismatch for file "%s"' % spec
+
+
+def crcfile(path):
+    """Calculate the CRC32 of a file.
+    Large files are memory-mapped to avoid copying into read buffers.
+    (zlib.crc32 releases the GIL, so this can be used in threads.)"""
+    curcrc = 0
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    for i in range(0, size, BUFFER_SIZE):
+                        curcrc = zlib.crc32(view[i:i+BUFFER_SIZE], curcrc)
+                finally:
+                    view.release()
+        else:
             while True:
-                buf = datafile.read(BUFFER_SIZE)
+                buf = f.read(BUFFER_SIZE)
                 if not buf:
                     break
-                curcrc = crc32(buf, curcrc)
-            curcrc &= 0xffffffff
-            if curcrc == chksum:
-                numok += 1
-            else:
-                numbad += 1
-                errln('CRC mismatch for file "%s"' % spec)
+                curcrc = zlib.crc32(buf, curcrc)
+    return curcrc & 0xffffffff
+
+
+def update(sfv, opt, errors):
+    """Create or update a SFV file listing all files in its directory tree.
+    Files whose entry in the existing SFV is confirmed by the stat cache
+    (matching size and mtime) are not hashed again. Both files are
+    rewritten atomically."""
+    print('Updating SFV file "%s"' % sfv)
+    topdir = os.path.dirname(sfv)
+    statpath = sfv + STAT_CACHE_EXT
+    old = {}
+    if os.path.exists(sfv):
+        old = dict((os.path.relpath(spec, topdir or '.'), chksum)
+                   for _, spec, chksum in readsfv(sfv, opt, errors))
+        if opt.exitonerror and errors:
+            return
+    statcache = {}
+    try:
+        with open(statpath) as f:
+            statcache = json.load(f)
+    except (IOError, ValueError):
+        pass
+
+    entries = {}  # relpath -> checksum
+    newstats = {}  # relpath -> [size, mtime, checksum]
+    tohash = []
+    for dpath, subs, files in os.walk(topdir or '.'):
+        subs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(('.sfv', '.sfv' + STAT_CACHE_EXT)):
+                continue  # don't list checksum files
+            spec = os.path.join(dpath, name)
+            rel = os.path.relpath(spec, topdir or '.')
+            try:
+                st = os.stat(spec)
+            except OSError as x:
+                errln(str(x))
                 errors.add(EXIT_FILEERROR)
-                if opt.exitonerror:
-                    return numok, numbad, nummissing
-        except IOError, x:
-            nummissing += 1
-            errln(str(x))
+                continue
+            cached = statcache.get(rel)
+            if (rel in old and cached and cached[2] == old[rel] and
+                    cached[:2] == [st.st_size, st.st_mtime_ns]):
+                entries[rel] = old[rel]
+                newstats[rel] = cached
+            else:
+                tohash += [(rel, spec, st)]
+
+    hashed = 0
+    for (rel, spec, st), chksum in zip(tohash, crcfiles([t[1] for t in tohash], opt)):
+        if isinstance(chksum, Exception):
+            errln(str(chksum))
             errors.add(EXIT_FILEERROR)
             if opt.exitonerror:
-                return numok, numbad, nummissing
-    return numok, numbad, nummissing
-            
+                return
+            continue
+        if opt.verbose:
+            print('Hashed file "%s"' % spec)
+        entries[rel] = chksum
+        newstats[rel] = [st.st_size, st.st_mtime_ns, chksum]
+        hashed += 1
+
+    lines = ['; Generated by sfv.py on %s\n' % time.strftime('%Y-%m-%d %H:%M:%S')]
+    lines += ['%s %08X\n' % (rel, entries[rel]) for rel in sorted(entries)]
+    writeatomic(sfv, ''.join(lines))
+    writeatomic(statpath, json.dumps(newstats))
+    print('Files hashed:%d, unchanged:%d, removed:%d' % (
+        hashed, len(entries) - hashed, len(set(old) - set(entries))))
+
+
+def crcfiles(paths, opt):
+    """Calculate the CRCs of files, concurrently if opt.jobs > 1.
+    Generate the CRC of each file in order, or the raised exception."""
+    def calc(path):
+        try:
+            return crcfile(path)
+        except (IOError, OSError) as x:
+            return x
+    if opt.jobs <= 1:
+        for path in paths:
+            yield calc(path)
+        return
+    with concurrent.futures.ThreadPoolExecutor(opt.jobs) as pool:
+        for ret in pool.map(calc, paths):
+            yield ret
+
+
+def writeatomic(path, data):
+    """Replace the contents of a text file atomically."""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
+
 
 def parseline(s, lineno, errors):
     """Parse non-empty, non-comment SFV line and return (filename, checksum).
@@ -195,7 +433,7 @@ def parseline(s, lineno, errors):
     fname = ' '.join(tokens[:-1])
     try:
         chksum = int(tokens[-1], 16)
-        if (chksum & ~0xffffffff) <> 0:  # must be 32-bit
+        if (chksum & ~0xffffffff) != 0:  # must be 32-bit
             raise ValueError
     except ValueError:
         errln('Line %d: invalid checksum "%s"' % (lineno+1,tokens[-1]))
@@ -205,20 +443,19 @@ def parseline(s, lineno, errors):
 
 
 def shellRegister():
-    import _winreg
     #import efRegistry
     k1, k2 = None
     try:
-        HKCR = _winreg.HKEY_CLASSES_ROOT
-        setStr = lambda key, name, data: _winreg.SetValueEx(
-            key, name, 0, _winreg.REG_SZ, data)
-        k1 = _winreg.CreateKey(HKCR, '.sfv')
+        HKCR = winreg.HKEY_CLASSES_ROOT
+        setStr = lambda key, name, data: winreg.SetValueEx(
+            key, name, 0, winreg.REG_SZ, data)
+        k1 = winreg.CreateKey(HKCR, '.sfv')
         setStr(k1, '', 'sfv_auto_file')
         setStr(k1, 'PerceivedType', 'text')
-        k2 = _winreg.CreateKey(HKCR, 'sfv_auto_file')
+        k2 = winreg.CreateKey(HKCR, 'sfv_auto_file')
     finally:
-        if k1: _winreg.CloseKey(k1)
-        if k2: _winreg.CloseKey(k2)
+        if k1: winreg.CloseKey(k1)
+        if k2: winreg.CloseKey(k2)
 
 
 ##
@@ -263,8 +500,7 @@ def shellRegister():
 )
 """
 
-import _winreg
-STR = _winreg.REG_SZ
+STR = winreg.REG_SZ
 a=('HKCR', (
     ('.sfv', (
         ('',STR,'sfv_auto_file'),
@@ -290,12 +526,12 @@ a=('HKCR', (
 
 
 def shellUnregister():
-    import _winreg, ctypes
+    import ctypes
     from ctypes.wintypes import DWORD, HKEY, LPCWSTR
     SHDeleteKeyW = ctypes.windll.shlwapi.SHDeleteKeyW
     SHDeleteKeyW.restype = DWORD
     SHDeleteKeyW.argtypes = [HKEY, LPCWSTR]
-    HKCR = _winreg.HKEY_CLASSES_ROOT
+    HKCR = winreg.HKEY_CLASSES_ROOT
     n1 = SHDeleteKeyW(HKCR, '.sfv')
     n2 = SHDeleteKeyW(HKCR, 'sfv_auto_file')
     return n1 == 0 and n2 == 0
@@ -305,6 +541,6 @@ def shellUnregister():
 ##sys.exit(main(sys.argv[1:]))
 try:
     sys.exit(main(sys.argv[1:]))
-except Exception, x:
+except Exception as x:
     errln(str(x))
     sys.exit(EXIT_FATAL)
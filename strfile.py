@@ -1,11 +1,186 @@
-"""Python implementation of Unix strfile."""
+"""Python implementation of Unix strfile.
+
+The output is the index format of Unix strfile, as read by fortune.Index:
+a header followed by a table of 32-bit big-endian string start offsets,
+with an extra final entry for the end of the last string. Normally,
+string i spans offsets i to i+1 (including its delimiter line). If the
+strings are ordered or randomized, only the start offsets are reordered
+and each string still extends up to its delimiter line.
+
+The source is read as a binary stream and only the offsets (and, when
+ordering, short sort keys) are kept in memory.
+"""
 
 import argparse
+import array
+import mmap
 import os
+import random
 import struct
 import sys
 
 
+HEADER = '>LLLLLc3s'
+HEADER_LEN = struct.calcsize(HEADER)
+VERSION = 1
+
+STR_RANDOM = 0x1
+STR_ORDERED = 0x2
+STR_ROTATED = 0x4
+
+# array typecode for unsigned 32-bit items
+UINT32 = 'L' if array.array('L').itemsize == 4 else 'I'
+
+# length of the string prefix used as the primary sort key;
+# strings with equal prefixes are then compared in full
+SORT_PREFIX_LEN = 64
+
+ROT13_TABLE = bytes.maketrans(
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz',
+    b'NOPQRSTUVWXYZABCDEFGHIJKLMnopqrstuvwxyzabcdefghijklm')
+
+
+class Stats(object):
+    """Summary of an index build."""
+    def __init__(self, count, minsize, maxsize, flags):
+        self.count = count
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.flags = flags
+
+
+def scan(f, delimiter, comments=False):
+    """Find the strings of a binary stream.
+
+    Returns an array of string start offsets, with an extra entry for the
+    end of the last string, and the min/max string size.
+    Sizes exclude the delimiter and comment lines.
+    """
+    delim_line = delimiter + b'\n'
+    comment_prefix = delimiter * 2
+    offsets = array.array(UINT32, [0])
+    minsize, maxsize = None, 0
+    curpos, size = 0, 0
+    for s in f:
+        curpos += len(s)
+        if s == delim_line:
+            offsets.append(curpos)
+        elif comments and s.startswith(comment_prefix):
+            continue
+        else:
+            size += len(s)
+            continue
+        if minsize is None or size < minsize:
+            minsize = size
+        if size > maxsize:
+            maxsize = size
+        size = 0
+    if curpos > offsets[-1]:
+        # last string without a delimiter line
+        offsets.append(curpos)
+        if minsize is None or size < minsize:
+            minsize = size
+        if size > maxsize:
+            maxsize = size
+    return offsets, minsize or 0, maxsize
+
+
+def sortkey(data, ignorecase, rot13):
+    """Normalize string data for ordering.
+
+    Initial non-alphanumeric characters are ignored.
+    """
+    if rot13:
+        data = data.translate(ROT13_TABLE)
+    i = 0
+    while i < len(data) and not data[i:i + 1].isalnum():
+        i += 1
+    data = data[i:]
+    return data.lower() if ignorecase else data
+
+
+def sortedoffsets(buf, offsets, ignorecase, rot13):
+    """Get the offset table with the strings in alphabetical order.
+
+    Strings are first sorted by a short prefix; runs with equal prefixes
+    are then sorted using the entire strings.
+    """
+    count = len(offsets) - 1
+    def prefix(i):
+        beg = offsets[i]
+        # also get some of the leading chars that will be skipped
+        end = min(offsets[i + 1], beg + 4 * SORT_PREFIX_LEN)
+        return sortkey(buf[beg:end], ignorecase, rot13)[:SORT_PREFIX_LEN]
+    def fullkey(i):
+        return sortkey(buf[offsets[i]:offsets[i + 1]], ignorecase, rot13)
+    keys = [prefix(i) for i in range(count)]
+    order = sorted(range(count), key=keys.__getitem__)
+    i = 0
+    while i < count:
+        j = i + 1
+        key = keys[order[i]]
+        while j < count and keys[order[j]] == key:
+            j += 1
+        if j - i > 1:
+            order[i:j] = sorted(order[i:j], key=fullkey)
+        i = j
+    del keys
+    return reordered(offsets, order)
+
+
+def reordered(offsets, order):
+    """Get the offset table with the string starts in the specified order.
+
+    The final entry (end of the last string) is kept in place.
+    """
+    ret = array.array(UINT32, (offsets[i] for i in order))
+    ret.append(offsets[-1])
+    return ret
+
+
+def build(source, output, delimiter='%', comments=False, ignorecase=False,
+          order=False, randomize=False, rot13=False):
+    """Create the index file of a strings file.
+
+    Returns a Stats object.
+    """
+    delim = delimiter.encode('ascii')
+    with open(source, 'rb') as f:
+        offsets, minsize, maxsize = scan(f, delim, comments)
+    if offsets[-1] >= 2**32:
+        raise ValueError('source file too large')
+    count = len(offsets) - 1
+
+    flags = STR_ROTATED if rot13 else 0
+    if randomize:
+        flags |= STR_RANDOM
+        indices = list(range(count))
+        random.shuffle(indices)
+        table = reordered(offsets, indices)
+    elif order and count:
+        flags |= STR_ORDERED
+        with open(source, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                table = sortedoffsets(buf, offsets, ignorecase, rot13)
+            finally:
+                buf.close()
+    else:
+        if order:
+            flags |= STR_ORDERED
+        table = offsets
+
+    if sys.byteorder == 'little':
+        table = array.array(UINT32, table)
+        table.byteswap()
+    with open(output, 'wb') as f:
+        f.write(struct.pack(HEADER, VERSION, count, maxsize, minsize, flags,
+                            delim, b'\0' * 3))
+        table.tofile(f)
+
+    return Stats(count, minsize, maxsize, flags)
+
+
 def parse_args():
     p = argparse.ArgumentParser(
         description='Implementation of Unix strfile command.'
@@ -15,7 +190,8 @@ def parse_args():
         dest='comments',
         action='store_true',
         help='Treat lines starting with two delimiter characters as comments. '
-             'Currently such comments are simply discarded.'
+             'Currently such comments are only excluded from the string '
+             'sizes.'
     )
     p.add_argument(
         '-c',
@@ -53,7 +229,8 @@ def parse_args():
         '-x',
         dest='rot13',
         action='store_true',
-        help='Rotate ASCII alphabetic characters by 13 positions (ROT13).'
+        help='Mark the strings as rotated by 13 positions (ROT13). '
+             'The source must already be rotated.'
     )
     p.add_argument(
         'source',
@@ -66,8 +243,8 @@ def parse_args():
              'with a ".dat" extension.'
     )
     args = p.parse_args()
-    if len(args.delimiter) != 1:
-        p.error('Delimiter must be a single character.')
+    if len(args.delimiter) != 1 or ord(args.delimiter) > 127:
+        p.error('Delimiter must be a single ASCII character.')
     if args.output is None:
         stem, ext = os.path.splitext(args.source)
         args.output = stem + '.dat'
@@ -81,57 +258,15 @@ def parse_args():
 if __name__ == '__main__':
     args = parse_args()
 
-    # TODO: handle options:
-    #   - ignorecase
-    #   - sort
-    #   - randomize
-    #   - rot13
-
-    HEADER = '>LLLLLc3s'
-    HEADER_LEN = struct.calcsize(HEADER)
-
-    fout = open(args.output, 'wb')
-    fout.write('\0' * HEADER_LEN)
-    fout.write(struct.pack('>L', 0))
-
-    count = 0
-    minsize = 2**31
-    maxsize = 0
-
-    delim_line = args.delim_line + '\n'
-
-    def is_comment_line(s, comments, delimiter):
-        return comments and s.startswith(delimiter * 2)
-
-    curpos, lastpos = 0, 0
-    fin = open(args.source, 'rt')
-    for s in fin:
-        curpos += len(s)
-        # TODO: may need to rework size calc to account for comments
-        if is_comment_line(s, args.comments, args.delimiter):
-            continue
-        if s == delim_line:
-            fout.write(struct.pack('>L', curpos))
-            count += 1
-            size = curpos - lastpos - 2
-            assert size >= 0, fin.tell()
-            if size < minsize: minsize = size
-            if size > maxsize: maxsize = size
-            lastpos = curpos
-
-    assert fin.tell() == lastpos, 'file does not end with a delimiter'
-
-    version = 1
-    flags = 0
-    delim = '%'
-    padding = '\0' * 3
-    hdr = struct.pack(HEADER, version, count, maxsize, minsize, flags, delim, padding)
-    fout.seek(0)
-    fout.write(hdr)
+    try:
+        stats = build(args.source, args.output, args.delimiter, args.comments,
+                      args.ignorecase, args.sort, args.randomize, args.rot13)
+    except (OSError, ValueError) as x:
+        sys.exit(str(x))
 
     if not args.silent:
         print('source:', args.source)
-        print('output:', args.ouput)
-        print('  entries: ', count)
-        print('  min size: ', minsize)
-        print('  max size: ', maxsize)
+        print('output:', args.output)
+        print('  entries: ', stats.count)
+        print('  min size: ', stats.minsize)
+        print('  max size: ', stats.maxsize)
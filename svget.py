@@ -4,14 +4,18 @@ import re
 import optparse
 import urllib2
 import socket
-import pickle
+import sqlite3
 import collections
+import threading
+import Queue
+import json
 import win32api
 import time
 import win32console
 import random
 
 import webdir
+import ratemeter
 import efutil
 import mathutil
 import console_stuff
@@ -21,9 +25,12 @@ import console_stuff
 TIMEOUT = 20  # timeout in seconds for urllib2's blocking operations
 TIMEOUT_RETRIES = 5  # times to retry timeouts
 PARTIAL_SUFFIX = '.PARTIAL'  # appended to partial downloads
-DEF_CACHEFILE = 'PAGECACHE'
+SEGMENTS_SUFFIX = '.SEGMENTS'  # appended to partial name for segment state
+TEMP_SUFFIX = '.TMP'  # appended to segment state while it's being written
+DEF_CACHEFILE = 'PAGECACHE.db'
 DEF_BUFSIZE_KB = 4
 IGNORE_DIRS = ['_vti_cnf/']
+RATE_HALFLIFE = 10  # seconds; weight half-life of speed measurements
 
 
 def safename(s):
@@ -42,46 +49,121 @@ def safename(s):
 class Cache(object):
     """Load/create an HTML page cache.
 
-    This is a mapping of URLs to HTML strings.
-    URLs that fail to load raise webdir.Error.
+    This is a mapping of URLs to HTML strings, stored in an SQLite database.
+    URLs that fail to load raise webdir.Error; these failures are cached too.
+
+    Each entry is written to disk when it is loaded. Entries older than
+    'ttl' seconds (None for no limit) are revalidated with the server,
+    using the ETag and Last-Modified headers of the original response.
+    If 'maxsize' is set, the least recently used entries are removed when
+    the total size of the stored pages exceeds it.
+
+    Pages are fetched through a webdir.ConnectionPool. Lookups are
+    thread-safe; the pool's requests are made outside the database lock.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY, data BLOB, error TEXT,
+            etag TEXT, modified TEXT, fetched REAL, used REAL, size INTEGER);
+        CREATE INDEX IF NOT EXISTS pages_used ON pages (used);
     """
 
-    def __init__(self, fpath):
+    def __init__(self, fpath, ttl=None, maxsize=None, pool=None):
         self.fpath = fpath
-        try:
-            self.pages = pickle.load(open(self.fpath, 'rb'))
-        except IOError:
-            self.pages = {}
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.pool = pool or webdir.ConnectionPool(timeout=TIMEOUT)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(fpath, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.totalsize = int(self.db.execute('SELECT TOTAL(size) FROM pages').fetchone()[0])
 
     def clear(self):
         """Clear cache."""
-        self.pages = {}
+        with self.lock:
+            self.db.execute('DELETE FROM pages')
+            self.db.commit()
+            self.totalsize = 0
 
     def flush(self):
-        """Write to disk."""
-        pickle.dump(self.pages, open(self.fpath, 'wb'), pickle.HIGHEST_PROTOCOL)
+        """Write pending changes (usage times) to disk."""
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
 
     def __getitem__(self, url):
         """Get cached page (load if necessary). May throw webdir.Error."""
-        try:
-            x = self.pages[url]
-            if isinstance(x, webdir.Error):
-                raise x
-            return x
-        except KeyError:
-            try:
-                data = urllib2.urlopen(url, timeout=TIMEOUT).read()
-                self.pages[url] = data
-                return data
-            except urllib2.HTTPError as err:
-                err = webdir.LoadError(str(err))
-                self.pages[url] = err
-                raise err
-            # Note that when urlopen times out, we get this (not an HTTPError):
-            # ...
-            #   File "C:\Program Files\Python26\lib\urllib2.py", line 1105, in do_open
-            #     raise URLError(err)
-            # urllib2.URLError: <urlopen error timed out>
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT data, error, etag, modified, fetched '
+                                  'FROM pages WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                data, error, etag, modified, fetched = row
+                if self.ttl is None or now - fetched < self.ttl:
+                    self.db.execute('UPDATE pages SET used = ? WHERE url = ?', (now, url))
+                    return self._result(data, error)
+            else:
+                data = error = etag = modified = None
+        headers = {}
+        if data is not None:
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        # network errors (e.g. socket.timeout) are not cached
+        status, reason, resp_headers, body = self.pool.request(url, headers)
+        with self.lock:
+            if status == 304:
+                # not modified
+                self.db.execute('UPDATE pages SET fetched = ?, used = ? WHERE url = ?',
+                                (now, now, url))
+                self.db.commit()
+                return self._result(data, error)
+            if status >= 400:
+                data, error, etag, modified = None, 'HTTP Error %d: %s' % (status, reason), None, None
+            else:
+                data, error = body, None
+                etag = resp_headers.get('etag')
+                modified = resp_headers.get('last-modified')
+            self._store(url, data, error, etag, modified, now)
+            return self._result(data, error)
+
+    @staticmethod
+    def _result(data, error):
+        if error is not None:
+            raise webdir.LoadError(error)
+        return str(data)
+
+    def _store(self, url, data, error, etag, modified, now):
+        size = len(data) if data is not None else 0
+        old = self.db.execute('SELECT size FROM pages WHERE url = ?', (url,)).fetchone()
+        if old is not None:
+            self.totalsize -= old[0]
+        self.db.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (url, sqlite3.Binary(data) if data is not None else None, error,
+             etag, modified, now, now, size))
+        self.totalsize += size
+        if self.maxsize is not None:
+            self._evict(url)
+        self.db.commit()
+
+    def _evict(self, keep):
+        """Remove least recently used pages until under the size limit."""
+        rows = self.db.execute('SELECT url, size FROM pages ORDER BY used')
+        evicted = []
+        for url, size in rows:
+            if self.totalsize <= self.maxsize:
+                break
+            if url != keep:
+                evicted.append((url,))
+                self.totalsize -= size
+        self.db.executemany('DELETE FROM pages WHERE url = ?', evicted)
 
 
 def percent(value, total):
@@ -109,9 +191,16 @@ def parse_cmdline():
 
     parser.add_option('-o', dest='outdir', default='.', metavar='DIR', help='Output directory. Default is "%default".')
     parser.add_option('-c', dest='cachefile', metavar='FILE', help='Page cache file. Default is "<output dir>\%s".' % DEF_CACHEFILE)
+    parser.add_option('--ttl', dest='cachettl', type='float', metavar='HOURS', help='Revalidate cached pages older than this. Default is to never revalidate.')
+    parser.add_option('--cachemax', dest='cachemax', type='int', metavar='MB', help='Maximum size of cached pages. Least recently used pages are removed when exceeded. Default is no limit.')
     parser.add_option('-a', dest='beep', action='store_true', help='Beep when downloading completes.')
     parser.add_option('-b', dest='bufsize', type='int', default=DEF_BUFSIZE_KB, help='Read buffer size in KB. Default is %default.')
+    parser.add_option('-j', dest='listthreads', type='int', default=8, metavar='N', help='Number of listing pages to read concurrently. Default is %default.')
+    parser.add_option('--hostconns', dest='hostconns', type='int', default=4, metavar='N', help='Maximum connections per host. Default is %default.')
     parser.add_option('--ile', dest='ignorelisterrors', action='store_true', help='Ignore listing errors.')
+    parser.add_option('--files', dest='filecount', type='int', default=1, metavar='N', help='Number of files to download concurrently. Default is %default.')
+    parser.add_option('--segments', dest='segments', type='int', default=1, metavar='N', help='Maximum number of concurrent byte range segments per file. Default is %default.')
+    parser.add_option('--minseg', dest='minsegsize', type='int', default=4, metavar='MB', help='Minimum segment size. Default is %default.')
     parser.add_option('--shuffle', dest='shuffle', action='store_true', help='Download files in random order (default is listing order).')
     parser.add_option('--all', dest='includeall', action='store_true', help='Include these directories, which are normally ignored: ' + ', '.join(IGNORE_DIRS))
     parser.add_option('-?', action='help', help='This help.')
@@ -139,6 +228,14 @@ def parse_cmdline():
         parser.error('exactly one param required')
     opts.topurl = args[0]
 
+    if opts.listthreads <= 0 or opts.hostconns <= 0:
+        parser.error('invalid number of threads/connections')
+    if opts.filecount <= 0 or opts.segments <= 0:
+        parser.error('invalid number of files/segments')
+    opts.minsegsize *= 2**20
+    if opts.minsegsize <= 0:
+        parser.error('invalid segment size')
+
     opts.bufsize *= 1024
     if opts.bufsize <= 0:
         parser.error('invalid buffer size')
@@ -161,6 +258,12 @@ def parse_cmdline():
 
     if not opts.cachefile:
         opts.cachefile = os.path.join(opts.outdir, DEF_CACHEFILE)
+    if opts.cachettl is not None:
+        opts.cachettl *= 3600
+    if opts.cachemax is not None:
+        if opts.cachemax <= 0:
+            parser.error('invalid cache size')
+        opts.cachemax *= 2**20
 
     return opts        
 
@@ -255,36 +358,11 @@ def filter_item(relpath, fname, opts):
     return True    
 
 
-class MovingAverage:
-    """Moving avarage (unweighted) calculator."""
-    
-    def __init__(self, winsize):
-        self.winsize = winsize
-        self.data = []
-        
-    def add(self, x, t):
-        """Add data."""
-        self.data.insert(0, (x, t))
-        
-    def get(self):
-        """Get current average."""
-        xsum, tsum = 0, 0
-        i = 0  # init in case data is empty
-        for i, (x, t) in enumerate(self.data):
-            xsum += x
-            tsum += t
-            if tsum >= self.winsize:
-                break
-        # discard data outside window
-        self.data[i+1:] = []
-        return xsum/tsum if tsum else 0
-
-
 def prettysize_compact(n, iec=False):
     return efutil.prettysize(n, iec).replace('bytes', '').rstrip('B').replace(' ', '')
 
 
-def download_resumable_file(src, dst, bufsize, totalsize, totaldone, movavg):
+def download_resumable_file(src, dst, bufsize, totalsize, totaldone, meter):
     """Download file with resume support.
 
     Returns a 3-tuple of sizes:
@@ -332,7 +410,7 @@ def download_resumable_file(src, dst, bufsize, totalsize, totaldone, movavg):
             ret_size = filesize
         
             while True:
-                speed = movavg.get()
+                speed = meter.rate()
 
                 file_eta = (filesize - filedone) / speed if speed else 0
                 if file_eta < 0: file_eta = 0
@@ -367,7 +445,7 @@ def download_resumable_file(src, dst, bufsize, totalsize, totaldone, movavg):
                 totaldone += len(s)
                 ret_done += len(s)
 
-                movavg.add(len(s), dt)
+                meter.add(len(s), dt)
 
                 f.write(s)
 
@@ -405,6 +483,279 @@ def download_resumable_file(src, dst, bufsize, totalsize, totaldone, movavg):
             spo.restore(eolclear=True)
     os.rename(partial_dst, dst)
     return ret_start, ret_done, ret_size
+
+
+def get_remote_size(src):
+    """Get the size of a remote file and whether it supports byte ranges.
+
+    Returns (size, ranges); size is None if not provided by the server.
+    """
+    req = urllib2.Request(src, headers={'Range':'bytes=0-0'})
+    conn = urllib2.urlopen(req, timeout=TIMEOUT)
+    try:
+        s = conn.headers.get('content-range')
+        if s:
+            m = re.match(r'^bytes (?:\d+-\d+|\*)/(\d+)$', s)
+            if m:
+                return int(m.group(1)), True
+        s = conn.headers.get('content-length')
+        return (int(s) if s else None), False
+    finally:
+        conn.close()
+
+
+def read_segment_state(fpath):
+    """Read a segment state file.
+
+    Returns (size, segments) or None if the file is missing or unreadable
+    (e.g. truncated by a kill). Falls back to the temporary file of an
+    interrupted replace.
+    """
+    for path in (fpath, fpath + TEMP_SUFFIX):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            return state['size'], state['segments']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+    return None
+
+
+def write_segment_state(fpath, size, segments):
+    """Replace a segment state file, so that it's never left incomplete."""
+    tmppath = fpath + TEMP_SUFFIX
+    with open(tmppath, 'w') as f:
+        json.dump({'size':size, 'segments':segments}, f)
+    try:
+        os.rename(tmppath, fpath)
+    except OSError:
+        # Windows can't rename over an existing file; if interrupted
+        # here, read_segment_state() uses the temporary file
+        os.remove(fpath)
+        os.rename(tmppath, fpath)
+
+
+def has_segment_state(fpath):
+    return os.path.exists(fpath) or os.path.exists(fpath + TEMP_SUFFIX)
+
+
+class SegmentedDownload(object):
+    """Download of a file in concurrent byte-range segments.
+
+    The data are written to a preallocated partial file. The progress of
+    each segment is saved in a state file next to it, so interrupted
+    downloads resume per segment. A partial file without a state file
+    (from download_resumable_file) is resumed as a single segment.
+    """
+
+    SAVE_INTERVAL = 5  # seconds between state file updates
+
+    def __init__(self, src, dst, bufsize, segments, minsegsize, progress):
+        self.src = src
+        self.dst = dst
+        self.partial = dst + PARTIAL_SUFFIX
+        self.statefile = self.partial + SEGMENTS_SUFFIX
+        self.bufsize = bufsize
+        self.segments = segments
+        self.minsegsize = minsegsize
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.state = None  # list of [start, end, done]
+        self.lastsave = 0
+        self.error = None
+        self.size = None
+        self.added = 0  # bytes downloaded by run()
+
+    def run(self):
+        """Download the file; returns True if completed."""
+        try:
+            size, ranges = get_remote_size(self.src)
+        except (socket.timeout, urllib2.URLError) as err:
+            self.error = err
+            return False
+        self.size = size
+        self.state = self._loadstate(size, ranges)
+        if self.state is None:
+            self.error = 'cannot resume or split (no byte range support)'
+            return False
+        # the size of a preallocated partial file says nothing about its
+        # progress, so the state must exist before preallocating
+        self._savestate(force=True)
+        if not os.path.exists(self.partial):
+            open(self.partial, 'wb').close()
+        if size is not None:
+            with open(self.partial, 'r+b') as f:
+                f.truncate(size)
+        threads = [threading.Thread(target=self._fetch, args=(seg,))
+                   for seg in self.state if seg[1] is None or seg[2] < seg[1] - seg[0]]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(1)
+        if self.error is not None:
+            self._savestate(force=True)
+            return False
+        for path in (self.statefile, self.statefile + TEMP_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rename(self.partial, self.dst)
+        return True
+
+    def _loadstate(self, size, ranges):
+        if has_segment_state(self.statefile):
+            # if unreadable or stale, the preallocated data can't be trusted
+            state = read_segment_state(self.statefile)
+            if state is not None and state[0] == size:
+                return state[1]
+        elif os.path.exists(self.partial):
+            done = os.path.getsize(self.partial)
+            if done and not ranges:
+                return None
+            return [[0, size, done]]
+        if size is None or not ranges:
+            # unknown size (read until closed) or single connection
+            return [[0, size, 0]]
+        count = max(1, min(self.segments, size // self.minsegsize))
+        bounds = [size * i // count for i in range(count + 1)]
+        return [[bounds[i], bounds[i+1], 0] for i in range(count)]
+
+    def _savestate(self, force=False):
+        with self.lock:
+            now = time.time()
+            if not force and now - self.lastsave < self.SAVE_INTERVAL:
+                return
+            self.lastsave = now
+            write_segment_state(self.statefile, self.size, self.state)
+
+    def _fetch(self, seg):
+        """Download one segment, retrying on timeouts."""
+        retries_left = TIMEOUT_RETRIES
+        # like download_resumable_file(), reopen the connection on timeouts
+        while True:
+            try:
+                self._fetchonce(seg)
+                return
+            except (socket.timeout, urllib2.URLError) as err:
+                timeout = isinstance(err, socket.timeout) or (
+                    not isinstance(err, urllib2.HTTPError) and isinstance(err.reason, socket.timeout))
+                if timeout and retries_left > 0:
+                    retries_left -= 1
+                    continue
+                self.error = err
+                return
+            except Exception as err:
+                self.error = err
+                return
+
+    def _fetchonce(self, seg):
+        # seg[2] (saved in the state file) is only advanced for data
+        # flushed to the partial file; buffered data may be lost on a kill
+        start, end, done = seg
+        pos = start + done
+        if end is None:
+            rng = 'bytes=%d-' % pos
+        else:
+            rng = 'bytes=%d-%d' % (pos, end - 1)
+        headers = {'Range':rng} if pos or end is not None else {}
+        conn = urllib2.urlopen(urllib2.Request(self.src, headers=headers), timeout=TIMEOUT)
+        try:
+            if pos and conn.getcode() != 206:
+                raise urllib2.URLError('server ignored byte range')
+            with open(self.partial, 'r+b') as f:
+                f.seek(pos)
+                lastflush = time.time()
+                try:
+                    while end is None or done < end - start:
+                        n = self.bufsize
+                        if end is not None:
+                            n = min(n, end - start - done)
+                        s = conn.read(n)
+                        if not s:
+                            break
+                        f.write(s)
+                        done += len(s)
+                        with self.lock:
+                            self.added += len(s)
+                        self.progress.add(len(s))
+                        if self.error is not None:
+                            # another segment failed
+                            return
+                        if time.time() - lastflush >= self.SAVE_INTERVAL:
+                            f.flush()
+                            seg[2] = done
+                            lastflush = time.time()
+                            self._savestate()
+                finally:
+                    f.flush()
+                    seg[2] = done
+            if end is not None and seg[2] < end - start:
+                raise socket.timeout('connection closed before end of segment')
+        finally:
+            conn.close()
+
+
+def download_files(items, bufsize, filecount, segments, minsegsize, progress):
+    """Download multiple files concurrently, optionally in segments.
+
+    Items are (src, dst, listing size) tuples. 'progress' is a
+    ratemeter.RateMeter shared by all transfers; the aggregate progress
+    is printed until done. Returns the list of incomplete dst paths.
+    """
+    tasks = Queue.Queue()
+    for item in items:
+        tasks.put(item)
+    incomplete = []
+    active = {}  # thread -> dst
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                src, dst, size = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            initial = getdownloadedsize(dst)
+            with lock:
+                active[threading.current_thread()] = dst
+            dl = SegmentedDownload(src, dst, bufsize, segments, minsegsize, progress)
+            ok = dl.run()
+            with lock:
+                del active[threading.current_thread()]
+                if not ok:
+                    incomplete.append(dst)
+                    spo.restore(eolclear=True)
+                    efutil.uprint(dst)
+                    print ' ', dl.error
+                    spo.reset()
+            # like the sequential download, count the whole file as done
+            # (whether completed or not), using the real size if known
+            progress.adjust((dl.size or size) - initial - dl.added)
+
+    spo = console_stuff.SamePosOutput(fallback=True)
+    threads = [threading.Thread(target=worker) for i in range(filecount)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            stats = progress.snapshot()
+            hr, min, sec = mathutil.multi_divmod(stats.eta or 0, 60, 60)
+            with lock:
+                spo.restore(eolclear=True)
+                print '  %.1f KB/s, Files: %d active, %d queued, Total: %s/%s (%s) %d:%02d:%02d' % (
+                    stats.rate/1024,
+                    len(active),
+                    tasks.qsize(),
+                    prettysize_compact(stats.done),
+                    prettysize_compact(stats.total),
+                    percent(stats.done, stats.total),
+                    hr, min, sec),
+            time.sleep(0.5)
+    finally:
+        spo.restore(eolclear=True)
+    return incomplete
             
 
 
@@ -483,6 +834,12 @@ def getdownloadedsize(fpath):
     """Get size of downloaded file or current partial size."""
     if os.path.exists(fpath):
         return os.path.getsize(fpath)
+    elif has_segment_state(fpath + PARTIAL_SUFFIX + SEGMENTS_SUFFIX):
+        # preallocated segmented download
+        state = read_segment_state(fpath + PARTIAL_SUFFIX + SEGMENTS_SUFFIX)
+        if state is None:
+            return 0  # will be restarted
+        return sum(done for start, end, done in state[1])
     elif os.path.exists(fpath + PARTIAL_SUFFIX):
         return os.path.getsize(fpath + PARTIAL_SUFFIX)
     else:
@@ -515,7 +872,8 @@ if __name__ == '__main__':
     cachedir = os.path.dirname(opt.cachefile)
     if not os.path.exists(cachedir):
         os.makedirs(cachedir)
-    cache = Cache(opt.cachefile)
+    pool = webdir.ConnectionPool(opt.hostconns, TIMEOUT)
+    cache = Cache(opt.cachefile, opt.cachettl, opt.cachemax, pool)
 
     try:
         totalsize = 0
@@ -526,7 +884,7 @@ if __name__ == '__main__':
         spo = console_stuff.SamePosOutput(fallback=True)
         conwidth = console_stuff.consolesize()[1]
         try:
-            for url, dirs, files in webdir.walk(opt.topurl, reader=myreader(cache), handler=myhandler(cache, spo, opt.ignorelisterrors)):
+            for url, dirs, files in webdir.pwalk(opt.topurl, reader=myreader(cache), handler=myhandler(cache, spo, opt.ignorelisterrors), threads=opt.listthreads):
                 relpath = url[len(opt.topurl):]
                 spo.restore(eolclear=True)
                 squeezeprint('reading: ', urllib2.unquote(url), conwidth)
@@ -622,23 +980,38 @@ if __name__ == '__main__':
             if opt.shuffle:
                 random.shuffle(filtered_items)
             incomplete = []
-            movavg = MovingAverage(30)  # speed counter
+            meter = ratemeter.RateMeter(RATE_HALFLIFE)  # speed counter
             try:
+                downloads = []
                 for relpath, f in filtered_items:
                     curoutdir = safename(urllib2.unquote(os.path.join(opt.outdir, relpath)))
                     if not os.path.exists(curoutdir):
                         os.makedirs(curoutdir)
                     src = opt.topurl + relpath + f.name
                     dst = safename(urllib2.unquote(os.path.join(opt.outdir, relpath + f.name)))
+                    if os.path.exists(dst):
+                        continue
+                    segmented = has_segment_state(dst + PARTIAL_SUFFIX + SEGMENTS_SUFFIX)
+                    if opt.filecount > 1 or opt.segments > 1:
+                        downloads += [(src, dst, f.size)]
+                        continue
                     efutil.uprint(safename(urllib2.unquote(relpath + f.name)))
-                    if not os.path.exists(dst):
-                        start, done, size = download_resumable_file(src, dst, opt.bufsize, totalsize, totaldone, movavg)
-                        if done != size:  # even if size is None
-                            incomplete += [dst]
-                        # subtract the initial partial size
-                        # and add the whole file size (whether completed or not)
-                        totaldone -= start
-                        totaldone += size or f.size
+                    if segmented:
+                        # preallocated partial file; resume its segments
+                        progress = ratemeter.RateMeter(RATE_HALFLIFE, totalsize, totaldone)
+                        incomplete += download_files([(src, dst, f.size)], opt.bufsize, 1, 1, opt.minsegsize, progress)
+                        totaldone = progress.done
+                        continue
+                    start, done, size = download_resumable_file(src, dst, opt.bufsize, totalsize, totaldone, meter)
+                    if done != size:  # even if size is None
+                        incomplete += [dst]
+                    # subtract the initial partial size
+                    # and add the whole file size (whether completed or not)
+                    totaldone -= start
+                    totaldone += size or f.size
+                if downloads:
+                    progress = ratemeter.RateMeter(RATE_HALFLIFE, totalsize, totaldone)
+                    incomplete += download_files(downloads, opt.bufsize, opt.filecount, opt.segments, opt.minsegsize, progress)
             finally:
                 if incomplete:
                     print 'Incomplete files:', len(incomplete)
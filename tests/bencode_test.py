@@ -0,0 +1,139 @@
+import io
+import os
+import tempfile
+import unittest
+
+import bencode
+
+
+SAMPLE = {
+    b'announce': b'http://tracker/announce',
+    b'info': {
+        b'name': b'test',
+        b'piece length': 262144,
+        b'pieces': bytes(range(256)) * 2,
+        b'files': [
+            {b'length': 0, b'path': [b'a', b'b.txt']},
+            {b'length': -12, b'path': [b'c:d']},
+        ],
+    },
+    b'list': [[], {}, b'', 0],
+}
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_roundtrip(self):
+        data = bencode.dumps(SAMPLE)
+        self.assertEqual(bencode.loads(data), SAMPLE)
+
+    def test_same_as_stream_reader(self):
+        data = bencode.dumps(SAMPLE)
+        self.assertEqual(bencode.loads(data), bencode.readany(io.BytesIO(data)))
+
+    def test_buffer_types(self):
+        data = bencode.dumps(SAMPLE)
+        self.assertEqual(bencode.loads(bytearray(data)), SAMPLE)
+        self.assertEqual(bencode.loads(memoryview(data)), SAMPLE)
+
+    def test_offsets(self):
+        data = b'xxi42e4:spam'
+        self.assertEqual(bencode.decode(data, 2), (42, 6))
+        self.assertEqual(bencode.decode(data, 6), (b'spam', 12))
+
+    def test_load_file(self):
+        data = bencode.dumps(SAMPLE)
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data + b'trailing')
+            self.assertEqual(bencode.load(path), SAMPLE)
+            with open(path, 'rb') as f:
+                self.assertEqual(bencode.load(f), SAMPLE)
+                self.assertEqual(f.read(), b'trailing')
+        finally:
+            os.unlink(path)
+
+    def test_errors(self):
+        for data in (b'', b'i42', b'l', b'5:abc', b'd3:key'):
+            with self.assertRaises(EOFError):
+                bencode.loads(data)
+        for data in (b'i-0e', b'i01e', b'ie', b'x', b'di1e1:ae',
+                     b'd-4:e', b'd:e', b'd1 :ai0ee', b'l1_0:0123456789e'):
+            with self.assertRaises(ValueError):
+                bencode.loads(data)
+
+
+class TestEncode(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(bencode.dumps(b'spam'), b'4:spam')
+        self.assertEqual(bencode.dumps(-3), b'i-3e')
+        self.assertEqual(bencode.dumps([b'', 0, []]), b'l0:i0elee')
+        self.assertEqual(bencode.dumps({b'b': 1, b'a': {}}), b'd1:ade1:bi1ee')
+
+    def test_chunks(self):
+        payload = b'x' * 1000
+        chunks = list(bencode.iterencode([payload]))
+        self.assertEqual(chunks, [b'l', b'1000:', payload, b'e'])
+        self.assertIs(chunks[2], payload)
+
+    def test_buffers(self):
+        self.assertEqual(bencode.dumps([bytearray(b'ab'), memoryview(b'cde')]),
+                         b'l2:ab3:cdee')
+
+    def test_deep_nesting(self):
+        obj = []
+        for _ in range(100000):
+            obj = [obj]
+        data = bencode.dumps(obj)
+        self.assertEqual(data, b'l' * 100001 + b'e' * 100001)
+
+    def test_dump_file(self):
+        f = io.BytesIO()
+        bencode.dump(f, SAMPLE)
+        self.assertEqual(f.getvalue(), bencode.dumps(SAMPLE))
+
+    def test_bad_key(self):
+        with self.assertRaises(TypeError):
+            bencode.dumps({1: 2})
+
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        self.data = bencode.dumps(SAMPLE)
+        self.obj = bencode.lazy(self.data)
+
+    def test_decode(self):
+        self.assertEqual(self.obj.decode(), SAMPLE)
+        self.assertEqual(self.obj.end, len(self.data))
+
+    def test_access(self):
+        info = self.obj[b'info']
+        self.assertIsInstance(info, bencode.LazyDict)
+        self.assertEqual(sorted(info), sorted(SAMPLE[b'info']))
+        self.assertEqual(info[b'piece length'], 262144)
+        files = info[b'files']
+        self.assertEqual(len(files), 2)
+        self.assertEqual(list(files[0][b'path']), [b'a', b'b.txt'])
+        self.assertEqual(files[1][b'length'], -12)
+        self.assertNotIn(b'missing', info)
+
+    def test_raw(self):
+        self.assertEqual(self.obj.rawitem(b'info'), bencode.dumps(SAMPLE[b'info']))
+        lst = self.obj[b'list']
+        self.assertEqual(lst.raw, bencode.dumps(SAMPLE[b'list']))
+        self.assertEqual(lst.rawitem(0), b'le')
+
+    def test_errors(self):
+        with self.assertRaises(EOFError):
+            len(bencode.lazy(b'd3:key'))
+        with self.assertRaises(ValueError):
+            len(bencode.lazy(b'li01ee'))
+        with self.assertRaises(ValueError):
+            len(bencode.lazy(b'l1_0:0123456789e'))
+
+
+if __name__ == '__main__':
+    unittest.main()
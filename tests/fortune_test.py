@@ -0,0 +1,58 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+import fortune
+import strfile
+
+
+SOURCE = (
+    b'The quick brown fox\n%\n'
+    b'jumps over\nthe lazy dog\n%\n'
+    b'Foxes are quick\n%\n'
+)
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'quotes')
+        self.write(SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        with open(self.source, 'wb') as f:
+            f.write(data)
+        strfile.build(self.source, fortune.indexname(self.source))
+
+    def search(self, pattern, usewords=True, flags=re.DOTALL):
+        rx = re.compile(pattern, flags)
+        return [(i, s) for _, i, s, _ in fortune.search(
+            [self.source], rx, fortune.SizeFilter(), usewords, 1)]
+
+    def test_same_as_scan(self):
+        for pattern in ('quick', 'Fox', 'ox', 'lazy dog', 'over.the', 'nothing'):
+            for flags in (re.DOTALL, re.DOTALL | re.IGNORECASE):
+                self.assertEqual(self.search(pattern, True, flags),
+                                 self.search(pattern, False, flags), pattern)
+
+    def test_index_file(self):
+        self.assertEqual([i for i, _ in self.search('quick')], [0, 2])
+        wdx = fortune.wordsname(fortune.indexname(self.source))
+        self.assertTrue(os.path.exists(wdx))
+
+    def test_rebuilt_when_changed(self):
+        self.assertEqual(self.search('cat'), [])
+        time.sleep(0.01)
+        self.write(SOURCE + b'A cat\n%\n')
+        self.assertEqual(self.search('cat'), [(3, 'A cat\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import overdisk
+
+
+DIR = stat.FILE_ATTRIBUTE_DIRECTORY
+FILE = stat.FILE_ATTRIBUTE_ARCHIVE
+
+# nested dicts are dirs; ints are file sizes
+SPEC = {
+    'a.txt': 10,
+    'sub': {'b.py': 5, 'deep': {'c.TXT': 7, 'd': 1}},
+    'z': {},
+    'e.py': 3,
+}
+
+
+def build(spec, name='root', tree=None, parent=-1):
+    """Build a Tree from a spec in pre-order."""
+    if tree is None:
+        tree = overdisk.Tree()
+    i = tree.append(parent, overdisk.ItemData(name, 0, DIR, 1.0, 2.0))
+    for key in sorted(spec):
+        if isinstance(spec[key], dict):
+            build(spec[key], key, tree, i)
+        else:
+            j = tree.append(i, overdisk.ItemData(key, spec[key], FILE, 1.0, 2.0))
+            tree.close(j)
+    tree.close(i)
+    return tree
+
+
+def dump(tree, i=0):
+    """Get the structure of a subtree as nested (name, size, children) tuples."""
+    return (tree.get_name(i), tree.size[i],
+            [dump(tree, j) for j in tree.children(i)])
+
+
+class TestTree(unittest.TestCase):
+
+    def assertSameTree(self, tree, expected):
+        self.assertEqual(list(tree.parent), list(expected.parent))
+        self.assertEqual(list(tree.end), list(expected.end))
+        self.assertEqual(dump(tree), dump(expected))
+        everything = overdisk.Filter(['*'])
+        for i in range(len(tree)):
+            if tree.is_dir(i):
+                self.assertEqual(vars(tree.get_list_stats(i, everything)),
+                                 vars(expected.get_list_stats(i, everything)))
+        self.assertEqual(
+            dict((k, vars(v)) for k, v in tree.get_ext_stats(0, everything).items()),
+            dict((k, vars(v)) for k, v in expected.get_ext_stats(0, everything).items()))
+
+    def test_build(self):
+        tree = build(SPEC)
+        self.assertEqual(len(tree), 9)
+        sub = tree.get_sub_path(0, 'sub')
+        self.assertEqual([tree.get_name(j) for j in tree.children(sub)], ['b.py', 'deep'])
+        stats = tree.get_list_stats(0, overdisk.Filter(['*']))
+        self.assertEqual((stats.dirs, stats.files, stats.bytes), (4, 5, 26))
+        exts = tree.get_ext_stats(0, overdisk.Filter(['*']))
+        self.assertEqual(exts['.txt'].files, 2)
+        self.assertEqual(exts['.txt'].bytes, 17)
+
+    def check_splice(self, new_sub):
+        tree = build(SPEC)
+        i = tree.get_sub_dir(0, 'sub')
+        tree.splice(i, build(new_sub, 'sub'))
+        self.assertSameTree(tree, build(dict(SPEC, sub=new_sub)))
+
+    def test_splice_larger(self):
+        self.check_splice({'b.py': 6, 'x': {'y.c': 2, 'w': {'v.h': 8}}, 'n.txt': 4})
+
+    def test_splice_smaller(self):
+        self.check_splice({'only.txt': 100})
+
+    def test_splice_empty(self):
+        self.check_splice({})
+
+    def test_splice_deep(self):
+        tree = build(SPEC)
+        i = tree.get_sub_path(0, 'sub/deep')
+        tree.splice(i, build({'new.bin': 9, 'more': {}}, 'deep'))
+        expected = dict(SPEC, sub={'b.py': 5, 'deep': {'new.bin': 9, 'more': {}}})
+        self.assertSameTree(tree, build(expected))
+
+    def test_graft(self):
+        tree = overdisk.Tree()
+        i = tree.append(-1, overdisk.ItemData('root', 0, DIR, 1.0, 2.0))
+        for key in sorted(SPEC):
+            if isinstance(SPEC[key], dict):
+                tree.graft(i, build(SPEC[key], key))
+            else:
+                tree.close(tree.append(i, overdisk.ItemData(key, SPEC[key], FILE, 1.0, 2.0)))
+        tree.close(i)
+        self.assertSameTree(tree, build(SPEC))
+
+
+class TestScandirScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # enough dirs at several levels to split the scan among threads
+        self.files = self.bytes = 0
+        for a in range(4):
+            for b in range(3):
+                for c in range(3):
+                    path = os.path.join(self.root, 'a%d' % a, 'b%d' % b, 'c%d' % c)
+                    os.makedirs(path)
+                    for n in range(c + 1):
+                        with open(os.path.join(path, 'f%d.txt' % n), 'wb') as f:
+                            f.write(b'x' * (a + n))
+                        self.files += 1
+                        self.bytes += a + n
+        with open(os.path.join(self.root, 'top.py'), 'wb') as f:
+            f.write(b'y' * 5)
+        self.files += 1
+        self.bytes += 5
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def scan(self, jobs):
+        errors = [overdisk.ScanError(startpath=self.root, messages=[])]
+        tree = overdisk.ScandirScanner(False, errors, None, jobs).scan(self.root)
+        self.assertEqual(errors[0].messages, [])
+        return tree
+
+    def test_same_tree_for_any_jobs(self):
+        tree1 = self.scan(1)
+        tree8 = self.scan(8)
+        self.assertEqual(list(tree1.parent), list(tree8.parent))
+        self.assertEqual(list(tree1.end), list(tree8.end))
+        self.assertEqual(list(tree1.attr), list(tree8.attr))
+        self.assertEqual(dump(tree1), dump(tree8))
+
+    def test_stats(self):
+        stats = self.scan(8).get_list_stats(0, overdisk.Filter(['*']))
+        self.assertEqual((stats.dirs, stats.files, stats.bytes),
+                         (1 + 4 + 4*3 + 4*3*3, self.files, self.bytes))
+
+
+if __name__ == '__main__':
+    unittest.main()
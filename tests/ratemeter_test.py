@@ -0,0 +1,49 @@
+import unittest
+
+import ratemeter
+
+
+class TestRateMeter(unittest.TestCase):
+
+    def test_constant_rate(self):
+        m = ratemeter.RateMeter(halflife=2)
+        for i in range(1000):
+            m.add(10, 0.01)
+        self.assertAlmostEqual(m.rate(), 1000)
+
+    def test_decay(self):
+        m = ratemeter.RateMeter(halflife=1)
+        for i in range(100):
+            m.add(1000, 0.1)
+        for i in range(300):
+            m.add(10, 0.1)
+        # old data have a negligible weight after 30 half-lives
+        self.assertAlmostEqual(m.rate(), 100, delta=1)
+
+    def test_snapshot(self):
+        m = ratemeter.RateMeter(total=1000, done=100)
+        m.add(400, 2)
+        stats = m.snapshot()
+        self.assertEqual(stats.done, 500)
+        self.assertEqual(stats.rate, 200)
+        self.assertEqual(stats.ratio, 0.5)
+        self.assertEqual(stats.eta, 2.5)
+
+    def test_unknown(self):
+        stats = ratemeter.RateMeter().snapshot()
+        self.assertEqual(stats.rate, 0)
+        self.assertIsNone(stats.eta)
+        self.assertIsNone(stats.ratio)
+        stats = ratemeter.RateMeter(total=10).snapshot()
+        self.assertIsNone(stats.eta)
+
+    def test_adjust(self):
+        m = ratemeter.RateMeter(total=100)
+        m.add(10, 1)
+        m.adjust(50)
+        self.assertEqual(m.snapshot().done, 60)
+        self.assertEqual(m.rate(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
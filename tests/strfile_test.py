@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import fortune
+import strfile
+
+
+SOURCE = (
+    u'Zebra crossing.\n%\n'
+    u'"apple" pie\nwith two lines\n%\n'
+    u'éclair, non-ASCII\n%\n'
+    u'Banana\n%\n'
+).encode('utf-8')
+
+
+class TestBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'quotes')
+        self.output = os.path.join(self.tmpdir, 'quotes.dat')
+        with open(self.source, 'wb') as f:
+            f.write(SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        ndx = fortune.Index(self.output)
+        return ndx, list(fortune.File(self.source, ndx))
+
+    def test_plain(self):
+        stats = strfile.build(self.source, self.output)
+        ndx, strings = self.read()
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(len(ndx), 4)
+        self.assertEqual(strings[0], u'Zebra crossing.\n')
+        self.assertEqual(strings[2], u'éclair, non-ASCII\n')
+        self.assertEqual(ndx.minlen, len(b'Banana\n'))
+        self.assertEqual(ndx.maxlen, len(b'"apple" pie\nwith two lines\n'))
+
+    def test_sizes_match_index(self):
+        strfile.build(self.source, self.output)
+        ndx, strings = self.read()
+        sizes = [end - beg - 2 for beg, end in ndx]
+        self.assertEqual(ndx.minlen, min(sizes))
+        self.assertEqual(ndx.maxlen, max(sizes))
+
+    def test_missing_last_delimiter(self):
+        with open(self.source, 'ab') as f:
+            f.write(b'last')
+        strfile.build(self.source, self.output)
+        ndx, strings = self.read()
+        self.assertEqual(strings[-1], u'last')
+
+    def test_ordered(self):
+        strfile.build(self.source, self.output, order=True)
+        ndx, strings = self.read()
+        self.assertTrue(ndx.flags & fortune.Index.STR_ORDERED)
+        self.assertEqual([s[:3] for s in strings],
+                         [u'Ban', u'Zeb', u'"ap', u'écl'])
+
+    def test_ordered_ignorecase(self):
+        strfile.build(self.source, self.output, order=True, ignorecase=True)
+        ndx, strings = self.read()
+        self.assertEqual([s[:3] for s in strings],
+                         [u'"ap', u'Ban', u'écl', u'Zeb'])
+
+    def test_ordered_long_common_prefix(self):
+        prefix = b'x' * (2 * strfile.SORT_PREFIX_LEN)
+        with open(self.source, 'wb') as f:
+            f.write(prefix + b'b\n%\n' + prefix + b'a\n%\n')
+        strfile.build(self.source, self.output, order=True)
+        ndx, strings = self.read()
+        self.assertEqual([s[-2] for s in strings], [u'a', u'b'])
+
+    def test_randomized(self):
+        strfile.build(self.source, self.output, randomize=True)
+        ndx, strings = self.read()
+        self.assertTrue(ndx.flags & fortune.Index.STR_RANDOM)
+        strfile.build(self.source, self.output + '.plain')
+        plain = list(fortune.File(self.source, fortune.Index(self.output + '.plain')))
+        self.assertEqual(sorted(strings), sorted(plain))
+
+    def test_reordered_layout(self):
+        # as in Unix strfile, only the starts are reordered
+        strfile.build(self.source, self.output + '.plain')
+        plain = fortune.Index(self.output + '.plain')
+        for kw in ({'order': True}, {'randomize': True}):
+            strfile.build(self.source, self.output, **kw)
+            ndx = fortune.Index(self.output)
+            self.assertEqual(len(ndx.offsets), ndx.count + 1)
+            self.assertEqual(ndx.offsets[-1], len(SOURCE))
+            self.assertEqual(sorted(ndx), list(plain))
+
+    def test_rot13(self):
+        with open(self.source, 'wb') as f:
+            f.write(b'Uryyb\n%\n')
+        strfile.build(self.source, self.output, rot13=True)
+        ndx, strings = self.read()
+        self.assertEqual(strings, [u'Hello\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
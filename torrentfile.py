@@ -1,7 +1,9 @@
 #!python
 """Torrent file utilities.
 
-When run as a script, it displays various types of information.
+When run as a script, it displays various types of information,
+verifies downloaded data against the torrent's piece hashes, or
+maintains and searches an SQLite catalog of a torrent library.
 """
 
 from __future__ import print_function
@@ -14,6 +16,12 @@ import pprint
 import argparse
 import glob
 import codecs
+import collections
+import concurrent.futures
+import json
+import mmap
+import sqlite3
+import time
 
 
 try:
@@ -26,11 +34,16 @@ def calchash(obj):
     """String hash of a torrent bencode object.
 
     This is the SHA1 hexdigest of the 'info' dict.
+    If obj is a bencode.LazyDict, the original bytes of the info dict are
+    hashed directly, instead of decoding and re-encoding them.
     Source:
         Index >> Protocol Design Discussion >> How to get Hash out of .torrent file ?
         http://forum.utorrent.com/viewtopic.php?id=47411
     """
-    data = bencode.dumps(obj[b'info'])
+    if isinstance(obj, bencode.LazyDict):
+        data = obj.rawitem(b'info')
+    else:
+        data = bencode.dumps(obj[b'info'])
     return hashlib.sha1(data).hexdigest()
 
 
@@ -43,6 +56,359 @@ def filesinfo(obj):
         yield obj[b'info'][b'name'], obj[b'info'][b'length']
 
 
+VERIFY_BUFLEN = 4 * 2**20
+MMAP_MIN_SIZE = 64 * 2**20  # larger files are memory-mapped when verifying
+PROGRESS_SAVE_SEC = 10
+
+
+class PieceHasher(object):
+    """Check the data stream of a torrent against its piece hashes.
+
+    Data are fed sequentially (across file boundaries) and each piece is
+    hashed on a thread pool as soon as it's complete. Missing data are
+    skipped, marking the affected pieces as bad. Pieces lying completely
+    inside a single fed buffer (e.g. a memoryview of an mmap) are hashed
+    without copying, so buffers must stay valid until wait() is called.
+    """
+
+    def __init__(self, piece_length, piece_hashes, total_length, pool,
+                 first_piece=0, maxpending=16):
+        self.piece_length = piece_length
+        self.piece_hashes = piece_hashes
+        self.total_length = total_length
+        self.pool = pool
+        self.maxpending = maxpending
+        self.index = first_piece  # current piece
+        self.buf = bytearray()
+        self.filled = 0  # bytes of current piece (in buf, unless broken)
+        self.broken = False  # current piece has missing data
+        self.pending = collections.deque()  # (index, future)
+        self.bad = set()
+        self.done = set()  # completed indices above prefix
+        self.prefix = first_piece  # all pieces before this are completed
+
+    def piece_size(self, index):
+        return min(self.piece_length, self.total_length - index * self.piece_length)
+
+    def feed(self, data):
+        """Process the next bytes of the stream."""
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            need = self.piece_size(self.index) - self.filled
+            take = min(need, len(view) - pos)
+            if self.broken:
+                pass
+            elif self.filled == 0 and take == need:
+                self._submit(view[pos:pos+take])  # no copy
+            else:
+                self.buf += view[pos:pos+take]
+            self.filled += take
+            pos += take
+            if self.filled == self.piece_size(self.index):
+                if not self.broken and self.buf:
+                    self._submit(bytes(self.buf))
+                elif self.broken:
+                    self._complete(self.index, False)
+                self._next()
+
+    def skip(self, size):
+        """Skip missing bytes of the stream."""
+        while size > 0:
+            self.broken = True
+            take = min(size, self.piece_size(self.index) - self.filled)
+            self.filled += take
+            size -= take
+            if self.filled == self.piece_size(self.index):
+                self._complete(self.index, False)
+                self._next()
+
+    def wait(self):
+        """Wait for all pending hashes."""
+        while self.pending:
+            self._collect()
+
+    def _next(self):
+        self.index += 1
+        self.buf = bytearray()
+        self.filled = 0
+        self.broken = False
+
+    def _submit(self, data):
+        while len(self.pending) >= self.maxpending:
+            self._collect()
+        self.pending.append((self.index, self.pool.submit(sha1digest, data)))
+
+    def _collect(self):
+        index, future = self.pending.popleft()
+        expected = self.piece_hashes[index*20:index*20+20]
+        self._complete(index, future.result() == expected)
+
+    def _complete(self, index, ok):
+        if not ok:
+            self.bad.add(index)
+        self.done.add(index)
+        while self.prefix in self.done:
+            self.done.remove(self.prefix)
+            self.prefix += 1
+
+
+def sha1digest(data):
+    """SHA1 digest of a buffer. Memoryviews are released afterwards."""
+    try:
+        return hashlib.sha1(data).digest()
+    finally:
+        if isinstance(data, memoryview):
+            data.release()
+
+
+def piece_ranges(indices):
+    """Format a sorted list of piece indices as a list of ranges."""
+    ret = []
+    for i in indices:
+        if ret and ret[-1][1] == i - 1:
+            ret[-1][1] = i
+        else:
+            ret.append([i, i])
+    return ', '.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ret)
+
+
+def datafiles(obj, datadir, decoder):
+    """Generate the local path and size of each file of a torrent."""
+    name = decoder(obj[b'info'][b'name'])[0]
+    if b'files' in obj[b'info']:
+        for item_path, size in filesinfo(obj):
+            yield os.path.join(datadir, name, decoder(item_path)[0]), size
+    else:
+        yield os.path.join(datadir, name), obj[b'info'][b'length']
+
+
+def verify(obj, datadir, decoder, jobs, progress_path=None):
+    """Verify the local data of a torrent against its piece hashes.
+
+    Each file is read once, sequentially; large files are memory-mapped.
+    If progress_path is specified, verification state is periodically
+    saved there and, if the local files are unchanged, it resumes from
+    where it stopped.
+
+    Returns a list of (path, size, good piece count, piece count, bad
+    piece indices) for each file.
+    """
+    info = obj[b'info']
+    piece_length = info[b'piece length']
+    piece_hashes = info[b'pieces']
+    files = list(datafiles(obj, datadir, decoder))
+    total_length = sum(size for _, size in files)
+    infohash = calchash(obj)
+
+    def stat(path):
+        try:
+            st = os.stat(path)
+            return [st.st_size, st.st_mtime_ns]
+        except OSError:
+            return None
+    stats = [stat(path) for path, _ in files]
+
+    first_piece, bad = 0, set()
+    if progress_path:
+        try:
+            with open(progress_path) as f:
+                state = json.load(f)
+            if state['infohash'] == infohash and state['stats'] == stats:
+                first_piece, bad = state['prefix'], set(state['bad'])
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(hasher):
+        if progress_path:
+            state = {'infohash': infohash, 'stats': stats, 'prefix': hasher.prefix,
+                     'bad': sorted(i for i in hasher.bad if i < hasher.prefix)}
+            with open(progress_path, 'w') as f:
+                json.dump(state, f)
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        hasher = PieceHasher(piece_length, piece_hashes, total_length, pool,
+                             first_piece, maxpending=jobs * 4)
+        hasher.bad |= bad
+        last_save = time.time()
+        start = first_piece * piece_length  # stream offset to resume from
+        offset = 0  # stream offset of current file
+        try:
+            for path, size in files:
+                if offset + size <= start:
+                    offset += size
+                    continue
+                skip = max(0, start - offset)
+                try:
+                    f = open(path, 'rb')
+                except IOError:
+                    hasher.skip(size - skip)
+                    offset += size
+                    continue
+                with f:
+                    fsize = os.fstat(f.fileno()).st_size
+                    avail = max(0, min(size, fsize) - skip)
+                    if avail >= MMAP_MIN_SIZE:
+                        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                            view = memoryview(m)
+                            try:
+                                for i in range(skip, skip + avail, VERIFY_BUFLEN):
+                                    hasher.feed(view[i:min(i + VERIFY_BUFLEN, skip + avail)])
+                            finally:
+                                hasher.wait()  # before unmapping
+                                view.release()
+                    else:
+                        f.seek(skip)
+                        left = avail
+                        while left > 0:
+                            data = f.read(min(VERIFY_BUFLEN, left))
+                            if not data:
+                                break
+                            hasher.feed(data)
+                            left -= len(data)
+                        avail -= left
+                hasher.skip(size - skip - avail)  # missing tail of short file
+                offset += size
+                if time.time() - last_save >= PROGRESS_SAVE_SEC:
+                    save(hasher)
+                    last_save = time.time()
+            hasher.wait()
+        finally:
+            hasher.wait()
+            save(hasher)
+
+    ret = []
+    offset = 0
+    for path, size in files:
+        if size:
+            first, last = offset // piece_length, (offset + size - 1) // piece_length
+            badlist = sorted(i for i in hasher.bad if first <= i <= last)
+            count = last - first + 1
+        else:
+            badlist, count = [], 0
+        ret.append((path, size, count - len(badlist), count, badlist))
+        offset += size
+    return ret
+
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime INTEGER,
+    infohash TEXT, name TEXT, size INTEGER);
+CREATE TABLE IF NOT EXISTS files (torrent INTEGER, path TEXT, size INTEGER);
+CREATE INDEX IF NOT EXISTS torrents_infohash ON torrents (infohash);
+CREATE INDEX IF NOT EXISTS files_torrent ON files (torrent);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+"""
+
+
+def catalog_entry(path, encoding):
+    """Parse a torrent for the catalog.
+
+    Returns (path, mtime, infohash, name, total size, [(file path, size)]),
+    with names decoded using the specified encoding.
+    Module-level, so that it can be used by a process pool.
+    """
+    with open(path, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+        data = f.read()
+    obj = bencode.loads(data)
+    infohash = calchash(bencode.lazy(data))
+    decode = lambda s: s.decode(encoding, 'replace')
+    files = [(decode(item_path), size) for item_path, size in filesinfo(obj)]
+    return (path, mtime, infohash, decode(obj[b'info'][b'name']),
+            sum(size for _, size in files), files)
+
+
+def open_catalog(path):
+    db = sqlite3.connect(path)
+    db.executescript(CATALOG_SCHEMA)
+    return db
+
+
+def update_catalog(db, paths, encoding, jobs):
+    """Add new or modified torrents to a catalog, parsing them in parallel.
+
+    Entries of torrents that no longer exist are removed.
+    Returns the counts of added/updated, unchanged, removed and failed torrents.
+    """
+    known = dict(db.execute('SELECT path, mtime FROM torrents'))
+    todo = []
+    unchanged = 0
+    for path in paths:
+        path = os.path.abspath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as x:
+            print('could not access "%s"; %s' % (path, x), file=sys.stderr)
+            continue
+        if known.get(path) == mtime:
+            unchanged += 1
+        else:
+            todo.append(path)
+
+    updated, failed = 0, 0
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = [(path, pool.submit(catalog_entry, path, encoding)) for path in todo]
+        for path, future in futures:
+            try:
+                path, mtime, infohash, name, size, files = future.result()
+            except Exception as x:
+                print('could not load "%s"; %s' % (path, x), file=sys.stderr)
+                failed += 1
+                continue
+            remove_catalog_entry(db, path)
+            cur = db.execute(
+                'INSERT INTO torrents (path, mtime, infohash, name, size) '
+                'VALUES (?, ?, ?, ?, ?)', (path, mtime, infohash, name, size))
+            db.executemany('INSERT INTO files VALUES (?, ?, ?)',
+                           ((cur.lastrowid, s, n) for s, n in files))
+            updated += 1
+
+    removed = 0
+    for path in list(known):
+        if not os.path.exists(path):
+            remove_catalog_entry(db, path)
+            removed += 1
+    db.commit()
+    return updated, unchanged, removed, failed
+
+
+def remove_catalog_entry(db, path):
+    for (id,) in db.execute('SELECT id FROM torrents WHERE path = ?', (path,)).fetchall():
+        db.execute('DELETE FROM files WHERE torrent = ?', (id,))
+        db.execute('DELETE FROM torrents WHERE id = ?', (id,))
+
+
+def query_catalog(db, path=None, size=None, infohash=None):
+    """Search a catalog for torrents containing files that match the specified
+    path substring (case-insensitive) and/or size, or torrents with the
+    specified hash.
+
+    Generates (torrent path, infohash, file path, file size) tuples; file
+    path and size are None when searching by hash only.
+    """
+    if path is None and size is None:
+        for row in db.execute('SELECT path, infohash FROM torrents WHERE infohash = ?',
+                              (infohash.lower(),)):
+            yield row + (None, None)
+        return
+    sql = ('SELECT t.path, t.infohash, f.path, f.size FROM files f '
+           'JOIN torrents t ON t.id = f.torrent WHERE 1')
+    params = []
+    if path is not None:
+        sql += " AND f.path LIKE ? ESCAPE '\\'"
+        params.append('%' + path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if size is not None:
+        sql += ' AND f.size = ?'
+        params.append(size)
+    if infohash is not None:
+        sql += ' AND t.infohash = ?'
+        params.append(infohash.lower())
+    for row in db.execute(sql + ' ORDER BY t.path, f.path', params):
+        yield row
+
+
 def parse_args():
     ap = argparse.ArgumentParser(description='print torrent contents')
     ap.add_argument('patterns', metavar='FILE', nargs='*',
@@ -52,9 +418,36 @@ def parse_args():
                        help='print torrent hash and path instead')
     group.add_argument('-l', dest='listing', action='store_true',
                        help='print list of file sizes and paths instead')
-    group.add_argument('-e', dest='decoder', default='utf-8',
-                       help='encoding for decoding path names in list; default: %(default)s')
+    group.add_argument('-c', dest='datadir',
+                       help='check the downloaded data in the specified directory '
+                       'against the torrent\'s piece hashes instead')
+    group.add_argument('--index', action='store_true',
+                       help='add new or modified torrents to the catalog '
+                       'specified by --db instead (parsing them in parallel)')
+    ap.add_argument('-e', dest='decoder', default='utf-8',
+                    help='encoding for decoding path names; default: %(default)s')
+    ap.add_argument('-j', dest='jobs', type=int, default=os.cpu_count() or 1,
+                    metavar='N', help='number of hashing threads for -c, '
+                    'or parsing processes for --index; default: number of CPUs')
+    ap.add_argument('--progress', metavar='FILE',
+                    help='file for saving the state of -c, so that it can be '
+                    'resumed if interrupted (only for a single torrent)')
+    ap.add_argument('--db', metavar='FILE',
+                    help='torrent catalog database for --index and queries')
+    ap.add_argument('--find-path', metavar='TEXT',
+                    help='list catalog files whose path contains TEXT')
+    ap.add_argument('--find-size', metavar='N', type=int,
+                    help='list catalog files whose size is N bytes')
+    ap.add_argument('--find-hash', metavar='HASH',
+                    help='list catalog torrents with the specified info hash')
     args = ap.parse_args()
+    if args.jobs < 1:
+        ap.error('number of threads/processes must be positive')
+    args.query = (args.find_path is not None or args.find_size is not None or
+                  args.find_hash is not None)
+    if (args.index or args.query) and not args.db:
+        ap.error('--db is required for --index and queries')
+    args.encoding = args.decoder
     try:
         args.decoder = codecs.getdecoder(args.decoder)
     except LookupError as x:
@@ -79,10 +472,29 @@ def gen_file_paths(patterns):
 if __name__ == '__main__':
     args = parse_args()
 
+    if args.query:
+        db = open_catalog(args.db)
+        for row in query_catalog(db, args.find_path, args.find_size, args.find_hash):
+            torrent, infohash, item_path, size = row
+            if item_path is None:
+                print(infohash, torrent)
+            else:
+                print('%s  %15d  %s' % (torrent, size, item_path))
+        sys.exit()
+
+    if args.index:
+        db = open_catalog(args.db)
+        counts = update_catalog(db, gen_file_paths(args.patterns), args.encoding, args.jobs)
+        print('torrents added/updated: %d, unchanged: %d, removed: %d, failed: %d' % counts)
+        sys.exit()
+
     for path in gen_file_paths(args.patterns):
 
         try:
-            obj = bencode.load(open(path, 'rb'))
+            if args.hashes:
+                obj = bencode.lazyload(path)
+            else:
+                obj = bencode.load(path)
         except Exception as x:
             print('could not load "%s"; %s' % (path, x), file=sys.stderr)
             continue
@@ -95,6 +507,22 @@ if __name__ == '__main__':
             else:
                 print(hash, path)
 
+        elif args.datadir:
+            try:
+                results = verify(obj, args.datadir, args.decoder, args.jobs, args.progress)
+            except Exception as x:
+                print('could not verify "%s"; %s' % (path, x), file=sys.stderr)
+                continue
+            print(path)
+            for item_path, size, good, count, bad in results:
+                percent = 100.0 * good / count if count else 100.0
+                print('  %6.1f%%  %s' % (percent, item_path))
+                if bad:
+                    print('           bad pieces: %s' % piece_ranges(bad))
+            pieces = len(obj[b'info'][b'pieces']) // 20
+            bad = set(i for r in results for i in r[4])
+            print('  pieces good/total: %d/%d' % (pieces - len(bad), pieces))
+
         elif args.listing:            
             print(path)
             for item_path, size in filesinfo(obj):
@@ -1,6 +1,12 @@
 """Utilities for server directory listings."""
 
 import urllib2
+import urlparse
+import httplib
+import base64
+import socket
+import threading
+import Queue
 import BeautifulSoup
 import re
 import collections
@@ -36,13 +42,8 @@ def stdhandler(err, url):
     """Default error handler prints to stderr."""
     print >>sys.stderr, err, url
 
-def walk(top, reader=stdreader, handler=stdhandler):
-    try:
-        html = reader(top)
-        _url, items = pagelist(html)
-    except Error as err:
-        handler(err, top)
-        return
+def _splititems(items):
+    """Split listing items into subdirs and files."""
     dirs, files = [], []
     for item in items:
         if item.name.endswith('/'):  # dir entry
@@ -51,11 +52,225 @@ def walk(top, reader=stdreader, handler=stdhandler):
                 dirs += [item]
         else:
             files += [item]
+    return dirs, files
+
+def walk(top, reader=stdreader, handler=stdhandler):
+    try:
+        html = reader(top)
+        _url, items = pagelist(html)
+    except Error as err:
+        handler(err, top)
+        return
+    dirs, files = _splititems(items)
     yield top, dirs, files
     for dir in dirs:
         for x,y,z in walk(top + dir.name, reader, handler):
             yield x,y,z
 
+class _ReadAhead(object):
+    """Thread pool that reads pages in the background.
+
+    Requests are served last-in-first-out, so that the most recently
+    submitted pages (the ones needed next by a depth-first walk) are read first.
+    """
+
+    def __init__(self, reader, threads):
+        self.reader = reader
+        self.tasks = Queue.LifoQueue()
+        self.results = {}
+        self.cond = threading.Condition()
+        self.nextticket = 0
+        self.closed = False
+        self.threads = threads
+        for i in range(threads):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            ticket, url = self.tasks.get()
+            if self.closed:
+                return
+            try:
+                result = True, self.reader(url)
+            except Exception as err:
+                result = False, err
+            with self.cond:
+                self.results[ticket] = result
+                self.cond.notify_all()
+
+    def submit(self, url):
+        """Queue a page for reading and return a ticket for result()."""
+        ticket = self.nextticket
+        self.nextticket += 1
+        self.tasks.put((ticket, url))
+        return ticket
+
+    def result(self, ticket):
+        """Wait for a page and return it or raise the reader's exception."""
+        with self.cond:
+            while ticket not in self.results:
+                self.cond.wait()
+            ok, value = self.results.pop(ticket)
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        self.closed = True
+        # wake up idle threads; with a LIFO queue these come out first
+        for i in range(self.threads):
+            self.tasks.put((None, None))
+
+def pwalk(top, reader=stdreader, handler=stdhandler, threads=8):
+    """Like walk(), but with pages read concurrently by a pool of threads.
+
+    While the caller processes a directory, the pages of its subdirs are
+    read ahead. Items are generated in the same order as walk(), and
+    removing items from 'dirs' still prevents walking into them.
+    The reader must be thread-safe.
+    """
+    pool = _ReadAhead(reader, threads)
+    try:
+        stack = [(top, pool.submit(top))]
+        while stack:
+            url, ticket = stack.pop()
+            try:
+                html = pool.result(ticket)
+                _url, items = pagelist(html)
+                dirs, files = _splititems(items)
+            except Error as err:
+                handler(err, url)
+                continue
+            yield url, dirs, files
+            # push/submit in reverse, so the first subdir is walked first
+            for dir in reversed(dirs):
+                suburl = url + dir.name
+                stack.append((suburl, pool.submit(suburl)))
+    finally:
+        pool.close()
+
+class ConnectionPool(object):
+    """Reusable (keep-alive) HTTP connections, with a per-host limit.
+
+    Thread-safe; requests to a host block while 'perhost' connections
+    to it are busy.
+
+    Proxies are taken from 'proxies' (a scheme:URL dict), by default from
+    the environment, like urllib2.urlopen(); http requests are sent to the
+    proxy with absolute URLs and https ones through a CONNECT tunnel.
+    """
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+    MAX_REDIRECTS = 5
+
+    # conditional request headers; they refer to the original URL,
+    # so they're not sent to redirect targets
+    VALIDATORS = ('if-none-match', 'if-modified-since')
+
+    def __init__(self, perhost=4, timeout=None, proxies=None):
+        self.perhost = perhost
+        self.timeout = timeout
+        self.proxies = urllib2.getproxies() if proxies is None else proxies
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.slots = {}
+
+    def request(self, url, headers=None):
+        """GET a URL, following redirects.
+
+        Returns (status, reason, headers, body); header names are lowercase.
+        Network errors raise socket.error or httplib.HTTPException.
+        """
+        headers = headers or {}
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            key, target = self._route(parts)
+            with self._slot((parts.scheme, parts.netloc)):
+                status, reason, resp_headers, data = self._request(key, target, headers)
+            if status in self.REDIRECTS and 'location' in resp_headers:
+                url = urlparse.urljoin(url, resp_headers['location'])
+                headers = dict((k, v) for k, v in headers.items()
+                               if k.lower() not in self.VALIDATORS)
+                continue
+            return status, reason, resp_headers, data
+        raise LoadError('too many redirects: %s' % url)
+
+    def _slot(self, key):
+        with self.lock:
+            try:
+                return self.slots[key]
+            except KeyError:
+                ret = self.slots[key] = threading.BoundedSemaphore(self.perhost)
+                return ret
+
+    def _route(self, parts):
+        """Get the connection key and request target of a split URL.
+
+        Keys are (scheme, host, tunnel, proxyauth); host is the proxy
+        (if any), tunnel the target host of an https proxy tunnel and
+        proxyauth the Proxy-Authorization header value (or None).
+        """
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        proxy = self.proxies.get(parts.scheme)
+        if not proxy or urllib2.proxy_bypass(parts.hostname or ''):
+            return (parts.scheme, parts.netloc, None, None), path
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy = urlparse.urlsplit(proxy)
+        auth = None
+        if proxy.username is not None:
+            userpass = '%s:%s' % (urllib2.unquote(proxy.username),
+                                  urllib2.unquote(proxy.password or ''))
+            auth = 'Basic ' + base64.b64encode(userpass)
+        host = proxy.netloc.rpartition('@')[2]
+        if parts.scheme == 'https':
+            return ('https', host, parts.netloc, auth), path
+        return ('http', host, None, auth), urlparse.urlunsplit(parts[:4] + ('',))
+
+    def _connect(self, key):
+        scheme, host, tunnel, auth = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+            if tunnel:
+                conn.set_tunnel(tunnel, headers={'Proxy-Authorization': auth} if auth else None)
+            return conn
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _request(self, key, path, headers):
+        if key[3] and not key[2]:
+            headers = dict(headers, **{'Proxy-Authorization': key[3]})
+        with self.lock:
+            conn = self.idle[key].pop() if self.idle[key] else None
+        if conn is not None:
+            try:
+                resp, data = self._send(conn, path, headers)
+            except (httplib.HTTPException, socket.error):
+                # idle connection may have been closed by the server
+                conn = None
+        if conn is None:
+            conn = self._connect(key)
+            resp, data = self._send(conn, path, headers)
+        if resp.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                self.idle[key].append(conn)
+        return resp.status, resp.reason, dict(resp.getheaders()), data
+
+    @staticmethod
+    def _send(conn, path, headers):
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            return resp, resp.read()
+        except:
+            conn.close()
+            raise
+
 _rxheader = re.compile(r'Index of (.*)')
 
 def pagelist(html):